@@ -4,7 +4,14 @@ from kitti_raw import KITTI_RAW
 from kitti_prepared import KITTI_Prepared
 from sintel_raw import SINTEL_RAW
 from sintel_prepared import SINTEL_Prepared
-from kitti_2012 import KITTI_2012
+from kitti_2012 import KITTI_2012, KittiFlowPairs
 from kitti_2015 import KITTI_2015
-from nyu_v2 import NYU_Prepare, NYU_v2
-from kitti_odo import KITTI_Odo
\ No newline at end of file
+from nyu_v2 import NYU_Prepare, NYU_v2, NYU_Test
+from kitti_odo import KITTI_Odo
+from batch_augment import BatchAugment, get_batch_augment, collate_frames
+from prefetcher import DataPrefetcher
+from prepare_utils import SampleCodec, get_sample_codec, read_sample
+from raw_triplets import RawTriplets
+from prepare_engine import PrepareEngine, FrameSource, StackedSampleWriter
+from sample_cache import SharedSampleCache, get_sample_cache
+from sample_index import SampleIndex
@@ -0,0 +1,128 @@
+import os, sys
+import torch
+import torch.nn.functional as F
+
+
+def collate_frames(batch):
+    '''
+    Collate function for samples served at raw resolution.
+    Samples of the same size are stacked into (B, 3, N*H, W), otherwise the list is
+    returned as is, since raw KITTI drives do not share a single frame size.
+    '''
+    shapes = set([tuple(img.shape) for img in batch])
+    if len(shapes) == 1:
+        return torch.stack(batch, 0)
+    return list(batch)
+
+
+class BatchAugment(object):
+    '''
+    Augmentation applied on whole collated batches after the host-to-device copy.
+    It replaces the per-sample cv2.resize / cv2.flip done in the dataloader workers:
+    all frames of a sample share the same crop and flip, and are resized to img_hw.
+    '''
+    def __init__(self, img_hw, num_frames=3, flip=True, crop_scale=None, seed=0):
+        self.img_hw = img_hw
+        self.num_frames = num_frames
+        self.flip = flip
+        self.crop_scale = crop_scale
+        self.seed = seed
+        self.generator = torch.Generator()
+        self.generator.manual_seed(seed)
+
+    def sample_params(self, batch_size):
+        '''
+        Returns:
+        - scale	torch.Tensor (B,) relative size of the crop window
+        - offset	torch.Tensor (B, 2) relative (y, x) position of the crop window in [0, 1)
+        - is_flip	torch.Tensor (B,) bool
+        '''
+        if self.crop_scale is not None:
+            s_min, s_max = self.crop_scale
+            scale = s_min + (s_max - s_min) * torch.rand(batch_size, generator=self.generator)
+            offset = torch.rand(batch_size, 2, generator=self.generator)
+        else:
+            scale = torch.ones(batch_size)
+            offset = torch.zeros(batch_size, 2)
+        if self.flip:
+            is_flip = (torch.rand(batch_size, generator=self.generator) > 0.5)
+        else:
+            is_flip = torch.zeros(batch_size, dtype=torch.bool)
+        return scale, offset, is_flip
+
+    def normalize(self, img):
+        if img.dtype == torch.uint8:
+            return img.float() / 255.0
+        return img
+
+    def split_frames(self, img):
+        # (B, 3, N*H, W) -> (B, N, 3, H, W)
+        b, c, nh, w = img.shape
+        n = self.num_frames
+        return img.view(b, c, n, nh // n, w).permute(0, 2, 1, 3, 4)
+
+    def merge_frames(self, frames):
+        # (B, N, 3, H, W) -> (B, 3, N*H, W)
+        b, n, c, h, w = frames.shape
+        return frames.permute(0, 2, 1, 3, 4).reshape(b, c, n * h, w)
+
+    def resize_frames(self, frames):
+        # (M, 3, H, W) -> (M, 3, H', W'), bilinear with half-pixel centers like cv2.resize
+        if tuple(frames.shape[2:]) == tuple(self.img_hw):
+            return frames
+        return F.interpolate(frames, size=tuple(self.img_hw), mode='bilinear', align_corners=False)
+
+    def crop_box(self, frame_hw, scale, offset):
+        h, w = frame_hw
+        crop_h, crop_w = max(int(round(h * scale)), 1), max(int(round(w * scale)), 1)
+        y0 = int(offset[0] * (h - crop_h + 1))
+        x0 = int(offset[1] * (w - crop_w + 1))
+        return y0, x0, crop_h, crop_w
+
+    def augment(self, img, scale, offset, is_flip):
+        frames = self.split_frames(img)
+        b, n, c, h, w = frames.shape
+        if self.crop_scale is None:
+            frames = self.resize_frames(frames.reshape(b * n, c, h, w))
+        else:
+            # crop windows differ per sample, so resize them one sample at a time
+            cropped = []
+            for i in range(b):
+                y0, x0, crop_h, crop_w = self.crop_box((h, w), float(scale[i]), offset[i].tolist())
+                cropped.append(self.resize_frames(frames[i, :, :, y0:y0+crop_h, x0:x0+crop_w]))
+            frames = torch.cat(cropped, 0)
+        frames = frames.view(b, n, c, frames.shape[2], frames.shape[3])
+        img = self.merge_frames(frames)
+        if is_flip.any():
+            idx = torch.nonzero(is_flip).view(-1).to(img.device)
+            img = img.index_copy(0, idx, img.index_select(0, idx).flip(3))
+        return img
+
+    def __call__(self, imgs, iter_=None):
+        '''
+        Input: torch.Tensor (B, 3, N*H, W) or a list of (3, N*H, W) tensors, uint8 or float in [0, 1]
+        Output: torch.Tensor (B, 3, N*H', W') in [0, 1]
+        If iter_ is given the generator is re-seeded with seed + iter_, so an iteration draws the
+        same augmentation regardless of where training was resumed.
+        '''
+        if iter_ is not None:
+            self.generator.manual_seed(self.seed + iter_)
+        batch_size = len(imgs)
+        scale, offset, is_flip = self.sample_params(batch_size)
+        if isinstance(imgs, (list, tuple)):
+            out = []
+            for i, img in enumerate(imgs):
+                img = self.normalize(img[None])
+                out.append(self.augment(img, scale[i:i+1], offset[i:i+1], is_flip[i:i+1]))
+            return torch.cat(out, 0)
+        return self.augment(self.normalize(imgs), scale, offset, is_flip)
+
+
+def get_batch_augment(cfg, num_frames=3):
+    if not getattr(cfg, 'batch_augment', False):
+        return None
+    crop_scale = getattr(cfg, 'aug_crop_scale', None)
+    if crop_scale is not None:
+        crop_scale = (float(crop_scale[0]), float(crop_scale[1]))
+    return BatchAugment(cfg.img_hw, num_frames=num_frames, flip=getattr(cfg, 'aug_flip', True),
+                        crop_scale=crop_scale, seed=getattr(cfg, 'aug_seed', 0))
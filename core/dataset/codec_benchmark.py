@@ -0,0 +1,63 @@
+import os, sys
+import time
+import shutil
+import tempfile
+import argparse
+import numpy as np
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from prepare_utils import SampleCodec, read_sample
+
+DEFAULT_CODECS = [('png', 0), ('png', 1), ('png', None), ('png', 9), ('webp', None), ('jpeg', 95), ('jpeg', 90), ('npy', None)]
+
+
+def benchmark_codec(codec, samples, out_dir):
+    '''
+    Encodes the samples with codec into out_dir and reads them back.
+    Returns a dict with the encode / decode throughput (samples/s), the mean size of a sample (bytes)
+    and the max absolute pixel error of the round trip.
+    '''
+    fnames = [os.path.join(out_dir, '%.6d' % i + codec.ext) for i in range(len(samples))]
+    start = time.time()
+    for fname, img in zip(fnames, samples):
+        codec.write(fname, img)
+    encode_time = time.time() - start
+    size = sum([os.path.getsize(fname) for fname in fnames])
+
+    start = time.time()
+    decoded = [read_sample(fname) for fname in fnames]
+    decode_time = time.time() - start
+    max_error = max([int(np.abs(a.astype(np.int16) - b.astype(np.int16)).max()) for a, b in zip(decoded, samples)])
+    return {'encode': len(samples) / max(encode_time, 1e-6), 'decode': len(samples) / max(decode_time, 1e-6),
+            'size': size / float(len(samples)), 'max_error': max_error}
+
+
+def benchmark_codecs(data_dir, num_samples=50, codecs=DEFAULT_CODECS):
+    '''
+    Benchmark of the sample codecs on the first num_samples samples of a prepared dataset.
+    The dataset size is extrapolated to all the samples listed in its train.txt.
+    '''
+    with open(os.path.join(data_dir, 'train.txt'), 'r') as f:
+        lines = f.readlines()
+    samples = [read_sample(os.path.join(data_dir, l.strip('\n').split()[0])) for l in lines[:num_samples]]
+    print('Codec benchmark on {0} of {1} samples of {2}'.format(len(samples), len(lines), data_dir))
+    print('{0:<10} {1:>12} {2:>12} {3:>12} {4:>12} {5:>10}'.format('codec', 'encode/s', 'decode/s', 'MB/sample', 'dataset GB', 'max err'))
+    results = {}
+    for name, level in codecs:
+        codec = SampleCodec(name, level)
+        out_dir = tempfile.mkdtemp(prefix='codec_benchmark_')
+        try:
+            res = benchmark_codec(codec, samples, out_dir)
+        finally:
+            shutil.rmtree(out_dir)
+        results[codec.signature()] = res
+        print('{0:<10} {1:>12.1f} {2:>12.1f} {3:>12.2f} {4:>12.1f} {5:>10d}'.format(codec.signature(), res['encode'], res['decode'],
+              res['size'] / 2.0**20, res['size'] * len(lines) / 2.0**30, res['max_error']))
+    return results
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Prep speed, dataset size and training decode throughput per sample codec.')
+    arg_parser.add_argument('data_dir', type=str, help='a prepared dataset, with its train.txt')
+    arg_parser.add_argument('--num_samples', type=int, default=50, help='number of samples to encode per codec.')
+    args = arg_parser.parse_args()
+    benchmark_codecs(args.data_dir, num_samples=args.num_samples)
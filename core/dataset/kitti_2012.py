@@ -42,17 +42,38 @@ class KITTI_2012(KITTI_Prepared):
         - K	torch.Tensor (num_scales, 3, 3)
         - K_inv	torch.Tensor (num_scales, 3, 3)
         '''
+        img = self.load_pair(idx)
+        img = np.concatenate([img[0], img[1]], 0) / 255.0
+        img  = img.transpose(2,0,1)
+
+        return torch.from_numpy(img).float()
+
+    def load_pair(self, idx):
+        '''
+        Returns uint8 (2, H, W, 3), the two frames resized to img_hw.
+        '''
         data = self.data_list[idx]
-        # load img
         img1 = cv2.imread(data['img1_dir'])
         img2 = cv2.imread(data['img2_dir'])
-        img_hw_orig = (img1.shape[0], img1.shape[1])
-        img = np.concatenate([img1, img2], 0)
-        #img = self.preprocess_img(img, self.img_hw, is_test=True)
-        img = self.preprocess_img_origin(img, self.img_hw, is_test=True)
-        img  = img.transpose(2,0,1)
+        img1 = cv2.resize(img1, (self.img_hw[1], self.img_hw[0]))
+        img2 = cv2.resize(img2, (self.img_hw[1], self.img_hw[0]))
+        return np.stack([img1, img2], 0)
 
-        return torch.from_numpy(img).float()
+
+class KittiFlowPairs(torch.utils.data.Dataset):
+    '''
+    The image pairs of KITTI_2012 / KITTI_2015 for a DataLoader, as (idx, uint8 (2, 3, H, W)).
+    The pairs are batched and sent to the GPU as uint8, then normalized there.
+    '''
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        img = self.dataset.load_pair(idx).transpose(0, 3, 1, 2)
+        return idx, torch.from_numpy(np.ascontiguousarray(img))
 
 if __name__ == '__main__':
     pass
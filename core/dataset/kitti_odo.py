@@ -1,33 +1,42 @@
 import os, sys
 import numpy as np
-import imageio
+import cv2
 from tqdm import tqdm
 import torch.multiprocessing as mp
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from prepare_utils import copy_if_newer
+from prepare_engine import FrameSource, StackedSampleWriter, PrepareEngine
 
-def process_folder(q, data_dir, output_dir, stride=1):
-    while True:
-        if q.empty():
-            break
-        folder = q.get()
-        image_path = os.path.join(data_dir, folder, 'image_2/')
-        dump_image_path = os.path.join(output_dir, folder)
-        if not os.path.isdir(dump_image_path):
-            os.makedirs(dump_image_path)
-        f = open(os.path.join(dump_image_path, 'train.txt'), 'w')
-        
-        # Note. the os.listdir method returns arbitary order of list. We need correct order.
-        numbers = len(os.listdir(image_path))
-        for n in range(numbers - stride):
-            s_idx = n
-            e_idx = s_idx + stride
-            curr_image = imageio.imread(os.path.join(image_path, '%.6d'%s_idx)+'.png')
-            next_image = imageio.imread(os.path.join(image_path, '%.6d'%e_idx)+'.png')
-            seq_images = np.concatenate([curr_image, next_image], axis=0)
-            imageio.imsave(os.path.join(dump_image_path, '%.6d'%s_idx)+'.png', seq_images.astype('uint8'))
+class KittiOdoSource(FrameSource):
+    # KITTI odometry: seq/image_2/%.6d.png, frame pairs, seq/calib.txt.
+    num_frames = 2
+    name = 'sequence'
 
-            # Write training files
-            f.write('%s %s\n' % (os.path.join(folder, '%.6d'%s_idx)+'.png', os.path.join(folder, 'calib.txt')))
-        print(folder)
+    def __init__(self, data_dir, train_seqs):
+        self.data_dir = data_dir
+        self.train_seqs = train_seqs
+
+    def list_drives(self):
+        if not os.path.isdir(self.data_dir):
+            raise
+        return [d for d in self.train_seqs if os.path.isdir(os.path.join(self.data_dir, d))]
+
+    def image_path(self, folder):
+        return os.path.join(self.data_dir, folder, 'image_2/')
+
+    def load_frame(self, folder, idx):
+        # BGR like the other datasets, the samples are read back with cv2
+        return cv2.imread(os.path.join(self.image_path(folder), '%.6d'%idx)+'.png')
+
+    def sample_name(self, folder, frame_ids):
+        return '%.6d'%frame_ids[0]
+
+    def train_line(self, folder, sample_file):
+        return '%s %s\n' % (os.path.join(folder, sample_file), os.path.join(folder, 'calib.txt'))
+
+    def finish(self, output_dir, done_folders):
+        for folder in done_folders:
+            copy_if_newer(os.path.join(self.data_dir, folder, 'calib.txt'), os.path.join(output_dir, folder, 'calib.txt'))
 
 
 class KITTI_Odo(object):
@@ -38,40 +47,17 @@ class KITTI_Odo(object):
     def __len__(self):
         raise NotImplementedError
 
-    def prepare_data_mp(self, output_dir, stride=1):
-        num_processes = 16
-        processes = []
-        q = mp.Queue()
-        if not os.path.isfile(os.path.join(output_dir, 'train.txt')):
-            os.makedirs(output_dir)
-            #f = open(os.path.join(output_dir, 'train.txt'), 'w')
-            print('Preparing sequence data....')
-            if not os.path.isdir(self.data_dir):
-                raise
-            dirlist = os.listdir(self.data_dir)
-            total_dirlist = []
-            # Get the different folders of images
-            for d in dirlist:
-                if d in self.train_seqs:
-                    q.put(d)
-            # Process every folder
-            for rank in range(num_processes):
-                p = mp.Process(target=process_folder, args=(q, self.data_dir, output_dir, stride))
-                p.start()
-                processes.append(p)
-            for p in processes:
-                p.join()
-        
-        f = open(os.path.join(output_dir, 'train.txt'), 'w')
-        for d in self.train_seqs:
-            train_file = open(os.path.join(output_dir, d, 'train.txt'), 'r')
-            for l in train_file.readlines():
-                f.write(l)
-
-            command = 'cp ' + os.path.join(self.data_dir, d, 'calib.txt') + ' ' + os.path.join(output_dir, d, 'calib.txt')
-            os.system(command)
-        
-        print('Data Preparation Finished.')
+    def prepare_data_mp(self, output_dir, stride=1, num_workers=None, io_concurrency=None, codec=None, stride_dirs=None):
+        '''
+        Incremental: sequences whose manifest matches their input folder are kept as they are,
+        unfinished and modified sequences are (re)processed.
+        stride_dirs {stride: output_dir} are prepared in the same pass over the frames.
+        '''
+        output_dirs = {stride: output_dir}
+        output_dirs.update(stride_dirs or {})
+        engine = PrepareEngine(KittiOdoSource(self.data_dir, self.train_seqs), StackedSampleWriter(codec),
+                               num_workers=num_workers, io_concurrency=io_concurrency)
+        engine.run(output_dirs)
 
     def __getitem__(self, idx):
         raise NotImplementedError
@@ -4,61 +4,65 @@ import cv2
 from tqdm import tqdm
 import torch.multiprocessing as mp
 import pdb
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from prepare_utils import copy_if_newer
+from prepare_engine import FrameSource, StackedSampleWriter, PrepareEngine
 
-def process_folder(q, static_frames, test_scenes, data_dir, output_dir, stride=1):
-    while True:
-        if q.empty():
-            break
-        folder = q.get()
-        if folder in static_frames.keys():
-            static_ids = static_frames[folder]
-        else:
-            static_ids = []
-        scene = folder.split('/')[1]
-        if scene[:-5] in test_scenes:
-            continue
-        image_path = os.path.join(data_dir, folder, 'image_02/data')
-        dump_image_path = os.path.join(output_dir, folder)
-        if not os.path.isdir(dump_image_path):
-            os.makedirs(dump_image_path)
-        f = open(os.path.join(dump_image_path, 'train.txt'), 'w')
-        
-        # Note. the os.listdir method returns arbitary order of list. We need correct order.
-        numbers = len(os.listdir(image_path))
-        if numbers < 3:
-            print("this folder do not have enough image, numbers < 3!")
-        for n in range(numbers - 2*stride):
-            s_idx = n
-            m_idx = s_idx + stride
-            e_idx = s_idx + 2*stride
-            if '%.10d'%s_idx in static_ids or '%.10d'%e_idx in static_ids or '%.10d'%m_idx in static_ids:
-                #print('%.10d'%s_idx)
-                continue
-            curr_image = cv2.imread(os.path.join(image_path, '%.10d'%s_idx)+'.png')
-            middle_image = cv2.imread(os.path.join(image_path, '%.10d'%m_idx)+'.png')
-            next_image = cv2.imread(os.path.join(image_path, '%.10d'%e_idx)+'.png')
+class KittiRawSource(FrameSource):
+    # KITTI raw: date/drive/image_02/data/%.10d.png, triplets, static frames and test scenes left out.
+    num_frames = 3
+    name = 'drive'
 
-            if curr_image is None:
-                print(os.path.join(image_path, '%.10d'%s_idx)+'.png')
+    def __init__(self, data_dir, static_frames, test_scenes):
+        self.data_dir = data_dir
+        self.static_frames = static_frames
+        self.test_scenes = test_scenes
+
+    def list_drives(self):
+        if not os.path.isdir(self.data_dir):
+            raise
+        total_dirlist = []
+        # Get the different folders of images
+        for d in os.listdir(self.data_dir):
+            if not os.path.isdir(os.path.join(self.data_dir, d)):
                 continue
+            seclist = os.listdir(os.path.join(self.data_dir, d))
+            for s in seclist:
+                if os.path.isdir(os.path.join(self.data_dir, d, s)) and s[:-5] not in self.test_scenes:
+                    total_dirlist.append(os.path.join(d, s))
+        return total_dirlist
+
+    def image_path(self, folder):
+        return os.path.join(self.data_dir, folder, 'image_02/data')
+
+    def list_frames(self, folder):
+        names = sorted(os.listdir(self.image_path(folder)))
+        if len(names) < 3:
+            print("this folder do not have enough image, numbers < 3!")
+        return names
 
-            if middle_image is None:
-                print(os.path.join(image_path, '%.10d'%m_idx)+'.png')
-                continue
+    def load_frame(self, folder, idx):
+        return cv2.imread(os.path.join(self.image_path(folder), '%.10d'%idx)+'.png')
 
-            if next_image is None:
-                print(os.path.join(image_path, '%.10d'%e_idx)+'.png')
-                continue
+    def keep_sample(self, folder, frame_ids):
+        static_ids = self.static_frames.get(folder, set())
+        for idx in frame_ids:
+            if '%.10d'%idx in static_ids:
+                return False
+        return True
 
-            seq_images = np.concatenate([curr_image, middle_image, next_image], axis=0)
-            # seq_images = np.concatenate([seq_images, next_image], axis=0)
-            cv2.imwrite(os.path.join(dump_image_path, '%.10d'%s_idx)+'.png', seq_images.astype('uint8'))
-            # cv2.imwrite(os.path.join(dump_image_path, '%.10d'%s_idx)+'.png', seq_images.astype('uint8'))
+    def sample_name(self, folder, frame_ids):
+        return '%.10d'%frame_ids[0]
 
-            # Write training files
-            date = folder.split('/')[0]
-            f.write('%s %s\n' % (os.path.join(folder, '%.10d'%s_idx)+'.png', os.path.join(date, 'calib_cam_to_cam.txt')))
-        print(folder)
+    def train_line(self, folder, sample_file):
+        date = folder.split('/')[0]
+        return '%s %s\n' % (os.path.join(folder, sample_file), os.path.join(date, 'calib_cam_to_cam.txt'))
+
+    def finish(self, output_dir, done_folders):
+        # Get calib files
+        for date in os.listdir(self.data_dir):
+            if os.path.isdir(os.path.join(output_dir, date)):
+                copy_if_newer(os.path.join(self.data_dir, date, 'calib_cam_to_cam.txt'), os.path.join(output_dir, date, 'calib_cam_to_cam.txt'))
 
 
 class KITTI_RAW(object):
@@ -78,63 +82,31 @@ class KITTI_RAW(object):
             date, drive, frame_id = line.split(' ')
             curr_fid = '%.10d' % (np.int(frame_id))
             if os.path.join(date, drive) not in static_frames.keys():
-                static_frames[os.path.join(date, drive)] = []
-            static_frames[os.path.join(date, drive)].append(curr_fid)
+                static_frames[os.path.join(date, drive)] = set()
+            static_frames[os.path.join(date, drive)].add(curr_fid)
         return static_frames
     
     def collect_test_scenes(self):
         f = open(self.test_scenes_txt)
-        test_scenes = []
+        test_scenes = set()
         for line in f.readlines():
             line = line.strip()
-            test_scenes.append(line)
+            test_scenes.add(line)
         return test_scenes
 
-    def prepare_data_mp(self, output_dir, stride=1):
-        num_processes = 16
-        processes = []
-        q = mp.Queue()
+    def prepare_data_mp(self, output_dir, stride=1, num_workers=None, io_concurrency=None, codec=None, stride_dirs=None):
+        '''
+        Incremental: drives whose manifest matches their input folder are kept as they are,
+        unfinished, modified and newly added drives are (re)processed.
+        stride_dirs {stride: output_dir} are prepared in the same pass over the frames.
+        '''
         static_frames = self.collect_static_frame()
         test_scenes = self.collect_test_scenes()
-        if not os.path.isfile(os.path.join(output_dir, 'train.txt')):
-            os.makedirs(output_dir)
-            #f = open(os.path.join(output_dir, 'train.txt'), 'w')
-            print('Preparing sequence data....')
-            if not os.path.isdir(self.data_dir):
-                raise
-            dirlist = os.listdir(self.data_dir)
-            total_dirlist = []
-            # Get the different folders of images
-            for d in dirlist:
-                seclist = os.listdir(os.path.join(self.data_dir, d))
-                for s in seclist:
-                    if os.path.isdir(os.path.join(self.data_dir, d, s)):
-                        total_dirlist.append(os.path.join(d, s))
-                        q.put(os.path.join(d, s))
-            # Process every folder
-            for rank in range(num_processes):
-                p = mp.Process(target=process_folder, args=(q, static_frames, test_scenes, self.data_dir, output_dir, stride))
-                p.start()
-                processes.append(p)
-            for p in processes:
-                p.join()
-        
-        # Collect the training frames.
-        f = open(os.path.join(output_dir, 'train.txt'), 'w')
-        for date in os.listdir(output_dir):
-            if os.path.isdir(os.path.join(output_dir, date)):
-                drives = os.listdir(os.path.join(output_dir, date))
-                for d in drives:
-                    train_file = open(os.path.join(output_dir, date, d, 'train.txt'), 'r')
-                    for l in train_file.readlines():
-                        f.write(l)
-        
-        # Get calib files
-        for date in os.listdir(self.data_dir):
-            command = 'cp ' + os.path.join(self.data_dir, date, 'calib_cam_to_cam.txt') + ' ' + os.path.join(output_dir, date, 'calib_cam_to_cam.txt')
-            os.system(command)
-        
-        print('Data Preparation Finished.')
+        output_dirs = {stride: output_dir}
+        output_dirs.update(stride_dirs or {})
+        engine = PrepareEngine(KittiRawSource(self.data_dir, static_frames, test_scenes), StackedSampleWriter(codec),
+                               num_workers=num_workers, io_concurrency=io_concurrency)
+        engine.run(output_dirs)
 
 
 
@@ -157,10 +129,7 @@ class KITTI_RAW(object):
                         total_dirlist.append(os.path.join(d, s))
             # Process every folder
             for folder in tqdm(total_dirlist):
-                if folder in static_frames.keys():
-                    static_ids = static_frames[folder]
-                else:
-                    static_ids = []
+                static_ids = static_frames.get(folder, set())
                 scene = folder.split('/')[1]
                 if scene in test_scenes:
                     continue
@@ -1,8 +1,8 @@
 import os, sys
 import numpy as np
-import imageio
 import cv2
 import copy
+import json
 import h5py
 import scipy.io as sio
 import torch
@@ -10,6 +10,10 @@ import torch.utils.data
 import pdb
 from tqdm import tqdm
 import torch.multiprocessing as mp
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from prepare_utils import read_sample, write_json_atomic, file_fingerprint
+from sample_index import SampleIndex
+from prepare_engine import FrameSource, StackedSampleWriter, PrepareEngine
 
 def collect_image_list(path):
     # Get ppm images list of a folder.
@@ -21,49 +25,119 @@ def collect_image_list(path):
             image_list.append(l)
     return image_list
 
-def process_folder(q, data_dir, output_dir, stride, train_scenes):
-    # Directly process the original nyu v2 depth dataset.
-    while True:
-        if q.empty():
-            break
-        folder = q.get()
-        scene_name = folder.split('/')[-1]
-        s1,s2 = scene_name.split('_')[:-1], scene_name.split('_')[-1]
-        scene_name_full = ''
-        for j in s1:
-            scene_name_full = scene_name_full + j + '_'
-        scene_name_full = scene_name_full + s2[:4]
-        
-        if scene_name_full not in train_scenes:
-            continue
-        image_path = os.path.join(data_dir, folder)
-        dump_image_path = os.path.join(output_dir, folder)
-        if not os.path.isdir(dump_image_path):
-            os.makedirs(dump_image_path)
-        f = open(os.path.join(dump_image_path, 'train.txt'), 'w')
-        
-        # Note. the os.listdir method returns arbitary order of list. We need correct order.
-        image_list = collect_image_list(image_path)
-        #image_list = open(os.path.join(image_path, 'index.txt')).readlines()
-        numbers = len(image_list) - 1  # The last ppm file seems truncated.
-        for n in range(numbers - stride):
-            s_idx = n
-            e_idx = s_idx + stride
-            s_name = image_list[s_idx].strip()
-            e_name = image_list[e_idx].strip()
-            
-            curr_image = imageio.imread(os.path.join(image_path, s_name))
-            next_image = imageio.imread(os.path.join(image_path, e_name))
-            #curr_image = cv2.imread(os.path.join(image_path, s_name))
-            #next_image = cv2.imread(os.path.join(image_path, e_name))
-            seq_images = np.concatenate([curr_image, next_image], axis=0)
-            imageio.imsave(os.path.join(dump_image_path,  os.path.splitext(s_name)[0]+'.png'), seq_images.astype('uint8'))
-            #cv2.imwrite(os.path.join(dump_image_path, os.path.splitext(s_name)[0]+'.png'), seq_images.astype('uint8'))
-
-            # Write training files
-            #date = folder.split('_')[2]
-            f.write('%s %s\n' % (os.path.join(folder, os.path.splitext(s_name)[0]+'.png'), 'calib_cam_to_cam.txt'))
-        print(folder)
+def get_scene_name_full(folder):
+    # e.g. 'bedroom_0001a' -> 'bedroom_0001'
+    scene_name = folder.split('/')[-1]
+    s1,s2 = scene_name.split('_')[:-1], scene_name.split('_')[-1]
+    scene_name_full = ''
+    for j in s1:
+        scene_name_full = scene_name_full + j + '_'
+    scene_name_full = scene_name_full + s2[:4]
+    return scene_name_full
+
+# Intrinsics and distortion of the NYU v2 kinect rgb camera, for 640x480 frames.
+NYU_P_RECT = [5.1885790117450188e+02, 0.0, 3.2558244941119034e+02, 0.0, 0.0, 5.1946961112127485e+02, 2.5373616633400465e+02, 0.0, 0.0, 0.0, 1.0, 0.0]
+NYU_UNDIST_COEFF = np.array([2.07966153e-01, -5.8613825e-01, 7.223136313e-04, 1.047962719e-03, 4.98569866e-01])
+# Written by NYU_Prepare when the samples are already undistorted, cropped and resized.
+UNDISTORTED_NAME = 'undistorted.json'
+# Train / test scene names of the labeled set, cached next to splits.mat.
+SCENE_SPLIT_NAME = 'nyu_scene_split.json'
+
+def get_undistort_maps(K, img_hw):
+    h, w = img_hw
+    newcameramtx, roi = cv2.getOptimalNewCameraMatrix(K, NYU_UNDIST_COEFF, (w,h), 1, (w,h))
+    mapx, mapy = cv2.initUndistortRectifyMap(K, NYU_UNDIST_COEFF, None, newcameramtx, (w,h), 5)
+    return mapx, mapy, roi
+
+def undistort_frame(img, maps):
+    mapx, mapy, roi = maps
+    img_undist = cv2.remap(img, mapx, mapy, cv2.INTER_LINEAR)
+    x,y,w,h = roi
+    return img_undist[y:y+h, x:x+w]
+
+def rescale_intrinsics(K, img_hw_orig, img_hw_new):
+    # Same convention as NYU_v2.rescale_intrinsics.
+    K_new = copy.deepcopy(K)
+    K_new[0,:] = K_new[0,:] * img_hw_new[0] / img_hw_orig[0]
+    K_new[1,:] = K_new[1,:] * img_hw_new[1] / img_hw_orig[1]
+    return K_new
+
+_undistort_maps = {}
+
+def preprocess_frame(img, img_hw):
+    # Offline version of NYU_v2.preprocess_img for one frame.
+    h, w = img.shape[0], img.shape[1]
+    if (h, w) not in _undistort_maps:
+        K = np.array(NYU_P_RECT).reshape(3,4)[:3,:3]
+        _undistort_maps[(h, w)] = get_undistort_maps(K, (h, w))
+    img = undistort_frame(img, _undistort_maps[(h, w)])
+    return cv2.resize(img, (img_hw[1], img_hw[0]))
+
+
+class NyuSource(FrameSource):
+    '''
+    NYU v2 raw: category/scene/*.ppm of the training scenes, frame pairs.
+    With img_hw the frames are undistorted, cropped and resized to img_hw when they are decoded,
+    and the intrinsics written to calib_cam_to_cam.txt are rescaled accordingly.
+    '''
+    num_frames = 2
+    name = 'scene'
+
+    def __init__(self, data_dir, train_scenes, img_hw=None):
+        self.data_dir = data_dir
+        self.train_scenes = train_scenes
+        self.img_hw = None if img_hw is None else [int(img_hw[0]), int(img_hw[1])]
+
+    def list_drives(self):
+        if not os.path.isdir(self.data_dir):
+            raise
+        total_dirlist = []
+        # Get the different folders of images
+        for d in os.listdir(self.data_dir):
+            if not os.path.isdir(os.path.join(self.data_dir, d)):
+                continue
+            seclist = os.listdir(os.path.join(self.data_dir, d))
+            for s in seclist:
+                if os.path.isdir(os.path.join(self.data_dir, d, s)) and get_scene_name_full(s) in self.train_scenes:
+                    total_dirlist.append(os.path.join(d, s))
+        return total_dirlist
+
+    def image_path(self, folder):
+        return os.path.join(self.data_dir, folder)
+
+    def list_frames(self, folder):
+        # The last ppm file seems truncated.
+        return collect_image_list(self.image_path(folder))[:-1]
+
+    def load_frame(self, folder, idx):
+        # BGR like the other datasets, the samples are read back with cv2
+        img = cv2.imread(os.path.join(self.image_path(folder), self.frame_names(folder)[idx].strip()))
+        if self.img_hw is not None and img is not None:
+            # Undistort, crop and resize each frame once, instead of every training sample.
+            img = preprocess_frame(img, self.img_hw)
+        return img
+
+    def sample_name(self, folder, frame_ids):
+        return os.path.splitext(self.frame_names(folder)[frame_ids[0]].strip())[0]
+
+    def train_line(self, folder, sample_file):
+        return '%s %s\n' % (os.path.join(folder, sample_file), 'calib_cam_to_cam.txt')
+
+    def manifest_kwargs(self):
+        return {'img_hw': self.img_hw}
+
+    def finish(self, output_dir, done_folders):
+        P_rect = np.array(NYU_P_RECT).reshape(3,4)
+        if self.img_hw is not None:
+            P_rect[:,:3] = rescale_intrinsics(P_rect[:,:3], (480, 640), self.img_hw)
+        f = open(os.path.join(output_dir, 'calib_cam_to_cam.txt'), 'w')
+        f.write('P_rect: ' + ' '.join([repr(float(k)) for k in P_rect.reshape(-1)]))
+        f.close()
+        if self.img_hw is not None:
+            write_json_atomic(os.path.join(output_dir, UNDISTORTED_NAME), {'img_hw': self.img_hw})
+        elif os.path.isfile(os.path.join(output_dir, UNDISTORTED_NAME)):
+            os.remove(os.path.join(output_dir, UNDISTORTED_NAME))
+
 
 class NYU_Prepare(object):
     def __init__(self, data_dir, test_dir):
@@ -71,8 +145,7 @@ class NYU_Prepare(object):
         self.test_data = os.path.join(test_dir, 'nyu_depth_v2_labeled.mat')
         self.splits = os.path.join(test_dir, 'splits.mat')
         self.get_all_scenes()
-        self.get_test_scenes()
-        self.get_train_scenes()
+        self.get_scene_split()
         
 
     def __len__(self):
@@ -87,78 +160,62 @@ class NYU_Prepare(object):
                 for path in pp:
                     self.all_scenes.append(path)
 
-    def get_test_scenes(self):
-        self.test_scenes = []
-        test_data = h5py.File(self.test_data, 'r')
-        test_split = sio.loadmat(self.splits)['testNdxs']
-        test_split = np.array(test_split).squeeze(1)
-        
-        test_scenes = test_data['scenes'][0][test_split-1]
-        for i in range(len(test_scenes)):
-            obj = test_data[test_scenes[i]]
-            name = "".join(chr(j) for j in obj[:])
-            if name not in self.test_scenes:
-                self.test_scenes.append(name)
-        #pdb.set_trace()
-    
-    def get_train_scenes(self):
-        self.train_scenes = []
-        train_data = h5py.File(self.test_data, 'r')
-        train_split = sio.loadmat(self.splits)['trainNdxs']
-        train_split = np.array(train_split).squeeze(1)
-        
-        train_scenes = train_data['scenes'][0][train_split-1]
-        for i in range(len(train_scenes)):
-            obj = train_data[train_scenes[i]]
-            name = "".join(chr(j) for j in obj[:])
-            if name not in self.train_scenes:
-                self.train_scenes.append(name)
-
-
-    def prepare_data_mp(self, output_dir, stride=1):
-        num_processes = 32
-        processes = []
-        q = mp.Queue()
-        if not os.path.isfile(os.path.join(output_dir, 'train.txt')):
-            os.makedirs(output_dir)
-            #f = open(os.path.join(output_dir, 'train.txt'), 'w')
-            print('Preparing sequence data....')
-            if not os.path.isdir(self.data_dir):
-                raise
-            dirlist = os.listdir(self.data_dir)
-            total_dirlist = []
-            # Get the different folders of images
-            for d in dirlist:
-                if not os.path.isdir(os.path.join(self.data_dir, d)):
-                    continue
-                seclist = os.listdir(os.path.join(self.data_dir, d))
-                for s in seclist:
-                    if os.path.isdir(os.path.join(self.data_dir, d, s)):
-                        total_dirlist.append(os.path.join(d, s))
-                        q.put(os.path.join(d, s))
-            # Process every folder
-            for rank in range(num_processes):
-                p = mp.Process(target=process_folder, args=(q, self.data_dir, output_dir, stride, self.train_scenes))
-                p.start()
-                processes.append(p)
-            for p in processes:
-                p.join()
-        
-        # Collect the training frames.
-        f = open(os.path.join(output_dir, 'train.txt'), 'w')
-        for dirlist in os.listdir(output_dir):
-            if os.path.isdir(os.path.join(output_dir, dirlist)):
-                seclists = os.listdir(os.path.join(output_dir, dirlist))
-                for s in seclists:
-                    train_file = open(os.path.join(output_dir, dirlist, s, 'train.txt'), 'r')
-                    for l in train_file.readlines():
-                        f.write(l)
-        f.close()
-        
-        f = open(os.path.join(output_dir, 'calib_cam_to_cam.txt'), 'w')
-        f.write('P_rect: 5.1885790117450188e+02 0.0 3.2558244941119034e+02 0.0 0.0 5.1946961112127485e+02 2.5373616633400465e+02 0.0 0.0 0.0 1.0 0.0')
-        f.close()
-        print('Data Preparation Finished.')
+    def read_scene_split(self):
+        # Scene names of the train / test frames, the labeled .mat file is opened once.
+        data = h5py.File(self.test_data, 'r')
+        splits = sio.loadmat(self.splits)
+        scene_refs = data['scenes'][0]
+        split = {}
+        for key, ndx_key in [('train_scenes', 'trainNdxs'), ('test_scenes', 'testNdxs')]:
+            ndxs = np.array(splits[ndx_key]).squeeze(1)
+            names = set()
+            for i in ndxs:
+                obj = data[scene_refs[i-1]]
+                names.add("".join(chr(j) for j in obj[:].reshape(-1)))
+            split[key] = sorted(names)
+        data.close()
+        return split
+
+    def get_scene_split(self, cache_file=None):
+        '''
+        The train / test scene split is cached in a small json file next to splits.mat, keyed by the
+        fingerprints of nyu_depth_v2_labeled.mat and splits.mat.
+        '''
+        if cache_file is None:
+            cache_file = os.path.join(os.path.dirname(self.splits), SCENE_SPLIT_NAME)
+        key = [file_fingerprint(self.test_data), file_fingerprint(self.splits)]
+        split = None
+        if os.path.isfile(cache_file):
+            try:
+                with open(cache_file, 'r') as f:
+                    cached = json.load(f)
+                if cached.get('key') == key:
+                    split = cached
+            except ValueError:
+                split = None
+        if split is None:
+            split = self.read_scene_split()
+            split['key'] = key
+            try:
+                write_json_atomic(cache_file, split)
+            except (IOError, OSError):
+                print('The NYU scene split can not be cached in ' + cache_file)
+        self.train_scenes = set(split['train_scenes'])
+        self.test_scenes = set(split['test_scenes'])
+
+    def prepare_data_mp(self, output_dir, stride=1, num_workers=None, io_concurrency=None, codec=None, img_hw=None, stride_dirs=None):
+        '''
+        Incremental: scenes whose manifest matches their input folder are kept as they are,
+        unfinished, modified and newly added scenes are (re)processed.
+        With img_hw the frames are undistorted, cropped and resized to img_hw here, the rescaled
+        intrinsics are written to calib_cam_to_cam.txt and NYU_v2 skips that per sample.
+        stride_dirs {stride: output_dir} are prepared in the same pass over the frames.
+        '''
+        output_dirs = {stride: output_dir}
+        output_dirs.update(stride_dirs or {})
+        engine = PrepareEngine(NyuSource(self.data_dir, self.train_scenes, img_hw=img_hw), StackedSampleWriter(codec),
+                               num_workers=num_workers, io_concurrency=io_concurrency)
+        engine.run(output_dirs)
 
     def __getitem__(self, idx):
         raise NotImplementedError
@@ -172,23 +229,20 @@ class NYU_v2(torch.utils.data.Dataset):
         self.num_scales = num_scales
         self.img_hw = img_hw
         self.num_iterations = num_iterations
-        self.undist_coeff = np.array([2.07966153e-01, -5.8613825e-01, 7.223136313e-04, 1.047962719e-03, 4.98569866e-01])
+        self.undist_coeff = NYU_UNDIST_COEFF
         self.mapx, self.mapy = None, None
         self.roi = None
+        # samples prepared with NYU_Prepare.prepare_data_mp(img_hw=...) are already undistorted
+        self.undistorted = os.path.isfile(os.path.join(self.data_dir, UNDISTORTED_NAME))
+        if self.undistorted:
+            print('Undistorted samples found, the per sample undistortion is skipped.')
 
         info_file = os.path.join(self.data_dir, 'train.txt')
         self.data_list = self.get_data_list(info_file)
 
     def get_data_list(self, info_file):
-        with open(info_file, 'r') as f:
-            lines = f.readlines()
-        data_list = []
-        for line in lines:
-            k = line.strip('\n').split()
-            data = {}
-            data['image_file'] = os.path.join(self.data_dir, k[0])
-            data['cam_intrinsic_file'] = os.path.join(self.data_dir, k[1])
-            data_list.append(data)
+        # array-backed, see SampleIndex
+        data_list = SampleIndex.load(self.data_dir, os.path.basename(info_file))
         print('A total of {} image pairs found'.format(len(data_list)))
         return data_list
 
@@ -250,12 +304,13 @@ class NYU_v2(torch.utils.data.Dataset):
     def preprocess_img(self, img, K, img_hw=None, is_test=False):
         if img_hw is None:
             img_hw = self.img_hw
-        if not is_test:
+        if not is_test and not self.undistorted:
             #img = img
             img = self.undistort_img(img, K)
             #img = self.random_flip_img(img)
             
-        img = self.resize_img(img, img_hw)
+        if (int(img.shape[0] / 2), img.shape[1]) != tuple(img_hw):
+            img = self.resize_img(img, img_hw)
         img = img / 255.0
         return img
 
@@ -302,13 +357,12 @@ class NYU_v2(torch.utils.data.Dataset):
             raise IndexError
         if self.num_iterations is not None:
             idx = self.rand_num(idx)
-        data = self.data_list[idx]
         # load img
-        img = cv2.imread(data['image_file'])
+        img = read_sample(self.data_list.image_file(idx))
         img_hw_orig = (int(img.shape[0] / 2), img.shape[1])
         
         # load intrinsic
-        cam_intrinsic_orig = self.read_cam_intrinsic(data['cam_intrinsic_file'])
+        cam_intrinsic_orig = self.read_cam_intrinsic(self.data_list.cam_intrinsic_file(idx))
         cam_intrinsic = self.rescale_intrinsics(cam_intrinsic_orig, img_hw_orig, self.img_hw)
         K_ms, K_inv_ms = self.get_multiscale_intrinsics(cam_intrinsic, self.num_scales) # (num_scales, 3, 3), (num_scales, 3, 3)
         
@@ -321,6 +375,91 @@ class NYU_v2(torch.utils.data.Dataset):
 
 
 
+class NYU_Test(object):
+    '''
+    The 654 labeled test frames of NYU v2, cropped to the evaluation region.
+    Only the test indices are read from nyu_depth_v2_labeled.mat, in increasing order and in
+    chunks, instead of loading and transposing the full images / depths arrays.
+    Without cache_dir the frames are read from the .mat file on access. With cache_dir the cropped
+    frames are written once to memory-mapped .npy files and served from there afterwards.
+    Item i is (img uint8 (3, H, W), depth float32 (H, W)), in the order of splits.mat.
+    '''
+    def __init__(self, data_dir, cache_dir=None, crop=(45, 472, 41, 602), chunk_size=32):
+        self.mat_file = os.path.join(data_dir, 'nyu_depth_v2_labeled.mat')
+        self.crop = crop
+        self.chunk_size = chunk_size
+        test = np.array(sio.loadmat(os.path.join(data_dir, 'splits.mat'))['testNdxs']).squeeze(1)
+        self.test_idx = test - 1
+        self.data = None
+        self.images, self.depths = None, None
+        if cache_dir is not None:
+            self.load_cache(cache_dir)
+
+    def __len__(self):
+        return len(self.test_idx)
+
+    def open(self):
+        if self.data is None:
+            self.data = h5py.File(self.mat_file, 'r')
+        return self.data
+
+    def crop_frames(self, images, depths):
+        # images (B, 3, W, H), depths (B, W, H) as stored in the .mat file
+        y0, y1, x0, x1 = self.crop
+        images = np.transpose(images, [0,1,3,2])[:, :, y0:y1, x0:x1]
+        depths = np.transpose(depths, [0,2,1])[:, y0:y1, x0:x1]
+        return images, depths
+
+    def read_chunks(self):
+        '''
+        Yields (positions, images, depths) for chunks of test frames, read in increasing index order.
+        '''
+        data = self.open()
+        order = np.argsort(self.test_idx)
+        for start in range(0, len(order), self.chunk_size):
+            pos = order[start:start+self.chunk_size]
+            idx = [int(i) for i in self.test_idx[pos]]
+            images, depths = self.crop_frames(data['images'][idx], data['depths'][idx])
+            yield pos, images, depths
+
+    def load_cache(self, cache_dir):
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        stat = os.stat(self.mat_file)
+        key = {'size': stat.st_size, 'mtime': stat.st_mtime, 'crop': list(self.crop), 'test_idx': [int(i) for i in self.test_idx]}
+        key_file = os.path.join(cache_dir, 'nyu_test.json')
+        image_file, depth_file = os.path.join(cache_dir, 'nyu_test_images.npy'), os.path.join(cache_dir, 'nyu_test_depths.npy')
+        if os.path.isfile(key_file) and os.path.isfile(image_file) and os.path.isfile(depth_file):
+            with open(key_file, 'r') as f:
+                cached_key = json.load(f)
+            if cached_key == key:
+                self.images = np.load(image_file, mmap_mode='r')
+                self.depths = np.load(depth_file, mmap_mode='r')
+                return
+        print('Caching the NYU v2 test frames in ' + cache_dir)
+        y0, y1, x0, x1 = self.crop
+        images = np.lib.format.open_memmap(image_file + '.tmp', mode='w+', dtype=np.uint8, shape=(len(self), 3, y1-y0, x1-x0))
+        depths = np.lib.format.open_memmap(depth_file + '.tmp', mode='w+', dtype=np.float32, shape=(len(self), y1-y0, x1-x0))
+        for pos, img, depth in self.read_chunks():
+            images[pos] = img
+            depths[pos] = depth
+        images.flush()
+        depths.flush()
+        del images, depths
+        os.replace(image_file + '.tmp', image_file)
+        os.replace(depth_file + '.tmp', depth_file)
+        write_json_atomic(key_file, key)
+        self.images = np.load(image_file, mmap_mode='r')
+        self.depths = np.load(depth_file, mmap_mode='r')
+
+    def __getitem__(self, i):
+        if self.images is not None:
+            return self.images[i], self.depths[i]
+        data = self.open()
+        idx = int(self.test_idx[i])
+        images, depths = self.crop_frames(data['images'][idx:idx+1], data['depths'][idx:idx+1])
+        return images[0], depths[0]
+
 
 
 if __name__ == '__main__':
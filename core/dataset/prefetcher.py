@@ -0,0 +1,158 @@
+import os, sys
+import time
+import queue
+import threading
+import collections
+import torch
+
+
+def map_tensors(batch, fn):
+    # Apply fn to every tensor of a (possibly nested) batch.
+    if isinstance(batch, torch.Tensor):
+        return fn(batch)
+    if isinstance(batch, (list, tuple)):
+        return type(batch)([map_tensors(b, fn) for b in batch])
+    if isinstance(batch, dict):
+        return {k: map_tensors(v, fn) for k, v in batch.items()}
+    return batch
+
+
+def pin_batch(batch):
+    return map_tensors(batch, lambda t: t if t.is_pinned() else t.pin_memory())
+
+
+def batch_to_device(batch, device, non_blocking=False):
+    return map_tensors(batch, lambda t: t.to(device, non_blocking=non_blocking))
+
+
+class _End(object):
+    pass
+
+
+class _Error(object):
+    def __init__(self, exc):
+        self.exc = exc
+
+
+class DataPrefetcher(object):
+    '''
+    Wraps a DataLoader so that the next batches are already on the device when the
+    training step asks for them.
+    A background thread pulls batches from the loader and pins them. On CUDA the pinned
+    batches are copied with non_blocking=True on a side stream, up to `depth` batches ahead
+    of the step being run. On CPU it degrades to a plain background-thread prefetch.
+    The time the loop spent blocked on data is kept in wait_time.
+    '''
+    def __init__(self, loader, device=None, depth=2, pin_memory=None):
+        self.loader = loader
+        if device is None:
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.device = torch.device(device)
+        self.depth = max(int(depth), 1)
+        self.use_cuda = (self.device.type == 'cuda')
+        self.pin_memory = self.use_cuda if pin_memory is None else pin_memory
+        self.stream = torch.cuda.Stream(device=self.device) if self.use_cuda else None
+
+        self.wait_time = 0.0
+        self.num_batches = 0
+        self.interval_wait = 0.0
+        self.interval_batches = 0
+
+    def __len__(self):
+        return len(self.loader)
+
+    def produce(self, q, stop):
+        try:
+            for batch in self.loader:
+                if self.pin_memory:
+                    batch = pin_batch(batch)
+                while not stop.is_set():
+                    try:
+                        q.put(batch, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                if stop.is_set():
+                    return
+            q.put(_End())
+        except Exception as e:
+            q.put(_Error(e))
+
+    def stage(self, batch):
+        if not self.use_cuda:
+            return batch, None
+        with torch.cuda.stream(self.stream):
+            batch = batch_to_device(batch, self.device, non_blocking=self.pin_memory)
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        return batch, event
+
+    def release(self, batch, event):
+        if event is not None:
+            stream = torch.cuda.current_stream(self.device)
+            stream.wait_event(event)
+            # the memory was allocated on the side stream but is consumed on the current one
+            map_tensors(batch, lambda t: t.record_stream(stream))
+        return batch
+
+    def __iter__(self):
+        q = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self.produce, args=(q, stop))
+        thread.daemon = True
+        thread.start()
+
+        staged = collections.deque()
+        finished = False
+        try:
+            while True:
+                start = time.time()
+                if not staged:
+                    if finished:
+                        break
+                    item = q.get()
+                    if isinstance(item, _Error):
+                        raise item.exc
+                    if isinstance(item, _End):
+                        break
+                    staged.append(self.stage(item))
+                batch, event = staged.popleft()
+                # stage whatever is ready so its copy overlaps with this step
+                while not finished and len(staged) < self.depth:
+                    try:
+                        item = q.get_nowait()
+                    except queue.Empty:
+                        break
+                    if isinstance(item, _Error):
+                        raise item.exc
+                    if isinstance(item, _End):
+                        finished = True
+                        break
+                    staged.append(self.stage(item))
+                batch = self.release(batch, event)
+
+                wait = time.time() - start
+                self.wait_time += wait
+                self.interval_wait += wait
+                self.num_batches += 1
+                self.interval_batches += 1
+                yield batch
+        finally:
+            stop.set()
+            while thread.is_alive():
+                try:
+                    q.get_nowait()
+                except queue.Empty:
+                    thread.join(timeout=0.1)
+
+    def stats(self, reset=True):
+        '''
+        Returns the average time per step spent waiting for data since the last reset,
+        and the total wait time so far (seconds).
+        '''
+        stats = {'data_wait': self.interval_wait / max(self.interval_batches, 1),
+                 'data_wait_total': self.wait_time}
+        if reset:
+            self.interval_wait = 0.0
+            self.interval_batches = 0
+        return stats
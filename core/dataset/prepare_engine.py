@@ -0,0 +1,191 @@
+import os, sys
+import numpy as np
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from prepare_utils import FrameWindow, AsyncImageWriter, SampleCodec
+from prepare_utils import drive_signature, drive_is_complete, write_drive_index, write_index_atomic, clear_drive_samples
+from prepare_scheduler import PrepareScheduler
+
+
+class FrameSource(object):
+    '''
+    Reader of a raw dataset for the PrepareEngine, one subclass per dataset.
+    A drive is a folder of consecutive frames; a sample of stride s starting at frame t is made of
+    the frames t, t + s, ..., t + (num_frames - 1) * s.
+    Sources are sent to the preparation workers, keep them picklable.
+    '''
+    num_frames = 3
+    name = 'drive'
+
+    def list_drives(self):
+        # Folders of the training drives, relative to the data dir.
+        raise NotImplementedError
+
+    def image_path(self, folder):
+        raise NotImplementedError
+
+    def frame_names(self, folder):
+        # File names of the frames of a drive, in frame order. Listed once per worker.
+        if not hasattr(self, '_frame_names'):
+            self._frame_names = {}
+        if folder not in self._frame_names:
+            self._frame_names[folder] = self.list_frames(folder)
+        return self._frame_names[folder]
+
+    def list_frames(self, folder):
+        # Note. the os.listdir method returns arbitary order of list. We need correct order.
+        return sorted(os.listdir(self.image_path(folder)))
+
+    def num_samples(self, folder, stride):
+        return max(len(self.frame_names(folder)) - (self.num_frames - 1) * stride, 0)
+
+    def load_frame(self, folder, idx):
+        raise NotImplementedError
+
+    def keep_sample(self, folder, frame_ids):
+        # e.g. static frames filtering
+        return True
+
+    def sample_name(self, folder, frame_ids):
+        # File name of a sample without extension.
+        raise NotImplementedError
+
+    def train_line(self, folder, sample_file):
+        # Line of a sample in train.txt.
+        return '%s\n' % os.path.join(folder, sample_file)
+
+    def signature(self, folder):
+        return drive_signature(self.image_path(folder))
+
+    def manifest_kwargs(self):
+        # Preparation settings of the source, a drive is prepared again when they change.
+        return {}
+
+    def finish(self, output_dir, done_folders):
+        # Called once per output dir after the drives are prepared (calibration files...).
+        pass
+
+
+class StackedSampleWriter(object):
+    '''
+    Writes the frames of a sample stacked vertically into one image, encoded with a SampleCodec.
+    Encoding runs on a background thread of the worker.
+    '''
+    def __init__(self, codec=None):
+        self.codec = SampleCodec() if codec is None else codec
+        self.ext = self.codec.ext
+        self.writer = None
+
+    def signature(self):
+        return self.codec.signature()
+
+    def start(self):
+        self.writer = AsyncImageWriter(self.codec.write)
+
+    def write(self, fname, frames):
+        self.writer.write(fname, np.concatenate(frames, axis=0).astype('uint8'))
+
+    def close(self):
+        self.writer.close()
+        self.writer = None
+
+
+def process_chunk(task, context):
+    '''
+    Prepare the samples starting at frames [start, end) of a drive, for all its pending strides.
+    Every frame is decoded once and shared by the samples of all the strides.
+    '''
+    folder, start, end = task
+    source, writer, output_dirs = context['source'], context['writer'], context['output_dirs']
+    window = FrameWindow(lambda idx: source.load_frame(folder, idx))
+    writer.start()
+    lines = []
+    try:
+        for s_idx in range(start, end):
+            window.evict_before(s_idx)
+            for stride, num_samples in context['pending'][folder]:
+                if s_idx >= num_samples:
+                    continue
+                frame_ids = [s_idx + k * stride for k in range(source.num_frames)]
+                if not source.keep_sample(folder, frame_ids):
+                    continue
+                frames = [window.get(i) for i in frame_ids]
+                missing = [i for i, img in zip(frame_ids, frames) if img is None]
+                if len(missing) > 0:
+                    print(os.path.join(source.image_path(folder), source.frame_names(folder)[missing[0]]))
+                    continue
+                sample_file = source.sample_name(folder, frame_ids) + writer.ext
+                writer.write(os.path.join(output_dirs[stride], folder, sample_file), frames)
+                lines.append(((stride, s_idx), source.train_line(folder, sample_file)))
+    finally:
+        writer.close()
+    return lines, window.num_decoded
+
+
+class PrepareEngine(object):
+    '''
+    Incremental preparation of a raw dataset, shared by all datasets.
+    - source	FrameSource, what the drives, frames, samples and calibration are
+    - writer	sample writer, how a sample is stored (StackedSampleWriter)
+    run() prepares several strides in one decode pass, each into its own output dir with its own
+    manifests and train.txt. Drives whose manifest matches their input folder are kept as they are,
+    unfinished, modified and newly added drives are (re)processed.
+    '''
+    def __init__(self, source, writer=None, num_workers=None, io_concurrency=None):
+        self.source = source
+        self.writer = StackedSampleWriter() if writer is None else writer
+        self.num_workers = num_workers
+        self.io_concurrency = io_concurrency
+
+    def manifest_kwargs(self, stride):
+        kwargs = {'stride': stride, 'codec': self.writer.signature()}
+        kwargs.update(self.source.manifest_kwargs())
+        return kwargs
+
+    def run(self, output_dirs):
+        '''
+        output_dirs: {stride: output_dir}
+        '''
+        strides = sorted(output_dirs.keys())
+        for stride in strides:
+            if not os.path.isdir(output_dirs[stride]):
+                os.makedirs(output_dirs[stride])
+        total_dirlist = sorted(self.source.list_drives())
+        signatures = {}
+        pending = {}
+        drives = []
+        for folder in total_dirlist:
+            signatures[folder] = self.source.signature(folder)
+            pending[folder] = []
+            for stride in strides:
+                dump_image_path = os.path.join(output_dirs[stride], folder)
+                if drive_is_complete(dump_image_path, signatures[folder], **self.manifest_kwargs(stride)):
+                    continue
+                if not os.path.isdir(dump_image_path):
+                    os.makedirs(dump_image_path)
+                else:
+                    # every sample is written again, drop the stale ones (e.g. of another codec)
+                    clear_drive_samples(dump_image_path)
+                pending[folder].append((stride, self.source.num_samples(folder, stride)))
+            if len(pending[folder]) > 0:
+                drives.append((folder, max([n for s, n in pending[folder]])))
+        print('Preparing sequence data: {0} of {1} {2}s to process, strides {3}....'.format(len(drives), len(total_dirlist), self.source.name, strides))
+
+        def finalize(folder, lines):
+            for stride, num_samples in pending[folder]:
+                stride_lines = [(key[1], l) for key, l in lines if key[0] == stride]
+                write_drive_index(os.path.join(output_dirs[stride], folder), stride_lines, signatures[folder], **self.manifest_kwargs(stride))
+        context = {'source': self.source, 'writer': self.writer, 'output_dirs': output_dirs, 'pending': pending}
+        scheduler = PrepareScheduler(num_workers=self.num_workers, io_concurrency=self.io_concurrency)
+        scheduler.run(process_chunk, context, drives, finalize)
+
+        # Collect the training frames of the finished drives.
+        for stride in strides:
+            done_dirlist = []
+            for folder in total_dirlist:
+                if drive_is_complete(os.path.join(output_dirs[stride], folder), signatures[folder], **self.manifest_kwargs(stride)):
+                    done_dirlist.append(folder)
+                else:
+                    print('{0} {1} is not finished, it is left out of train.txt.'.format(self.source.name.capitalize(), folder))
+            write_index_atomic(output_dirs[stride], done_dirlist)
+            self.source.finish(output_dirs[stride], done_dirlist)
+        print('Data Preparation Finished.')
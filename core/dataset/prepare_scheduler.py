@@ -0,0 +1,108 @@
+import os, sys
+import time
+from tqdm import tqdm
+import torch.multiprocessing as mp
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from prepare_utils import PrepareMeter
+
+
+def default_num_workers(io_concurrency=None):
+    '''
+    One worker per core available to this process. io_concurrency caps it for storage
+    that does not scale with the number of concurrent readers (e.g. network file systems).
+    '''
+    try:
+        num_cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        num_cores = mp.cpu_count()
+    if io_concurrency is None:
+        return max(num_cores, 1)
+    return max(min(num_cores, io_concurrency), 1)
+
+
+_worker_state = {}
+
+def _init_worker(chunk_fn, context):
+    # The context (paths, static frames...) is sent once per worker, not once per chunk.
+    _worker_state['chunk_fn'] = chunk_fn
+    _worker_state['context'] = context
+
+def _run_chunk(task):
+    lines, num_decoded = _worker_state['chunk_fn'](task, _worker_state['context'])
+    return task, lines, num_decoded, os.getpid()
+
+
+class PrepareScheduler(object):
+    '''
+    Runs the data preparation at frame-chunk granularity.
+    Every drive is split into chunks of chunk_size consecutive samples. Chunks of the longest
+    drives are queued first and an idle worker always takes the next pending chunk, so a long
+    drive is spread over all workers instead of dictating the wall-clock time on its own.
+    Drives are finalized in the main process once all their chunks are done, with the samples
+    sorted back into their original order.
+    '''
+    def __init__(self, num_workers=None, chunk_size=64, io_concurrency=None):
+        if num_workers is None:
+            num_workers = default_num_workers(io_concurrency)
+        self.num_workers = num_workers
+        self.chunk_size = chunk_size
+
+    def split_tasks(self, drives):
+        tasks = []
+        for folder, num_samples in sorted(drives, key=lambda d: -d[1]):
+            for start in range(0, num_samples, self.chunk_size):
+                tasks.append((folder, start, min(start + self.chunk_size, num_samples)))
+        return tasks
+
+    def run(self, chunk_fn, context, drives, finalize_fn):
+        '''
+        - chunk_fn(task, context) -> (lines, num_decoded), a top level function run in the workers.
+          task is (folder, start, end) and lines a list of (sample_idx, line) for the drive train.txt.
+        - drives: list of (folder, num_samples)
+        - finalize_fn(folder, lines) is called in the main process once a drive is complete.
+        '''
+        tasks = self.split_tasks(drives)
+        pending = {}
+        drive_lines = {}
+        for folder, num_samples in drives:
+            pending[folder] = 0
+            drive_lines[folder] = []
+        for folder, start, end in tasks:
+            pending[folder] += 1
+        for folder, num_samples in drives:
+            if pending[folder] == 0:
+                finalize_fn(folder, [])
+
+        total_samples = sum([d[1] for d in drives])
+        if len(tasks) == 0:
+            return
+        num_workers = min(self.num_workers, len(tasks))
+        print('Preparing {0} samples in {1} chunks with {2} workers.'.format(total_samples, len(tasks), num_workers))
+        meters = {}
+        start_time = time.time()
+        pool = mp.Pool(num_workers, initializer=_init_worker, initargs=(chunk_fn, context))
+        try:
+            pbar = tqdm(total=total_samples, unit='sample', dynamic_ncols=True)
+            for task, lines, num_decoded, pid in pool.imap_unordered(_run_chunk, tasks, chunksize=1):
+                folder, start, end = task
+                if pid not in meters:
+                    meters[pid] = PrepareMeter(name='worker {}'.format(pid), start=start_time)
+                meters[pid].update(num_decoded, len(lines))
+                pbar.update(end - start)
+                pbar.set_postfix(frames_per_s='{0:.1f}'.format(sum([m.num_decoded for m in meters.values()]) / max(time.time() - start_time, 1e-6)))
+
+                drive_lines[folder].extend(lines)
+                pending[folder] -= 1
+                if pending[folder] == 0:
+                    lines = sorted(drive_lines.pop(folder), key=lambda l: l[0])
+                    finalize_fn(folder, lines)
+                    pbar.write(folder)
+            pbar.close()
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        for pid in sorted(meters.keys()):
+            meters[pid].report()
@@ -0,0 +1,277 @@
+import os, sys
+import time
+import json
+import hashlib
+import shutil
+import queue
+import threading
+import numpy as np
+import cv2
+
+
+class FrameWindow(object):
+    '''
+    Sliding window of decoded frames for a process walking over the samples of a drive.
+    Every frame is decoded at most once and dropped as soon as the walk moved past it,
+    so at most 2 * stride + 1 frames are kept.
+    '''
+    def __init__(self, load_fn):
+        self.load_fn = load_fn
+        self.frames = {}
+        self.num_decoded = 0
+
+    def get(self, idx):
+        if idx not in self.frames:
+            # a failed decode (None) is cached as well, it would fail again
+            self.frames[idx] = self.load_fn(idx)
+            self.num_decoded += 1
+        return self.frames[idx]
+
+    def evict_before(self, idx):
+        for k in [k for k in self.frames.keys() if k < idx]:
+            del self.frames[k]
+
+
+class AsyncImageWriter(object):
+    '''
+    Encodes and writes images on a background thread, so that decoding the next frames
+    overlaps with encoding the current sample. The queue is bounded to keep memory in check.
+    '''
+    def __init__(self, write_fn=cv2.imwrite, max_queue=16):
+        self.write_fn = write_fn
+        self.q = queue.Queue(maxsize=max_queue)
+        self.num_written = 0
+        self.error = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.q.get()
+            if item is None:
+                self.q.task_done()
+                break
+            path, img = item
+            try:
+                self.write_fn(path, img)
+                self.num_written += 1
+            except Exception as e:
+                self.error = e
+            self.q.task_done()
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+    def write(self, path, img):
+        self.check()
+        self.q.put((path, img))
+
+    def flush(self):
+        self.q.join()
+        self.check()
+
+    def close(self):
+        self.q.put(None)
+        self.thread.join()
+        self.check()
+
+
+SAMPLE_CODECS = {'png': '.png', 'webp': '.webp', 'jpeg': '.jpg', 'npy': '.npy'}
+
+
+class SampleCodec(object):
+    '''
+    Encoding of the prepared samples. Images are BGR uint8 as returned by cv2.imread.
+    - png	level is the compression level 0-9, None keeps the cv2 default (3)
+    - webp	lossless
+    - jpeg	level is the quality 0-100, 95 by default; lossy
+    - npy	uncompressed np.save, the fastest to decode but the largest on disk
+    '''
+    def __init__(self, name='png', level=None):
+        if name not in SAMPLE_CODECS:
+            raise ValueError('Unknown sample codec {}, expected one of {}'.format(name, sorted(SAMPLE_CODECS.keys())))
+        self.name = name
+        self.level = level
+        self.ext = SAMPLE_CODECS[name]
+
+    def params(self):
+        if self.name == 'png':
+            return [] if self.level is None else [cv2.IMWRITE_PNG_COMPRESSION, int(self.level)]
+        if self.name == 'webp':
+            # quality above 100 selects the lossless mode
+            return [cv2.IMWRITE_WEBP_QUALITY, 101]
+        if self.name == 'jpeg':
+            return [cv2.IMWRITE_JPEG_QUALITY, 95 if self.level is None else int(self.level)]
+        return []
+
+    def signature(self):
+        # Stored in the drive manifests, a drive is prepared again when its encoding changes.
+        if self.level is None:
+            return self.name
+        return '{}-{}'.format(self.name, self.level)
+
+    def write(self, fname, img):
+        if self.name == 'npy':
+            np.save(fname, np.ascontiguousarray(img))
+        elif not cv2.imwrite(fname, img, self.params()):
+            raise IOError('Failed to write ' + fname)
+
+
+def get_sample_codec(cfg):
+    return SampleCodec(getattr(cfg, 'prep_codec', 'png') or 'png', getattr(cfg, 'prep_codec_level', None))
+
+
+def read_sample(fname):
+    # Decoder matching SampleCodec, chosen from the file extension. Returns BGR uint8 like cv2.imread.
+    if os.path.splitext(fname)[1] == '.npy':
+        return np.load(fname)
+    return cv2.imread(fname)
+
+
+class PrepareMeter(object):
+    # Frames decoded / samples written per second of a preparation worker.
+    def __init__(self, name=None, start=None):
+        if name is None:
+            name = 'worker {}'.format(os.getpid())
+        if start is None:
+            start = time.time()
+        self.name = name
+        self.start = start
+        self.num_decoded = 0
+        self.num_samples = 0
+
+    def update(self, num_decoded, num_samples):
+        self.num_decoded += num_decoded
+        self.num_samples += num_samples
+
+    def report(self):
+        elapsed = max(time.time() - self.start, 1e-6)
+        print('{0}: {1} frames decoded, {2} samples written, {3:.1f} frames/s, {4:.1f} samples/s'.format(
+            self.name, self.num_decoded, self.num_samples, self.num_decoded / elapsed, self.num_samples / elapsed))
+
+
+MANIFEST_NAME = 'manifest.json'
+# values of manifest keys added after the first prepared datasets
+MANIFEST_DEFAULTS = {'codec': 'png'}
+
+
+def drive_signature(image_path):
+    '''
+    Number of input files and their latest modification time in a drive folder.
+    A drive has to be prepared again when its signature changes.
+    '''
+    num_inputs, mtime = 0, 0.0
+    for entry in os.scandir(image_path):
+        if entry.is_file():
+            num_inputs += 1
+            mtime = max(mtime, entry.stat().st_mtime)
+    return {'num_inputs': num_inputs, 'mtime': mtime}
+
+
+def file_fingerprint(fname, block_size=1<<20):
+    '''
+    Hash of the size, modification time and first / last block_size bytes of a file.
+    Cheap on large files, it only tells whether a derived index has to be rebuilt.
+    '''
+    stat = os.stat(fname)
+    h = hashlib.sha1('{}:{}'.format(stat.st_size, stat.st_mtime).encode())
+    with open(fname, 'rb') as f:
+        h.update(f.read(block_size))
+        if stat.st_size > block_size:
+            f.seek(max(stat.st_size - block_size, block_size))
+            h.update(f.read(block_size))
+    return h.hexdigest()
+
+
+def write_json_atomic(fname, data):
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_fname, fname)
+
+
+def read_manifest(dump_path):
+    fname = os.path.join(dump_path, MANIFEST_NAME)
+    if not os.path.isfile(fname):
+        return None
+    try:
+        with open(fname, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        return None
+
+
+def write_manifest(dump_path, signature, num_outputs, **kwargs):
+    # Written last, once all samples and the drive train.txt are on disk.
+    manifest = dict(signature)
+    manifest['num_outputs'] = num_outputs
+    manifest.update(kwargs)
+    write_json_atomic(os.path.join(dump_path, MANIFEST_NAME), manifest)
+
+
+def drive_is_complete(dump_path, signature, **kwargs):
+    manifest = read_manifest(dump_path)
+    if manifest is None or not os.path.isfile(os.path.join(dump_path, 'train.txt')):
+        return False
+    expected = dict(signature)
+    expected.update(kwargs)
+    for k, v in expected.items():
+        if manifest.get(k, MANIFEST_DEFAULTS.get(k)) != v:
+            return False
+    return True
+
+
+def write_drive_index(dump_path, lines, signature, **kwargs):
+    '''
+    Write the train.txt of a finished drive, lines being (sample_idx, line) in sample order,
+    and then its manifest.
+    '''
+    with open(os.path.join(dump_path, 'train.txt'), 'w') as f:
+        for idx, l in lines:
+            f.write(l)
+    write_manifest(dump_path, signature, len(lines), **kwargs)
+
+
+def clear_drive_samples(dump_path):
+    '''
+    Remove the manifest and the sample files of a drive before it is prepared again, so that
+    samples of a previous codec or settings do not stay next to the new ones.
+    Other files of the drive (calibration...) are kept.
+    '''
+    sample_exts = set(SAMPLE_CODECS.values())
+    num_removed = 0
+    for entry in os.scandir(dump_path):
+        if not entry.is_file():
+            continue
+        if entry.name == MANIFEST_NAME or os.path.splitext(entry.name)[1] in sample_exts:
+            os.remove(entry.path)
+            num_removed += 1
+    return num_removed
+
+
+def write_index_atomic(output_dir, folders, index_name='train.txt'):
+    '''
+    Concatenate the train.txt of the given drives into output_dir/index_name.
+    The index is written to a temporary file first, so a crash never leaves a truncated one.
+    '''
+    fname = os.path.join(output_dir, index_name)
+    tmp_fname = fname + '.tmp'
+    num_lines = 0
+    with open(tmp_fname, 'w') as f:
+        for folder in folders:
+            with open(os.path.join(output_dir, folder, 'train.txt'), 'r') as train_file:
+                for l in train_file:
+                    f.write(l)
+                    num_lines += 1
+    os.replace(tmp_fname, fname)
+    return num_lines
+
+
+def copy_if_newer(src, dst):
+    if not os.path.isfile(src):
+        return
+    if os.path.isfile(dst) and os.path.getmtime(dst) >= os.path.getmtime(src):
+        return
+    shutil.copyfile(src, dst)
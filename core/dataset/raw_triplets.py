@@ -0,0 +1,121 @@
+import os, sys
+import numpy as np
+import cv2
+
+import torch
+import torch.utils.data
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from kitti_prepared import KITTI_Prepared
+from kitti_raw import KITTI_RAW
+
+
+def list_drives(data_dir, source):
+    '''
+    Returns the (folder, image_path, calib_file) of the training drives of a raw dataset.
+    - kitti_depth	data_dir/date/drive/image_02/data, data_dir/date/calib_cam_to_cam.txt
+    - kitti_odo	data_dir/seq/image_2, data_dir/seq/calib.txt
+    - sintel_raw	data_dir/scene, no calibration
+    '''
+    drives = []
+    if source == 'kitti_depth':
+        for d in sorted(os.listdir(data_dir)):
+            if not os.path.isdir(os.path.join(data_dir, d)):
+                continue
+            for s in sorted(os.listdir(os.path.join(data_dir, d))):
+                if os.path.isdir(os.path.join(data_dir, d, s)):
+                    folder = os.path.join(d, s)
+                    drives.append((folder, os.path.join(data_dir, folder, 'image_02/data'), os.path.join(data_dir, d, 'calib_cam_to_cam.txt')))
+    elif source == 'kitti_odo':
+        for folder in ['00','01','02','03','04','05','06','07','08']:
+            if os.path.isdir(os.path.join(data_dir, folder)):
+                drives.append((folder, os.path.join(data_dir, folder, 'image_2'), os.path.join(data_dir, folder, 'calib.txt')))
+    elif source == 'sintel_raw':
+        for folder in sorted(os.listdir(data_dir)):
+            if os.path.isdir(os.path.join(data_dir, folder)):
+                drives.append((folder, os.path.join(data_dir, folder), None))
+    else:
+        raise NotImplementedError
+    return drives
+
+
+class RawTriplets(KITTI_Prepared):
+    '''
+    Serves (t - s, t, t + s) triplets read directly from the raw drive folders, instead of the
+    concatenated frames materialized by prepare_data_mp. The index tables are built on the fly
+    for any set of strides, so changing or mixing strides does not need a new preparation.
+    Static frames and test scenes are filtered like KITTI_RAW.prepare_data_mp does.
+    A sample is the same (3 * H, W) stack as a prepared KITTI sample.
+    '''
+    def __init__(self, data_dir, source='kitti_depth', strides=(1,), static_frames_txt=None, test_scenes_txt=None,
+                 num_scales=3, img_hw=(256, 832), num_iterations=None, batch_augment=False, sample_cache=None):
+        torch.utils.data.Dataset.__init__(self)
+        self.data_dir = data_dir
+        self.source = source
+        self.strides = [int(s) for s in strides]
+        self.num_scales = num_scales
+        self.img_hw = img_hw
+        self.num_iterations = num_iterations
+        # resize, flip and normalization are left to BatchAugment on the device
+        self.batch_augment = batch_augment
+        self.sample_cache = sample_cache
+
+        static_frames, test_scenes = {}, set()
+        if source == 'kitti_depth':
+            kitti_raw = KITTI_RAW(data_dir, static_frames_txt, test_scenes_txt)
+            if static_frames_txt is not None:
+                static_frames = kitti_raw.collect_static_frame()
+            if test_scenes_txt is not None:
+                test_scenes = kitti_raw.collect_test_scenes()
+        self.build_index(static_frames, test_scenes)
+
+    def build_index(self, static_frames, test_scenes):
+        '''
+        Per drive the sorted frame names are kept once; a sample is three integers
+        (drive, t, s) in self.drive_ids / self.frame_ids / self.sample_strides.
+        '''
+        self.drive_paths, self.drive_calibs, self.frame_names = [], [], []
+        drive_ids, frame_ids, sample_strides = [], [], []
+        for folder, image_path, calib_file in list_drives(self.data_dir, self.source):
+            if self.source == 'kitti_depth' and folder.split('/')[1][:-5] in test_scenes:
+                continue
+            # Note. the os.listdir method returns arbitary order of list. We need correct order.
+            names = sorted(os.listdir(image_path))
+            is_static = np.array([os.path.splitext(n)[0] in static_frames.get(folder, set()) for n in names], dtype=bool)
+            d = len(self.drive_paths)
+            self.drive_paths.append(image_path)
+            self.drive_calibs.append(calib_file)
+            self.frame_names.append(names)
+            for s in self.strides:
+                t = np.arange(s, len(names) - s)
+                if len(t) == 0:
+                    continue
+                keep = ~(is_static[t - s] | is_static[t] | is_static[t + s])
+                t = t[keep]
+                drive_ids.append(np.full(len(t), d, dtype=np.int32))
+                frame_ids.append(t.astype(np.int32))
+                sample_strides.append(np.full(len(t), s, dtype=np.int32))
+        if len(drive_ids) == 0:
+            drive_ids, frame_ids, sample_strides = [np.zeros(0, dtype=np.int32)] * 3
+        self.drive_ids = np.concatenate(drive_ids)
+        self.frame_ids = np.concatenate(frame_ids)
+        self.sample_strides = np.concatenate(sample_strides)
+        print('A total of {0} triplets found in {1} drives, strides {2}'.format(len(self.drive_ids), len(self.drive_paths), self.strides))
+
+    def count(self):
+        return len(self.drive_ids)
+
+    def read_triplet(self, idx):
+        d, t, s = int(self.drive_ids[idx]), int(self.frame_ids[idx]), int(self.sample_strides[idx])
+        names = self.frame_names[d]
+        imgs = [cv2.imread(os.path.join(self.drive_paths[d], names[i])) for i in (t - s, t, t + s)]
+        for i, img in zip((t - s, t, t + s), imgs):
+            if img is None:
+                raise IOError('Failed to read ' + os.path.join(self.drive_paths[d], names[i]))
+        return np.concatenate(imgs, 0)
+
+    def read_image(self, idx):
+        return self.read_triplet(idx)
+
+if __name__ == '__main__':
+    pass
+
@@ -0,0 +1,110 @@
+import os, sys
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+
+class SharedSampleCache(object):
+    '''
+    Cache of decoded uint8 samples in shared memory, common to all DataLoader workers.
+    It has to be created in the main process before the workers are forked.
+    The byte budget is split into fixed slots of sample_shape; a full cache evicts with the CLOCK
+    policy (a slot hit since the hand last passed gets a second chance). Samples of another shape
+    are not cached.
+    The lock only guards the slot tables, the samples are copied in and out of the slots outside of it.
+    '''
+    def __init__(self, capacity_bytes, sample_shape, num_keys):
+        self.sample_shape = tuple(sample_shape)
+        slot_bytes = int(np.prod(self.sample_shape))
+        self.num_slots = int(min(capacity_bytes // slot_bytes, num_keys))
+        self.data = torch.zeros((max(self.num_slots, 1),) + self.sample_shape, dtype=torch.uint8).share_memory_()
+        self.slot_keys = torch.full((max(self.num_slots, 1),), -1, dtype=torch.int64).share_memory_()
+        self.key_slots = torch.full((num_keys,), -1, dtype=torch.int64).share_memory_()
+        self.ref_bits = torch.zeros(max(self.num_slots, 1), dtype=torch.uint8).share_memory_()
+        # readers (or the writer) copying a slot outside the lock, pinned slots are not evicted
+        self.pins = torch.zeros(max(self.num_slots, 1), dtype=torch.int32).share_memory_()
+        # hand, number of used slots, hits, misses
+        self.counters = torch.zeros(4, dtype=torch.int64).share_memory_()
+        self.lock = mp.Lock()
+        self.last_hits, self.last_misses = 0, 0
+        print('Sample cache: {0} slots of {1}, {2:.2f} GB'.format(self.num_slots, self.sample_shape, self.num_slots * slot_bytes / 2.0**30))
+
+    def get(self, key):
+        # Returns a copy of the cached sample, or None. The slot is pinned while it is copied
+        # outside the lock, so it is not evicted meanwhile.
+        with self.lock:
+            slot = int(self.key_slots[key])
+            if slot < 0:
+                self.counters[3] += 1
+                return None
+            self.counters[2] += 1
+            self.ref_bits[slot] = 1
+            self.pins[slot] += 1
+        img = self.data[slot].numpy().copy()
+        with self.lock:
+            self.pins[slot] -= 1
+        return img
+
+    def next_slot(self):
+        # CLOCK: advance the hand, clearing the reference bits, up to a slot not used recently and
+        # not pinned. Returns -1 when every slot is pinned.
+        if int(self.counters[1]) < self.num_slots:
+            slot = int(self.counters[1])
+            self.counters[1] += 1
+            return slot
+        hand = int(self.counters[0])
+        for _ in range(2 * self.num_slots + 1):
+            if self.pins[hand] == 0 and not self.ref_bits[hand]:
+                break
+            self.ref_bits[hand] = 0
+            hand = (hand + 1) % self.num_slots
+        else:
+            return -1
+        self.counters[0] = (hand + 1) % self.num_slots
+        old_key = int(self.slot_keys[hand])
+        if old_key >= 0 and int(self.key_slots[old_key]) == hand:
+            self.key_slots[old_key] = -1
+        self.slot_keys[hand] = -1
+        return hand
+
+    def put(self, key, img):
+        # The slot is reserved and pinned under the lock, filled outside of it and mapped to key
+        # when it is complete.
+        if self.num_slots == 0 or tuple(img.shape) != self.sample_shape:
+            return
+        with self.lock:
+            if int(self.key_slots[key]) >= 0:
+                return
+            slot = self.next_slot()
+            if slot < 0:
+                return
+            self.pins[slot] = 1
+        self.data[slot].copy_(torch.from_numpy(np.ascontiguousarray(img)))
+        with self.lock:
+            self.pins[slot] = 0
+            if int(self.key_slots[key]) >= 0:
+                # another worker cached the same sample meanwhile, the slot stays free
+                return
+            self.slot_keys[slot] = key
+            self.key_slots[key] = slot
+            self.ref_bits[slot] = 1
+
+    def stats(self, reset=True):
+        '''
+        Hit rate since the last reset and the fraction of the slots in use.
+        '''
+        hits, misses = int(self.counters[2]), int(self.counters[3])
+        interval_hits, interval_misses = hits - self.last_hits, misses - self.last_misses
+        stats = {'cache_hit': interval_hits / float(max(interval_hits + interval_misses, 1)),
+                 'cache_fill': int(self.counters[1]) / float(max(self.num_slots, 1))}
+        if reset:
+            self.last_hits, self.last_misses = hits, misses
+        return stats
+
+
+def get_sample_cache(cfg, dataset):
+    # cfg.sample_cache_gb is the byte budget, 0 or empty disables the cache.
+    cache_gb = getattr(cfg, 'sample_cache_gb', None)
+    if not cache_gb or not hasattr(dataset, 'cache_shape'):
+        return None
+    return SharedSampleCache(int(cache_gb * 2**30), dataset.cache_shape(), dataset.count())
@@ -0,0 +1,83 @@
+import os, sys
+import numpy as np
+
+
+class SampleIndex(object):
+    '''
+    The samples of a train.txt, stored in a few numpy arrays instead of one dict per sample:
+    - paths	uint8 buffer of the concatenated sample paths, with offsets (num_samples + 1,)
+    - calibs	deduplicated table of the calibration files, with calib_ids (num_samples,), -1 for none
+    Forked dataloader workers only read these arrays, there are no per-sample python objects whose
+    refcounts would copy the pages on write.
+    The arrays are cached next to train.txt and rebuilt when train.txt changes.
+    '''
+    def __init__(self, data_dir, paths, offsets, calibs, calib_ids):
+        self.data_dir = data_dir
+        self.paths = paths
+        self.offsets = offsets
+        self.calibs = calibs
+        self.calib_ids = calib_ids
+
+    @staticmethod
+    def parse(info_file):
+        with open(info_file, 'rb') as f:
+            lines = f.read().splitlines()
+        paths, lengths, calib_ids = [], [], []
+        calib_table = {}
+        for line in lines:
+            k = line.split()
+            if len(k) == 0:
+                continue
+            paths.append(k[0])
+            lengths.append(len(k[0]))
+            if len(k) > 1:
+                if k[1] not in calib_table:
+                    calib_table[k[1]] = len(calib_table)
+                calib_ids.append(calib_table[k[1]])
+            else:
+                calib_ids.append(-1)
+        offsets = np.zeros(len(paths) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths)
+        paths = np.frombuffer(b''.join(paths), dtype=np.uint8).copy()
+        calibs = sorted(calib_table.keys(), key=lambda c: calib_table[c])
+        calibs = np.array(calibs, dtype='S') if len(calibs) > 0 else np.zeros(0, dtype='S1')
+        return paths, offsets, calibs, np.array(calib_ids, dtype=np.int32)
+
+    @classmethod
+    def load(cls, data_dir, info_name='train.txt', use_cache=True):
+        info_file = os.path.join(data_dir, info_name)
+        cache_file = info_file + '.index.npz'
+        stat = os.stat(info_file)
+        key = np.array([stat.st_size, stat.st_mtime], dtype=np.float64)
+        if use_cache and os.path.isfile(cache_file):
+            try:
+                cached = np.load(cache_file)
+                if np.array_equal(cached['key'], key):
+                    return cls(data_dir, cached['paths'], cached['offsets'], cached['calibs'], cached['calib_ids'])
+            except (IOError, OSError, ValueError, KeyError):
+                pass
+        paths, offsets, calibs, calib_ids = cls.parse(info_file)
+        if use_cache:
+            try:
+                # np.savez appends .npz to names without it
+                tmp_file = cache_file[:-len('.npz')] + '.tmp.npz'
+                np.savez(tmp_file, key=key, paths=paths, offsets=offsets, calibs=calibs, calib_ids=calib_ids)
+                os.replace(tmp_file, cache_file)
+            except (IOError, OSError):
+                print('The sample index can not be cached in ' + cache_file)
+        return cls(data_dir, paths, offsets, calibs, calib_ids)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def path(self, idx):
+        return self.paths[self.offsets[idx]:self.offsets[idx+1]].tobytes().decode()
+
+    def image_file(self, idx):
+        return os.path.join(self.data_dir, self.path(idx))
+
+    def cam_intrinsic_file(self, idx):
+        calib_id = self.calib_ids[idx]
+        if calib_id < 0:
+            return None
+        return os.path.join(self.data_dir, self.calibs[calib_id].decode())
@@ -6,28 +6,29 @@ import copy
 import torch
 import torch.utils.data
 import pdb
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from prepare_utils import read_sample
+from sample_index import SampleIndex
 
 class SINTEL_Prepared(torch.utils.data.Dataset):
-    def __init__(self, data_dir, num_scales=3, img_hw=(256, 832), num_iterations=None):
+    def __init__(self, data_dir, num_scales=3, img_hw=(256, 832), num_iterations=None, batch_augment=False, sample_cache=None):
         super(SINTEL_Prepared, self).__init__()
         self.data_dir = data_dir
         self.num_scales = num_scales
         self.img_hw = img_hw
         self.num_iterations = num_iterations
+        # resize, flip and normalization are left to BatchAugment on the device
+        self.batch_augment = batch_augment
+        # SharedSampleCache of the decoded (and resized) uint8 samples, shared by the workers
+        self.sample_cache = sample_cache
 
         info_file = os.path.join(self.data_dir, 'train.txt')
         #info_file = os.path.join(self.data_dir, 'train_flow.txt')
         self.data_list = self.get_data_list(info_file)
 
     def get_data_list(self, info_file):
-        with open(info_file, 'r') as f:
-            lines = f.readlines()
-        data_list = []
-        for line in lines:
-            k = line.strip('\n').split()
-            data = {}
-            data['image_file'] = os.path.join(self.data_dir, k[0])
-            data_list.append(data)
+        # array-backed, see SampleIndex
+        data_list = SampleIndex.load(self.data_dir, os.path.basename(info_file))
         print('A total of {} image pairs found'.format(len(data_list)))
         return data_list
 
@@ -97,22 +98,45 @@ class SINTEL_Prepared(torch.utils.data.Dataset):
         img = img / 255.0
         return img
 
+    def read_image(self, idx):
+        return read_sample(self.data_list.image_file(idx))
+
+    def cache_shape(self):
+        # Shape of the samples kept in a SharedSampleCache.
+        if self.batch_augment:
+            return self.read_image(0).shape
+        return (3 * self.img_hw[0], self.img_hw[1], 3)
+
+    def load_sample(self, idx):
+        '''
+        Returns uint8 (N * H, W, 3), at raw resolution with batch_augment and resized to img_hw
+        otherwise, from the sample cache when it holds the sample.
+        '''
+        if self.sample_cache is not None:
+            img = self.sample_cache.get(idx)
+            if img is not None:
+                return img
+        img = self.read_image(idx)
+        if not self.batch_augment:
+            img = self.resize_img(img, self.img_hw)
+        if self.sample_cache is not None:
+            self.sample_cache.put(idx, img)
+        return img
+
     def __getitem__(self, idx):
         '''
         Returns:
         - img		torch.Tensor (N * H, W, 3)
-        - K	torch.Tensor (num_scales, 3, 3)
-        - K_inv	torch.Tensor (num_scales, 3, 3)
         '''
         if self.num_iterations is not None:
             idx = self.rand_num(idx)
-        data = self.data_list[idx]
-        # load img
-        img = cv2.imread(data['image_file'])
-        #img_hw_orig = (int(img.shape[0] / 3), img.shape[1])
-        img = self.preprocess_img(img, self.img_hw) # (img_h * 3, img_w, 3)
+        img = self.load_sample(idx)
+        if self.batch_augment:
+            # raw resolution uint8 (3, N * H, W)
+            return torch.from_numpy(np.ascontiguousarray(img.transpose(2,0,1)))
+        img = self.random_flip_img(img)
+        img = img / 255.0
         img = img.transpose(2,0,1)
-
         return torch.from_numpy(img).float()
 
 if __name__ == '__main__':
@@ -1,5 +1,8 @@
 import os, sys
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-from evaluate_flow import eval_flow_avg, load_gt_flow_kitti
+from evaluate_flow import eval_flow_avg, load_gt_flow_kitti, FlowEvaluator, format_flow_result
 from evaluate_mask import load_gt_mask
 from evaluate_depth import eval_depth
+from gt_cache import AsyncCall, load_kitti_gt
+from async_evaluator import AsyncEvaluator
+from flow_color import flow_to_image_torch
@@ -0,0 +1,150 @@
+import os, sys
+import time
+import atexit
+import traceback
+import queue
+import torch
+import torch.multiprocessing as mp
+
+
+class EvalConfig(object):
+    # Attribute view of the training config in the evaluation process.
+    def __init__(self, cfg_dict):
+        for k, v in cfg_dict.items():
+            setattr(self, k, v)
+
+
+def visible_device(device):
+    '''
+    CUDA_VISIBLE_DEVICES of the evaluation process for device ('cpu', a gpu id or 'cuda:<id>'), or
+    None for the cpu. The id is relative to the gpus visible to the training, as torch.device ids.
+    '''
+    device = str(device).strip()
+    if device == 'cpu':
+        return None
+    if device.startswith('cuda:'):
+        device = device[len('cuda:'):]
+    if not device.isdigit():
+        raise ValueError('Evaluation device {} is not cpu, a gpu id or cuda:<id>.'.format(device))
+    visible = os.environ.get('CUDA_VISIBLE_DEVICES')
+    if visible is None:
+        return device
+    visible = [d.strip() for d in visible.split(',') if d.strip()]
+    if int(device) >= len(visible):
+        raise ValueError('Evaluation device {} is not one of the visible gpus {}.'.format(device, ','.join(visible)))
+    return visible[int(device)]
+
+
+def eval_worker(cfg_dict, build_model_fn, load_data_fn, eval_fn, device, snapshot_queue, result_queue):
+    '''
+    Evaluation process: builds the model and loads the test data once, then evaluates every weight
+    snapshot it receives until the None sentinel.
+    '''
+    if device is not None:
+        # only the evaluation gpu is visible, the .cuda() calls of the evaluation go to it
+        os.environ['CUDA_VISIBLE_DEVICES'] = device
+    torch.set_grad_enabled(False)
+    cfg = EvalConfig(cfg_dict)
+    model = build_model_fn(cfg)
+    model = model.cuda() if device is not None else model.cpu()
+    model.eval()
+    data = load_data_fn(cfg)
+    while True:
+        item = snapshot_queue.get()
+        if item is None:
+            break
+        iter_, state_dict = item
+        try:
+            model.load_state_dict(state_dict)
+            del state_dict
+            res = eval_fn(cfg, model, data)
+            result_queue.put((iter_, res, None))
+        except Exception:
+            result_queue.put((iter_, None, traceback.format_exc()))
+
+
+class AsyncEvaluator(object):
+    '''
+    Evaluates weight snapshots in a separate (spawned) process, on the cpu or on another gpu, while
+    training goes on.
+    - build_model_fn(cfg)	returns the model to load the snapshots into
+    - load_data_fn(cfg)	returns the test data, loaded once in the evaluation process
+    - eval_fn(cfg, model, data)	returns the results of a snapshot
+    The functions are sent to the new process, they have to be module level functions.
+    At most max_pending snapshots wait for evaluation; when the evaluation is slower than the
+    training a waiting snapshot is replaced by the newer one.
+    The process is not a daemon, the evaluation can start DataLoader workers; it is terminated at
+    exit when close() was not called.
+    '''
+    def __init__(self, cfg, build_model_fn, load_data_fn, eval_fn, device='cpu', max_pending=1):
+        ctx = mp.get_context('spawn')
+        self.snapshot_queue = ctx.Queue(maxsize=max(max_pending, 1))
+        self.result_queue = ctx.Queue()
+        cfg_dict = dict(vars(cfg))
+        self.process = ctx.Process(target=eval_worker, args=(cfg_dict, build_model_fn, load_data_fn, eval_fn, visible_device(device),
+                                                             self.snapshot_queue, self.result_queue))
+        self.process.daemon = False
+        self.process.start()
+        atexit.register(self.terminate)
+        self.num_submitted, self.num_dropped = 0, 0
+
+    def snapshot(self, model):
+        return dict([(k, v.detach().cpu().clone()) for k, v in model.state_dict().items()])
+
+    def put(self, item):
+        try:
+            self.snapshot_queue.put_nowait(item)
+            return
+        except queue.Full:
+            pass
+        try:
+            stale = self.snapshot_queue.get(timeout=1.0)
+            if stale is not None:
+                self.num_dropped += 1
+                print('[EVAL] snapshot of iteration {} dropped, the evaluation is behind.'.format(stale[0]))
+        except queue.Empty:
+            pass
+        self.snapshot_queue.put(item)
+
+    def submit(self, iter_, model):
+        # Queues a copy of the weights of model (without DataParallel) for evaluation.
+        if not self.process.is_alive():
+            print('[EVAL] the evaluation process is not running, iteration {} is not evaluated.'.format(iter_))
+            return
+        self.put((iter_, self.snapshot(model)))
+        self.num_submitted += 1
+
+    def poll(self, block=False):
+        '''
+        Results available so far, [(iter_, result)]. Failed evaluations are printed and left out.
+        '''
+        results = []
+        while True:
+            try:
+                iter_, res, error = self.result_queue.get(block=block and len(results) == 0, timeout=1.0 if block else None)
+            except queue.Empty:
+                break
+            if error is not None:
+                print('[EVAL] evaluation of iteration {} failed:\n{}'.format(iter_, error))
+                continue
+            results.append((iter_, res))
+        return results
+
+    def close(self, timeout=None):
+        # Evaluates the pending snapshots, then stops the process. Returns their results.
+        if self.process.is_alive():
+            self.snapshot_queue.put(None)
+        start = time.time()
+        results = []
+        while self.process.is_alive() and (timeout is None or time.time() - start < timeout):
+            results += self.poll(block=True)
+        self.process.join(timeout=1.0)
+        results += self.poll()
+        self.terminate()
+        return results
+
+    def terminate(self):
+        # Stops the process without evaluating the pending snapshots.
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(timeout=5.0)
@@ -3,6 +3,7 @@ from matplotlib import pyplot as plt
 import numpy as np
 import os
 from glob import glob
+from multiprocessing import Pool
 import pdb
 
 
@@ -45,9 +46,7 @@ def umeyama_alignment(x, y, with_scale=False):
     sigma_x = 1.0 / n * (np.linalg.norm(x - mean_x[:, np.newaxis])**2)
 
     # covariance matrix, eq. 38
-    outer_sum = np.zeros((m, m))
-    for i in range(n):
-        outer_sum += np.outer((y[:, i] - mean_y), (x[:, i] - mean_x))
+    outer_sum = (y - mean_y[:, np.newaxis]).dot((x - mean_x[:, np.newaxis]).T)
     cov_xy = np.multiply(1.0 / n, outer_sum)
 
     # SVD (text betw. eq. 38 and 39)
@@ -83,116 +82,96 @@ class KittiEvalOdom():
 		# Each line in the file should follow one of the following structures
 		# (1) idx pose(3x4 matrix in terms of 12 numbers)
 		# (2) pose(3x4 matrix in terms of 12 numbers)
+		# Returns the frame indices (N,) and the poses (N,4,4), sorted by frame index
 		# ----------------------------------------------------------------------
-        f = open(file_name, 'r')
-        s = f.readlines()
-        f.close()
-        file_len = len(s)
-        poses = {}
-        for cnt, line in enumerate(s):
-            P = np.eye(4)
-            line_split = [float(i) for i in line.split(" ")]
-            withIdx = int(len(line_split) == 13)
-            for row in range(3):
-                for col in range(4):
-                    P[row, col] = line_split[row*4 + col + withIdx]
-            if withIdx:
-                frame_idx = line_split[0]
-            else:
-                frame_idx = cnt
-            poses[frame_idx] = P
-        return poses
+        data = np.loadtxt(file_name, dtype=np.float64, ndmin=2)
+        withIdx = int(data.shape[1] == 13)
+        if withIdx:
+            frame_ids = data[:, 0].astype(np.int64)
+        else:
+            frame_ids = np.arange(data.shape[0], dtype=np.int64)
+        poses = np.tile(np.eye(4), (data.shape[0], 1, 1))
+        poses[:, :3, :] = data[:, withIdx:].reshape(-1, 3, 4)
+        order = np.argsort(frame_ids, kind='mergesort')
+        return frame_ids[order], poses[order]
 
     def trajectory_distances(self, poses):
         # ----------------------------------------------------------------------
-		# poses: dictionary: [frame_idx: pose]
+		# poses: N,4,4 in frame order
 		# ----------------------------------------------------------------------
-        dist = [0]
-        sort_frame_idx = sorted(poses.keys())
-        for i in range(len(sort_frame_idx)-1):
-            cur_frame_idx = sort_frame_idx[i]   
-            next_frame_idx = sort_frame_idx[i+1]
-            P1 = poses[cur_frame_idx]
-            P2 = poses[next_frame_idx]
-            dx = P1[0, 3] - P2[0, 3]
-            dy = P1[1, 3] - P2[1, 3]
-            dz = P1[2, 3] - P2[2, 3]
-            dist.append(dist[i]+np.sqrt(dx**2+dy**2+dz**2))
-        return dist
+        steps = np.sqrt(np.sum(np.square(poses[:-1, :3, 3] - poses[1:, :3, 3]), axis=1))
+        return np.concatenate([[0.0], np.cumsum(steps)])
 
     def rotation_error(self, pose_error):
-        a = pose_error[0, 0]
-        b = pose_error[1, 1]
-        c = pose_error[2, 2]
+        # pose_error: (...,4,4)
+        a = pose_error[..., 0, 0]
+        b = pose_error[..., 1, 1]
+        c = pose_error[..., 2, 2]
         d = 0.5*(a+b+c-1.0)
-        rot_error = np.arccos(max(min(d, 1.0), -1.0))
+        rot_error = np.arccos(np.clip(d, -1.0, 1.0))
         return rot_error
 
     def translation_error(self, pose_error):
-        dx = pose_error[0, 3]
-        dy = pose_error[1, 3]
-        dz = pose_error[2, 3]
-        return np.sqrt(dx**2+dy**2+dz**2)
-
-    def last_frame_from_segment_length(self, dist, first_frame, len_):
-        for i in range(first_frame, len(dist), 1):
-            if dist[i] > (dist[first_frame] + len_):
-                return i
-        return -1
-
-    def calc_sequence_errors(self, poses_gt, poses_result):
-        err = []
+        return np.sqrt(np.sum(np.square(pose_error[..., :3, 3]), axis=-1))
+
+    def last_frame_from_segment_length(self, dist, first_frames, len_):
+        # first frame i after each first frame with dist[i] > dist[first_frame] + len_, -1 if none
+        last_frames = np.searchsorted(dist, dist[first_frames] + len_, side='right')
+        last_frames[last_frames >= len(dist)] = -1
+        return last_frames
+
+    def calc_sequence_errors(self, poses_gt, poses_result, result_ids):
+        # ----------------------------------------------------------------------
+		# poses_gt: N,4,4, frame i at index i
+		# poses_result: M,4,4 of the frames result_ids
+		# Returns err: K,5 [first_frame, r_err/len, t_err/len, len, speed]
+		# ----------------------------------------------------------------------
         dist = self.trajectory_distances(poses_gt)
         self.step_size = 10
+        # index of every gt frame in poses_result, -1 if not predicted
+        result_index = -np.ones(len(poses_gt), dtype=np.int64)
+        in_range = (result_ids >= 0) & (result_ids < len(poses_gt))
+        result_index[result_ids[in_range]] = np.arange(len(result_ids))[in_range]
+
+        first_frames = np.arange(0, len(poses_gt), self.step_size)
+        # (num_first_frames, num_lengths), first frame major as the segments are listed
+        last_frames = np.stack([self.last_frame_from_segment_length(dist, first_frames, len_) for len_ in self.lengths], axis=1)
+        first_frames = np.repeat(first_frames[:, np.newaxis], self.num_lengths, axis=1)
+        lengths = np.tile(np.array(self.lengths, dtype=np.float64), (len(first_frames), 1))
+
+        # ----------------------------------------------------------------------
+		# Skip the segments out of the sequence or without prediction
+		# ----------------------------------------------------------------------
+        valid = (last_frames != -1) & (result_index[first_frames] >= 0) & (result_index[np.maximum(last_frames, 0)] >= 0)
+        first_frames, last_frames, lengths = first_frames[valid], last_frames[valid], lengths[valid]
+        if len(first_frames) == 0:
+            return np.zeros((0, 5))
+
+        # ----------------------------------------------------------------------
+		# compute rotational and translational errors of all the segments at once
+		# ----------------------------------------------------------------------
+        pose_delta_gt = np.matmul(np.linalg.inv(poses_gt[first_frames]), poses_gt[last_frames])
+        pose_delta_result = np.matmul(np.linalg.inv(poses_result[result_index[first_frames]]), poses_result[result_index[last_frames]])
+        pose_error = np.matmul(np.linalg.inv(pose_delta_result), pose_delta_gt)
 
-        for first_frame in range(0, len(poses_gt), self.step_size):
-            for i in range(self.num_lengths):
-                len_ = self.lengths[i]
-                last_frame = self.last_frame_from_segment_length(dist, first_frame, len_)
-
-                # ----------------------------------------------------------------------
-				# Continue if sequence not long enough
-				# ----------------------------------------------------------------------
-                if last_frame == -1 or not(last_frame in poses_result.keys()) or not(first_frame in poses_result.keys()):
-                    continue
-
-                # ----------------------------------------------------------------------
-				# compute rotational and translational errors
-				# ----------------------------------------------------------------------
-                pose_delta_gt = np.dot(np.linalg.inv(poses_gt[first_frame]), poses_gt[last_frame])
-                pose_delta_result = np.dot(np.linalg.inv(poses_result[first_frame]), poses_result[last_frame])
-                pose_error = np.dot(np.linalg.inv(pose_delta_result), pose_delta_gt)
-
-                r_err = self.rotation_error(pose_error)
-                t_err = self.translation_error(pose_error)
-
-                # ----------------------------------------------------------------------
-				# compute speed 
-				# ----------------------------------------------------------------------
-                num_frames = last_frame - first_frame + 1.0
-                speed = len_/(0.1*num_frames)
-
-                err.append([first_frame, r_err/len_, t_err/len_, len_, speed])
-        return err
+        r_err = self.rotation_error(pose_error)
+        t_err = self.translation_error(pose_error)
+
+        # ----------------------------------------------------------------------
+		# compute speed 
+		# ----------------------------------------------------------------------
+        num_frames = last_frames - first_frames + 1.0
+        speed = lengths/(0.1*num_frames)
+
+        return np.stack([first_frames, r_err/lengths, t_err/lengths, lengths, speed], axis=1)
         
     def save_sequence_errors(self, err, file_name):
-        fp = open(file_name, 'w')
-        for i in err:
-            line_to_write = " ".join([str(j) for j in i])
-            fp.writelines(line_to_write+"\n")
-        fp.close()
+        np.savetxt(file_name, np.asarray(err), fmt='%d %.18g %.18g %d %.18g')
 
     def compute_overall_err(self, seq_err):
-        t_err = 0
-        r_err = 0
-
-        seq_len = len(seq_err)
-
-        for item in seq_err:
-            r_err += item[1]
-            t_err += item[2]
-        ave_t_err = t_err / seq_len
-        ave_r_err = r_err / seq_len
+        seq_err = np.asarray(seq_err)
+        ave_t_err = np.mean(seq_err[:, 2])
+        ave_r_err = np.mean(seq_err[:, 1])
         return ave_t_err, ave_r_err
 
     def plotPath(self, seq, poses_gt, poses_result):
@@ -209,12 +188,8 @@ class KittiEvalOdom():
         ax.set_aspect('equal')
 
         for key in plot_keys:
-            pos_xz = []
-            # for pose in poses_dict[key]:
-            for frame_idx in sorted(poses_dict[key].keys()):
-                pose = poses_dict[key][frame_idx]
-                pos_xz.append([pose[0,3],  pose[2,3]])
-            pos_xz = np.asarray(pos_xz)
+            # poses in frame order
+            pos_xz = poses_dict[key][:, [0, 2], 3]
             plt.plot(pos_xz[:,0],  pos_xz[:,1], label = key)
 
         plt.legend(loc="upper right", prop={'size': fontsize_})
@@ -225,6 +200,7 @@ class KittiEvalOdom():
         fig.set_size_inches(10, 10)
         png_title = "sequence_"+(seq)
         plt.savefig(self.plot_path_dir + "/" + png_title + ".pdf", bbox_inches='tight', pad_inches=0)
+        plt.close(fig)
         # plt.show()
 
     def compute_segment_error(self, seq_errs):
@@ -232,25 +208,16 @@ class KittiEvalOdom():
 		# This function calculates average errors for different segment.
 		# ----------------------------------------------------------------------
 
-        segment_errs = {}
+        seq_errs = np.asarray(seq_errs)
         avg_segment_errs = {}
         for len_ in self.lengths:
-            segment_errs[len_] = []
-        # ----------------------------------------------------------------------
-		# Get errors
-		# ----------------------------------------------------------------------
-        for err in seq_errs:
-            len_ = err[3]
-            t_err = err[2]
-            r_err = err[1]
-            segment_errs[len_].append([t_err, r_err])
-        # ----------------------------------------------------------------------
-		# Compute average
-		# ----------------------------------------------------------------------
-        for len_ in self.lengths:
-            if segment_errs[len_] != []:
-                avg_t_err = np.mean(np.asarray(segment_errs[len_])[:, 0])
-                avg_r_err = np.mean(np.asarray(segment_errs[len_])[:, 1])
+            # ----------------------------------------------------------------------
+            # Average of the errors of the segments of this length
+            # ----------------------------------------------------------------------
+            segment_errs = seq_errs[seq_errs[:, 3] == len_] if len(seq_errs) > 0 else seq_errs
+            if len(segment_errs) > 0:
+                avg_t_err = np.mean(segment_errs[:, 2])
+                avg_r_err = np.mean(segment_errs[:, 1])
                 avg_segment_errs[len_] = [avg_t_err, avg_r_err]
             else:
                 avg_segment_errs[len_] = []
@@ -259,57 +226,42 @@ class KittiEvalOdom():
     def scale_optimization(self, gt, pred):
         """ Optimize scaling factor
         Args:
-            gt (4x4 array dict): ground-truth poses
-            pred (4x4 array dict): predicted poses
+            gt (Nx4x4 array): ground-truth poses
+            pred (Nx4x4 array): predicted poses of the same frames
         Returns:
-            new_pred (4x4 array dict): predicted poses after optimization
+            new_pred (Nx4x4 array): predicted poses after optimization
         """
-        pred_updated = copy.deepcopy(pred)
-        xyz_pred = []
-        xyz_ref = []
-        for i in pred:
-            pose_pred = pred[i]
-            pose_ref = gt[i]
-            xyz_pred.append(pose_pred[:3, 3])
-            xyz_ref.append(pose_ref[:3, 3])
-        xyz_pred = np.asarray(xyz_pred)
-        xyz_ref = np.asarray(xyz_ref)
+        pred_updated = pred.copy()
+        xyz_pred = pred[:, :3, 3]
+        xyz_ref = gt[:, :3, 3]
         scale = scale_lse_solver(xyz_pred, xyz_ref)
-        for i in pred_updated:
-            pred_updated[i][:3, 3] *= scale
+        pred_updated[:, :3, 3] *= scale
         return pred_updated
 
-    def eval(self, gt_txt, result_txt, seq=None):
-        # gt_dir: the directory of groundtruth poses txt
-        # results_dir: the directory of predicted poses txt
-        self.plot_path_dir = os.path.dirname(result_txt) + "/plot_path"
-        if not os.path.exists(self.plot_path_dir):
-            os.makedirs(self.plot_path_dir)
-        
-        self.gt_txt = gt_txt
-
-        ave_t_errs = []
-        ave_r_errs = []
-
-        poses_result = self.loadPoses(result_txt)
-        poses_gt = self.loadPoses(self.gt_txt)
+    def eval_sequence(self, gt_txt, result_txt, seq=None, cache_dir=None, keep_poses=False):
+        """ Errors of the predicted poses of a sequence
+        Args:
+            gt_txt, result_txt: groundtruth and predicted poses txt
+            cache_dir: directory of the binary cache of the groundtruth poses, next to gt_txt by default
+            keep_poses: also return the aligned poses, for plotting
+        Returns:
+            dict: seq, t_err (%), r_err (deg/100m), num_segments and
+                  segment_errs {length: [t_err, r_err] or []} (per meter, rad per meter)
+        """
+        result_ids, poses_result = self.loadPoses(result_txt)
+        gt_ids, poses_gt = load_gt_poses(gt_txt, cache_dir)
+        # gt pose of each predicted frame (the gt frames are 0..N-1)
+        gt_index = result_ids
 
         # Pose alignment to first frame
-        idx_0 = sorted(list(poses_result.keys()))[0]
-        pred_0 = poses_result[idx_0]
-        gt_0 = poses_gt[idx_0]
-        for cnt in poses_result:
-            poses_result[cnt] = np.linalg.inv(pred_0) @ poses_result[cnt]
-            poses_gt[cnt] = np.linalg.inv(gt_0) @ poses_gt[cnt]
+        pred_0 = poses_result[0]
+        gt_0 = poses_gt[gt_index[0]]
+        poses_result = np.matmul(np.linalg.inv(pred_0), poses_result)
+        poses_gt[gt_index] = np.matmul(np.linalg.inv(gt_0), poses_gt[gt_index])
 
         # get XYZ
-        xyz_gt = []
-        xyz_result = []
-        for cnt in poses_result:
-            xyz_gt.append([poses_gt[cnt][0, 3], poses_gt[cnt][1, 3], poses_gt[cnt][2, 3]])
-            xyz_result.append([poses_result[cnt][0, 3], poses_result[cnt][1, 3], poses_result[cnt][2, 3]])
-        xyz_gt = np.asarray(xyz_gt).transpose(1, 0)
-        xyz_result = np.asarray(xyz_result).transpose(1, 0)
+        xyz_gt = poses_gt[gt_index, :3, 3].transpose(1, 0)
+        xyz_result = poses_result[:, :3, 3].transpose(1, 0)
 
         r, t, scale = umeyama_alignment(xyz_result, xyz_gt, True)
 
@@ -317,14 +269,13 @@ class KittiEvalOdom():
         align_transformation[:3:, :3] = r
         align_transformation[:3, 3] = t
         
-        for cnt in poses_result:
-            poses_result[cnt][:3, 3] *= scale
-            poses_result[cnt] = align_transformation @ poses_result[cnt]
+        poses_result[:, :3, 3] *= scale
+        poses_result = np.matmul(align_transformation, poses_result)
 
         # ----------------------------------------------------------------------
         # compute sequence errors
         # ----------------------------------------------------------------------
-        seq_err = self.calc_sequence_errors(poses_gt, poses_result)
+        seq_err = self.calc_sequence_errors(poses_gt, poses_result, result_ids)
 
         # ----------------------------------------------------------------------
         # Compute segment errors
@@ -335,29 +286,133 @@ class KittiEvalOdom():
         # compute overall error
         # ----------------------------------------------------------------------
         ave_t_err, ave_r_err = self.compute_overall_err(seq_err)
+
+        res = {'seq': seq, 't_err': float(ave_t_err*100), 'r_err': float(ave_r_err/np.pi*180*100), 'num_segments': len(seq_err),
+               'segment_errs': dict([(len_, [float(e) for e in errs]) for len_, errs in avg_segment_errs.items()])}
+        if keep_poses:
+            res['poses_gt'], res['poses_result'] = poses_gt, poses_result
+        return res
+
+    def eval(self, gt_txt, result_txt, seq=None, cache_dir=None, plot=True):
+        # gt_dir: the directory of groundtruth poses txt
+        # results_dir: the directory of predicted poses txt
+        self.plot_path_dir = os.path.dirname(result_txt) + "/plot_path"
+        if plot and not os.path.exists(self.plot_path_dir):
+            os.makedirs(self.plot_path_dir)
+        
+        self.gt_txt = gt_txt
+
+        res = self.eval_sequence(gt_txt, result_txt, seq=seq, cache_dir=cache_dir, keep_poses=plot)
         print("Sequence: " + seq)
-        print("Translational error (%): ", ave_t_err*100)
-        print("Rotational error (deg/100m): ", ave_r_err/np.pi*180*100)
-        ave_t_errs.append(ave_t_err)
-        ave_r_errs.append(ave_r_err)
+        print("Translational error (%): ", res['t_err'])
+        print("Rotational error (deg/100m): ", res['r_err'])
 
         # Plotting
-        self.plotPath(seq, poses_gt, poses_result)    
+        if plot:
+            self.plotPath(seq, res.pop('poses_gt'), res.pop('poses_result'))
 
         print("-------------------- For Copying ------------------------------")
-        for i in range(len(ave_t_errs)):
-            print("{0:.2f}".format(ave_t_errs[i]*100))
-            print("{0:.2f}".format(ave_r_errs[i]/np.pi*180*100))
+        print("{0:.2f}".format(res['t_err']))
+        print("{0:.2f}".format(res['r_err']))
+        return res
 
+    def eval_sequences(self, sequences, num_workers=None, cache_dir=None, plot_dir=None):
+        """ Evaluation of several sequences, one process per sequence
+        Args:
+            sequences: [(seq, gt_txt, result_txt)]
+            plot_dir: where the trajectory plots are saved, None for no plots. The plots are
+                      drawn by another process while the next sequences are evaluated.
+        Returns:
+            dict: sequences {seq: eval_sequence result}, and t_err / r_err averaged over the sequences
+        """
+        tasks = [(seq, gt_txt, result_txt, cache_dir, plot_dir is not None) for seq, gt_txt, result_txt in sequences]
+        plot_pool, plot_jobs = None, []
+        if plot_dir is not None:
+            if not os.path.exists(plot_dir):
+                os.makedirs(plot_dir)
+            plot_pool = Pool(1)
+        results = {}
+        pool = Pool(min(num_workers or os.cpu_count(), max(len(tasks), 1)))
+        try:
+            for res in pool.imap_unordered(eval_sequence_task, tasks):
+                if plot_pool is not None:
+                    plot_jobs.append(plot_pool.apply_async(plot_sequence, (plot_dir, res['seq'], res.pop('poses_gt'), res.pop('poses_result'))))
+                results[res['seq']] = res
+        finally:
+            pool.close()
+            pool.join()
+        if plot_pool is not None:
+            plot_pool.close()
+            for job in plot_jobs:
+                job.get()
+            plot_pool.join()
+        seqs = [seq for seq, _, _ in sequences]
+        return {'sequences': results,
+                't_err': float(np.mean([results[seq]['t_err'] for seq in seqs])) if len(seqs) > 0 else None,
+                'r_err': float(np.mean([results[seq]['r_err'] for seq in seqs])) if len(seqs) > 0 else None}
+
+
+def load_gt_poses(gt_txt, cache_dir=None):
+    """ Groundtruth poses of gt_txt (frame indices, N,4,4 poses), parsed once and then read from
+    a binary .npz cache, in cache_dir or next to gt_txt. The cache is rebuilt when gt_txt changes.
+    """
+    if cache_dir is None:
+        cache_dir = os.path.dirname(os.path.abspath(gt_txt))
+    cache_file = os.path.join(cache_dir, os.path.basename(gt_txt) + '.poses.npz')
+    stat = os.stat(gt_txt)
+    key = np.array([stat.st_size, stat.st_mtime], dtype=np.float64)
+    if os.path.isfile(cache_file):
+        try:
+            cached = np.load(cache_file)
+            if np.array_equal(cached['key'], key):
+                return cached['frame_ids'], cached['poses']
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+    frame_ids, poses = KittiEvalOdom().loadPoses(gt_txt)
+    try:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        # np.savez appends .npz to names without it
+        tmp_file = cache_file[:-len('.npz')] + '.tmp.npz'
+        np.savez(tmp_file, key=key, frame_ids=frame_ids, poses=poses)
+        os.replace(tmp_file, cache_file)
+    except (IOError, OSError):
+        print('The groundtruth poses can not be cached in ' + cache_file)
+    return frame_ids, poses
+
+
+def eval_sequence_task(task):
+    seq, gt_txt, result_txt, cache_dir, keep_poses = task
+    return KittiEvalOdom().eval_sequence(gt_txt, result_txt, seq=seq, cache_dir=cache_dir, keep_poses=keep_poses)
+
+
+def plot_sequence(plot_dir, seq, poses_gt, poses_result):
+    eval_tool = KittiEvalOdom()
+    eval_tool.plot_path_dir = plot_dir
+    eval_tool.plotPath(seq, poses_gt, poses_result)
 
 
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser(description='KITTI evaluation')
-    parser.add_argument('--gt_txt', type=str, required=True, help="Groundtruth directory")
-    parser.add_argument('--result_txt', type=str, required=True, help="Result directory")
-    parser.add_argument('--seq', type=str, help="sequences to be evaluated", default='09')
+    parser.add_argument('--gt_txt', type=str, required=True, help="Groundtruth poses txt, or their directory (<seq>.txt)")
+    parser.add_argument('--result_txt', type=str, required=True, help="Result poses txt, or their directory (<seq>.txt)")
+    parser.add_argument('--seq', type=str, help="sequences to be evaluated, comma separated", default='09')
+    parser.add_argument('--num_workers', type=int, default=None, help="number of sequences evaluated in parallel")
+    parser.add_argument('--cache_dir', type=str, default=None, help="directory of the groundtruth poses cache")
+    parser.add_argument('--no_plot', action='store_true', help="skip the trajectory plots")
     args = parser.parse_args()
 
     eval_tool = KittiEvalOdom()
-    eval_tool.eval(args.gt_txt, args.result_txt, seq=args.seq)
+    seqs = args.seq.split(',')
+    if len(seqs) == 1 and not os.path.isdir(args.gt_txt):
+        eval_tool.eval(args.gt_txt, args.result_txt, seq=args.seq, cache_dir=args.cache_dir, plot=not args.no_plot)
+    else:
+        seq_file = lambda path, seq: os.path.join(path, seq + '.txt') if os.path.isdir(path) else path
+        sequences = [(seq, seq_file(args.gt_txt, seq), seq_file(args.result_txt, seq)) for seq in seqs]
+        plot_dir = None if args.no_plot else os.path.join(args.result_txt if os.path.isdir(args.result_txt) else os.path.dirname(args.result_txt), 'plot_path')
+        res = eval_tool.eval_sequences(sequences, num_workers=args.num_workers, cache_dir=args.cache_dir, plot_dir=plot_dir)
+        print("{0:>10} {1:>10} {2:>10}".format('seq', 't_err(%)', 'r_err'))
+        for seq in seqs:
+            print("{0:>10} {1:>10.2f} {2:>10.2f}".format(seq, res['sequences'][seq]['t_err'], res['sequences'][seq]['r_err']))
+        print("{0:>10} {1:>10.2f} {2:>10.2f}".format('mean', res['t_err'], res['r_err']))
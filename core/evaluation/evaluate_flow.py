@@ -2,9 +2,12 @@ import os, sys
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 import numpy as np
 from flowlib import read_flow_png, flow_to_image
+from gt_cache import load_gt_flow_cached
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'visualize'))
+from image_writer import get_image_writer, imwrite
 import cv2
-import multiprocessing
-import functools
+import torch
+import torch.nn.functional as F
 
 def get_scaled_intrinsic_matrix(calib_file, zoom_x, zoom_y):
     intrinsics = load_intrinsics_raw(calib_file)
@@ -50,37 +53,12 @@ def scale_intrinsics(mat, sx, sy):
     out[1, 2] *= sy
     return out
 
-def read_flow_gt_worker(dir_gt, i):
-    flow_true = read_flow_png(
-        os.path.join(dir_gt, "flow_occ", str(i).zfill(6) + "_10.png"))
-    flow_noc_true = read_flow_png(
-        os.path.join(dir_gt, "flow_noc", str(i).zfill(6) + "_10.png"))
-    return flow_true, flow_noc_true[:, :, 2]
-
-def load_gt_flow_kitti(gt_dataset_dir, mode):
-    gt_flows = []
-    noc_masks = []
-    if mode == "kitti_2012":
-        num_gt = 194
-        dir_gt = gt_dataset_dir
-    elif mode == "kitti_2015":
-        num_gt = 200
-        dir_gt = gt_dataset_dir
-    else:
-        num_gt = None
-        dir_gt = None
-        raise ValueError('Mode {} not found.'.format(mode))
-
-    fun = functools.partial(read_flow_gt_worker, dir_gt)
-    pool = multiprocessing.Pool(5)
-    results = pool.imap(fun, range(num_gt), chunksize=10)
-    pool.close()
-    pool.join()
-
-    for result in results:
-        gt_flows.append(result[0])
-        noc_masks.append(result[1])
-    return gt_flows, noc_masks
+def load_gt_flow_kitti(gt_dataset_dir, mode, cache_dir=None):
+    '''
+    Returns the gt flows (float32 (h, w, 3), u, v and valid) and noc masks of KITTI 2012 / 2015,
+    served lazily from arrays decoded once and memory-mapped from cache_dir when it is given.
+    '''
+    return load_gt_flow_cached(gt_dataset_dir, mode, cache_dir=cache_dir)
 
 def calculate_error_rate(epe_map, gt_flow, mask):
     bad_pixels = np.logical_and(
@@ -90,6 +68,20 @@ def calculate_error_rate(epe_map, gt_flow, mask):
     return bad_pixels.sum() / mask.sum()
 
 
+def write_flow_images(out_dir, i, flo_pred, gt_flow):
+    # predicted, gt and error flow images of a sample
+    imwrite(
+        os.path.join(out_dir, str(i).zfill(6) + "_10.png"),
+        flow_to_image(flo_pred))
+    imwrite(
+        os.path.join(out_dir, str(i).zfill(6) + "_10_gt.png"),
+        flow_to_image(gt_flow[:, :, 0:2]))
+    imwrite(
+        os.path.join(out_dir, str(i).zfill(6) + "_10_err.png"),
+        flow_to_image(
+            (flo_pred - gt_flow[:, :, 0:2]) * gt_flow[:, :, 2:3]))
+
+
 def eval_flow_avg(gt_flows,
                   noc_masks,
                   pred_flows,
@@ -98,6 +90,7 @@ def eval_flow_avg(gt_flows,
                   write_img=False):
     error, error_noc, error_occ, error_move, error_static, error_rate = 0.0, 0.0, 0.0, 0.0, 0.0, 0.0
     error_move_rate, error_static_rate = 0.0, 0.0
+    writer = get_image_writer().group() if write_img else None
 
     num = len(gt_flows)
     for gt_flow, noc_mask, pred_flow, i in zip(gt_flows, noc_masks, pred_flows,
@@ -114,19 +107,8 @@ def eval_flow_avg(gt_flows,
         if write_img:
             if not os.path.exists(os.path.join(cfg.model_dir, "pred_flow")):
                 os.mkdir(os.path.join(cfg.model_dir, "pred_flow"))
-            cv2.imwrite(
-                os.path.join(cfg.model_dir, "pred_flow",
-                             str(i).zfill(6) + "_10.png"),
-                flow_to_image(flo_pred))
-            cv2.imwrite(
-                os.path.join(cfg.model_dir, "pred_flow",
-                             str(i).zfill(6) + "_10_gt.png"),
-                flow_to_image(gt_flow[:, :, 0:2]))
-            cv2.imwrite(
-                os.path.join(cfg.model_dir, "pred_flow",
-                             str(i).zfill(6) + "_10_err.png"),
-                flow_to_image(
-                    (flo_pred - gt_flow[:, :, 0:2]) * gt_flow[:, :, 2:3]))
+            # colorized and written in the background
+            writer.submit(write_flow_images, os.path.join(cfg.model_dir, "pred_flow"), i, flo_pred, gt_flow)
 
         epe_map = np.sqrt(
             np.sum(np.square(flo_pred[:, :, 0:2] - gt_flow[:, :, 0:2]),
@@ -157,6 +139,9 @@ def eval_flow_avg(gt_flows,
                 1.0 - move_mask)) / np.sum(gt_flow[:, :, 2] *
                                            (1.0 - move_mask))
 
+    if writer is not None:
+        writer.flush()
+
     if moving_masks:
         result = "{:>10}, {:>10}, {:>10}, {:>10}, {:>10}, {:>10}, {:>10}, {:>10} \n".format(
             'epe', 'epe_noc', 'epe_occ', 'epe_move', 'epe_static',
@@ -172,3 +157,98 @@ def eval_flow_avg(gt_flows,
         result += "{:10.4f}, {:10.4f}, {:10.4f}, {:10.4f} \n".format(
             error / num, error_noc / num, error_occ / num, error_rate / num)
         return result
+
+
+class FlowEvaluator(object):
+    '''
+    Streaming version of eval_flow_avg. Predictions are added one image at a time with update() (the
+    gt sizes differ, a batch is split by the caller), resized and compared to the ground truth in
+    torch on the device of the prediction, and only the per-image sums are kept, so memory does not
+    grow with the number of images.
+    result() returns the averages as a dict, format_flow_result() the eval_flow_avg string.
+    '''
+    keys = ['epe', 'epe_noc', 'epe_occ', 'err_rate', 'epe_move', 'epe_static', 'move_err_rate', 'static_err_rate']
+
+    def __init__(self, img_hw, with_moving=False):
+        self.img_hw = img_hw
+        self.with_moving = with_moving
+        self.sums = None
+        self.num = 0
+
+    def to_tensor(self, x, device):
+        if isinstance(x, torch.Tensor):
+            return x.to(device).float()
+        return torch.from_numpy(np.ascontiguousarray(x)).to(device).float()
+
+    def resize_flow(self, pred_flow, H, W):
+        # (1, 2, h, w) at img_hw -> (2, H, W), flow rescaled to the gt resolution
+        scale = torch.tensor([W / float(self.img_hw[1]), H / float(self.img_hw[0])], device=pred_flow.device).view(1, 2, 1, 1)
+        pred_flow = F.interpolate(pred_flow * scale, size=(H, W), mode='bilinear', align_corners=False)
+        return pred_flow[0]
+
+    def error_rate(self, epe_map, gt_norm, mask):
+        epe_masked = epe_map * mask
+        bad_pixels = (epe_masked > 3) & (epe_masked / gt_norm.clamp(min=1e-10) > 0.05)
+        return bad_pixels.double().sum() / mask.double().sum()
+
+    def masked_mean(self, epe_map, mask, min_sum=None):
+        mask_sum = mask.double().sum()
+        if min_sum is not None:
+            mask_sum = mask_sum.clamp(min=min_sum)
+        return (epe_map.double() * mask.double()).sum() / mask_sum
+
+    def update(self, pred_flow, gt_flow, noc_mask, move_mask=None):
+        '''
+        - pred_flow	torch.Tensor (2, h, w) or (1, 2, h, w) predicted at img_hw, a single image
+        - gt_flow	(H, W, 3) u, v and valid, as read_flow_png
+        - noc_mask	(H, W)
+        - move_mask	(H, W), required when with_moving
+        '''
+        if pred_flow.dim() == 3:
+            pred_flow = pred_flow[None]
+        if pred_flow.shape[0] != 1:
+            raise ValueError('FlowEvaluator.update takes one image, got a batch of {}.'.format(pred_flow.shape[0]))
+        device = pred_flow.device
+        H, W = gt_flow.shape[0:2]
+        flo_pred = self.resize_flow(pred_flow.float(), H, W)
+        gt = self.to_tensor(gt_flow, device).permute(2, 0, 1)
+        gt_uv, valid = gt[0:2], gt[2]
+        noc = self.to_tensor(noc_mask, device)
+
+        epe_map = torch.sqrt(((flo_pred - gt_uv) ** 2).sum(0))
+        gt_norm = torch.sqrt((gt_uv ** 2).sum(0))
+        values = [self.masked_mean(epe_map, valid), self.masked_mean(epe_map, noc),
+                  self.masked_mean(epe_map, valid - noc, min_sum=1.0), self.error_rate(epe_map, gt_norm, valid)]
+        if self.with_moving:
+            move = self.to_tensor(move_mask, device)
+            values += [self.masked_mean(epe_map, valid * move), self.masked_mean(epe_map, valid * (1.0 - move)),
+                       self.error_rate(epe_map, gt_norm, valid * move), self.error_rate(epe_map, gt_norm, valid * (1.0 - move))]
+        values = torch.stack(values)
+        # summed on the device, read back once in result()
+        self.sums = values if self.sums is None else self.sums + values
+        self.num += 1
+
+    def result(self):
+        if self.num == 0:
+            return {}
+        means = (self.sums / self.num).cpu().numpy()
+        return dict([(k, float(v)) for k, v in zip(self.keys, means)])
+
+
+def format_flow_result(res):
+    # eval_flow_avg output for a FlowEvaluator result.
+    if 'epe_move' in res:
+        result = "{:>10}, {:>10}, {:>10}, {:>10}, {:>10}, {:>10}, {:>10}, {:>10} \n".format(
+            'epe', 'epe_noc', 'epe_occ', 'epe_move', 'epe_static',
+            'move_err_rate', 'static_err_rate', 'err_rate')
+        result += "{:10.4f}, {:10.4f}, {:10.4f}, {:10.4f}, {:10.4f}, {:10.4f}, {:10.4f}, {:10.4f} \n".format(
+            res['epe'], res['epe_noc'], res['epe_occ'], res['epe_move'],
+            res['epe_static'], res['move_err_rate'], res['static_err_rate'],
+            res['err_rate'])
+        return result
+    else:
+        result = "{:>10}, {:>10}, {:>10}, {:>10} \n".format(
+            'epe', 'epe_noc', 'epe_occ', 'err_rate')
+        result += "{:10.4f}, {:10.4f}, {:10.4f}, {:10.4f} \n".format(
+            res['epe'], res['epe_noc'], res['epe_occ'], res['err_rate'])
+        return result
@@ -4,6 +4,11 @@ import cv2
 import functools
 import matplotlib.pyplot as plt
 import multiprocessing
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from gt_cache import load_gt_mask_cached
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'visualize'))
+from image_writer import get_image_writer, imwrite
 
 """
 Adopted from https://github.com/martinkersner/py_img_seg_eval
@@ -17,88 +22,79 @@ class EvalSegErr(Exception):
         return repr(self.value)
 
 
-def pixel_accuracy(eval_segm, gt_segm):
+def confusion_matrix(eval_segm, gt_segm, num_classes=None):
     '''
-    sum_i(n_ii) / sum_i(t_i)
+    n_cl x n_cl matrix of the pixel counts, gt class in rows and eval class in columns, in one
+    np.bincount pass. The classes are the labels 0..n_cl-1 (binary masks here).
     '''
 
     check_size(eval_segm, gt_segm)
 
-    cl, n_cl = extract_classes(gt_segm)
-    eval_mask, gt_mask = extract_both_masks(eval_segm, gt_segm, cl, n_cl)
-
-    sum_n_ii = 0
-    sum_t_i = 0
-
-    for i, c in enumerate(cl):
-        curr_eval_mask = eval_mask[i, :, :]
-        curr_gt_mask = gt_mask[i, :, :]
+    eval_labels = np.asarray(eval_segm).astype(np.int64).ravel()
+    gt_labels = np.asarray(gt_segm).astype(np.int64).ravel()
+    if num_classes is None:
+        num_classes = int(max(eval_labels.max(initial=0), gt_labels.max(initial=0))) + 1
+    elif max(eval_labels.max(initial=0), gt_labels.max(initial=0)) >= num_classes or \
+            min(eval_labels.min(initial=0), gt_labels.min(initial=0)) < 0:
+        # out of range labels would be counted in the cells of other classes
+        raise EvalSegErr("Labels out of the range 0..{}!".format(num_classes - 1))
+    conf = np.bincount(gt_labels * num_classes + eval_labels, minlength=num_classes * num_classes)
+    return conf.reshape(num_classes, num_classes)
 
-        sum_n_ii += np.sum(np.logical_and(curr_eval_mask, curr_gt_mask))
-        sum_t_i += np.sum(curr_gt_mask)
 
-    if (sum_t_i == 0):
-        pixel_accuracy_ = 0
-    else:
-        pixel_accuracy_ = sum_n_ii / sum_t_i
-
-    return pixel_accuracy_
-
-
-def mean_accuracy(eval_segm, gt_segm):
+def segm_metrics(conf):
     '''
-    (1/n_cl) sum_i(n_ii/t_i)
+    pixel accuracy, mean accuracy, mean IU, per class IU (all the classes of conf) and frequency
+    weighted IU of a confusion matrix, as the functions below.
     '''
+    n_ii = np.diag(conf).astype(np.float64)
+    t_i = conf.sum(1).astype(np.float64)
+    n_ji = conf.sum(0).astype(np.float64)
+    gt_cl = t_i > 0
+    both_cl = np.logical_and(t_i > 0, n_ji > 0)
+    n_cl_gt = np.sum(gt_cl)
+    sum_t_i = np.sum(t_i)
 
-    check_size(eval_segm, gt_segm)
-
-    cl, n_cl = extract_classes(gt_segm)
-    eval_mask, gt_mask = extract_both_masks(eval_segm, gt_segm, cl, n_cl)
-
-    accuracy = list([0]) * n_cl
+    pixel_accuracy_ = np.sum(n_ii[gt_cl]) / sum_t_i if sum_t_i > 0 else 0
+    mean_accuracy_ = np.mean(n_ii[gt_cl] / t_i[gt_cl]) if n_cl_gt > 0 else 0
 
-    for i, c in enumerate(cl):
-        curr_eval_mask = eval_mask[i, :, :]
-        curr_gt_mask = gt_mask[i, :, :]
+    IU = np.zeros(len(n_ii))
+    IU[both_cl] = n_ii[both_cl] / (t_i[both_cl] + n_ji[both_cl] - n_ii[both_cl])
+    mean_IU_ = np.sum(IU) / n_cl_gt if n_cl_gt > 0 else 0
+    frequency_weighted_IU_ = np.sum(t_i * IU) / sum_t_i if sum_t_i > 0 else 0
 
-        n_ii = np.sum(np.logical_and(curr_eval_mask, curr_gt_mask))
-        t_i = np.sum(curr_gt_mask)
+    return pixel_accuracy_, mean_accuracy_, mean_IU_, IU, frequency_weighted_IU_
 
-        if (t_i != 0):
-            accuracy[i] = n_ii / t_i
 
-    mean_accuracy_ = np.mean(accuracy)
-    return mean_accuracy_
+def union_mask(conf):
+    # classes in the gt or in the eval segmentation
+    return np.logical_or(conf.sum(1) > 0, conf.sum(0) > 0)
 
 
-def mean_IU(eval_segm, gt_segm):
+def pixel_accuracy(eval_segm, gt_segm):
     '''
-    (1/n_cl) * sum_i(n_ii / (t_i + sum_j(n_ji) - n_ii))
+    sum_i(n_ii) / sum_i(t_i)
     '''
 
-    check_size(eval_segm, gt_segm)
-
-    cl, n_cl = union_classes(eval_segm, gt_segm)
-    _, n_cl_gt = extract_classes(gt_segm)
-    eval_mask, gt_mask = extract_both_masks(eval_segm, gt_segm, cl, n_cl)
+    return segm_metrics(confusion_matrix(eval_segm, gt_segm))[0]
 
-    IU = list([0]) * n_cl
 
-    for i, c in enumerate(cl):
-        curr_eval_mask = eval_mask[i, :, :]
-        curr_gt_mask = gt_mask[i, :, :]
+def mean_accuracy(eval_segm, gt_segm):
+    '''
+    (1/n_cl) sum_i(n_ii/t_i)
+    '''
 
-        if (np.sum(curr_eval_mask) == 0) or (np.sum(curr_gt_mask) == 0):
-            continue
+    return segm_metrics(confusion_matrix(eval_segm, gt_segm))[1]
 
-        n_ii = np.sum(np.logical_and(curr_eval_mask, curr_gt_mask))
-        t_i = np.sum(curr_gt_mask)
-        n_ij = np.sum(curr_eval_mask)
 
-        IU[i] = n_ii / (t_i + n_ij - n_ii)
+def mean_IU(eval_segm, gt_segm):
+    '''
+    (1/n_cl) * sum_i(n_ii / (t_i + sum_j(n_ji) - n_ii))
+    '''
 
-    mean_IU_ = np.sum(IU) / n_cl_gt
-    return mean_IU_, np.array(IU)
+    conf = confusion_matrix(eval_segm, gt_segm)
+    _, _, mean_IU_, IU, _ = segm_metrics(conf)
+    return mean_IU_, IU[union_mask(conf)]
 
 
 def frequency_weighted_IU(eval_segm, gt_segm):
@@ -106,73 +102,34 @@ def frequency_weighted_IU(eval_segm, gt_segm):
     sum_k(t_k)^(-1) * sum_i((t_i*n_ii)/(t_i + sum_j(n_ji) - n_ii))
     '''
 
-    check_size(eval_segm, gt_segm)
-
-    cl, n_cl = union_classes(eval_segm, gt_segm)
-    eval_mask, gt_mask = extract_both_masks(eval_segm, gt_segm, cl, n_cl)
-
-    frequency_weighted_IU_ = list([0]) * n_cl
+    return segm_metrics(confusion_matrix(eval_segm, gt_segm))[4]
 
-    for i, c in enumerate(cl):
-        curr_eval_mask = eval_mask[i, :, :]
-        curr_gt_mask = gt_mask[i, :, :]
 
-        if (np.sum(curr_eval_mask) == 0) or (np.sum(curr_gt_mask) == 0):
-            continue
-
-        n_ii = np.sum(np.logical_and(curr_eval_mask, curr_gt_mask))
-        t_i = np.sum(curr_gt_mask)
-        n_ij = np.sum(curr_eval_mask)
-
-        frequency_weighted_IU_[i] = (t_i * n_ii) / (t_i + n_ij - n_ii)
-
-    sum_k_t_k = get_pixel_area(eval_segm)
-
-    frequency_weighted_IU_ = np.sum(frequency_weighted_IU_) / sum_k_t_k
-    return frequency_weighted_IU_
-
-
-'''
-Auxiliary functions used during evaluation.
-'''
-
-
-def get_pixel_area(segm):
-    return segm.shape[0] * segm.shape[1]
-
-
-def extract_both_masks(eval_segm, gt_segm, cl, n_cl):
-    eval_mask = extract_masks(eval_segm, cl, n_cl)
-    gt_mask = extract_masks(gt_segm, cl, n_cl)
-
-    return eval_mask, gt_mask
-
-
-def extract_classes(segm):
-    cl = np.unique(segm)
-    n_cl = len(cl)
-
-    return cl, n_cl
-
-
-def union_classes(eval_segm, gt_segm):
-    eval_cl, _ = extract_classes(eval_segm)
-    gt_cl, _ = extract_classes(gt_segm)
-
-    cl = np.union1d(eval_cl, gt_cl)
-    n_cl = len(cl)
-
-    return cl, n_cl
-
-
-def extract_masks(segm, cl, n_cl):
-    h, w = segm_size(segm)
-    masks = np.zeros((n_cl, h, w))
-
-    for i, c in enumerate(cl):
-        masks[i, :, :] = segm == c
-
-    return masks
+class MaskEvaluator(object):
+    '''
+    Segmentation metrics over a dataset: the per image metrics are averaged over the images and
+    the confusion matrices summed, for the dataset level IU.
+    '''
+    def __init__(self, num_classes=2):
+        self.num_classes = num_classes
+        self.conf = np.zeros((num_classes, num_classes), dtype=np.int64)
+        self.sums = np.zeros(4)
+        self.IU_sum = np.zeros(num_classes)
+        self.num = 0
+
+    def update(self, eval_segm, gt_segm):
+        conf = confusion_matrix(eval_segm, gt_segm, self.num_classes)
+        pa, ma, mIU, IU, fwIU = segm_metrics(conf)
+        self.sums += [pa, ma, mIU, fwIU]
+        self.IU_sum += IU
+        self.conf += conf
+        self.num += 1
+
+    def result(self):
+        num = max(self.num, 1)
+        pa, ma, mIU, fwIU = self.sums / num
+        return {'pixel_accuracy': pa, 'mean_accuracy': ma, 'mean_IU': mIU, 'frequency_weighted_IU': fwIU,
+                'IU': self.IU_sum / num, 'dataset_IU': segm_metrics(self.conf)[3]}
 
 
 def segm_size(segm):
@@ -192,25 +149,19 @@ def check_size(eval_segm, gt_segm):
     if (h_e != h_g) or (w_e != w_g):
         raise EvalSegErr("DiffDim: Different dimensions of matrices!")
 
-def read_mask_gt_worker(gt_dataset_dir, idx):
-    return cv2.imread(
-        gt_dataset_dir + "/obj_map/" + str(idx).zfill(6) + "_10.png", -1)
-
-def load_gt_mask(gt_dataset_dir):
-    num_gt = 200
-    
+def load_gt_mask(gt_dataset_dir, cache_dir=None):
     # the dataset dir should be the directory of kitti-2015.
-    fun = functools.partial(read_mask_gt_worker, gt_dataset_dir)
-    pool = multiprocessing.Pool(5)
-    results = pool.imap(fun, range(num_gt), chunksize=10)
-    pool.close()
-    pool.join()
+    # masks (obj_map > 0) decoded once, memory-mapped from cache_dir when it is given.
+    return load_gt_mask_cached(gt_dataset_dir, cache_dir=cache_dir)
 
-    gt_masks = []
-    for m in results:
-        m[m > 0.0] = 1.0
-        gt_masks.append(m)
-    return gt_masks
+
+def write_mask_images(out_dir, i, pred_mask, cmap):
+    imwrite(
+        os.path.join(out_dir, str(i).zfill(6) + "_10_plot.png"),
+        cmap(pred_mask))
+    imwrite(
+        os.path.join(out_dir, str(i).zfill(6) + "_10.png"),
+        pred_mask)
 
 
 def eval_mask(pred_masks, gt_masks, opt):
@@ -218,8 +169,8 @@ def eval_mask(pred_masks, gt_masks, opt):
     if not os.path.exists(os.path.join(opt.trace, "pred_mask")):
         os.mkdir(os.path.join(opt.trace, "pred_mask"))
 
-    pa_res, ma_res, mIU_res, fwIU_res = 0.0, 0.0, 0.0, 0.0
-    IU_res = np.array([0.0, 0.0])
+    evaluator = MaskEvaluator(num_classes=2)
+    writer = get_image_writer().group()
 
     num_total = len(gt_masks)
     for i in range(num_total):
@@ -232,21 +183,11 @@ def eval_mask(pred_masks, gt_masks, opt):
         pred_mask[pred_mask >= 0.5] = 1.0
         pred_mask[pred_mask < 0.5] = 0.0
 
-        cv2.imwrite(
-            os.path.join(opt.trace, "pred_mask",
-                         str(i).zfill(6) + "_10_plot.png"),
-            grey_cmap(pred_mask))
-        cv2.imwrite(
-            os.path.join(opt.trace, "pred_mask", str(i).zfill(6) + "_10.png"),
-            pred_mask)
-
-        pa_res += pixel_accuracy(pred_mask, gt_mask)
-        ma_res += mean_accuracy(pred_mask, gt_mask)
-
-        mIU, IU = mean_IU(pred_mask, gt_mask)
-        mIU_res += mIU
-        IU_res += IU
+        # colormapped and written in the background, pred_mask is not modified below
+        writer.submit(write_mask_images, os.path.join(opt.trace, "pred_mask"), i, pred_mask, grey_cmap)
 
-        fwIU_res += frequency_weighted_IU(pred_mask, gt_mask)
+        evaluator.update(pred_mask, gt_mask)
 
-    return pa_res / 200., ma_res / 200., mIU_res / 200., fwIU_res / 200., IU_res / 200.
+    writer.flush()
+    res = evaluator.result()
+    return res['pixel_accuracy'], res['mean_accuracy'], res['mean_IU'], res['frequency_weighted_IU'], res['IU']
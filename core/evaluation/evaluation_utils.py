@@ -9,25 +9,25 @@ import imageio as sm
 
 # Adopted from https://github.com/mrharicot/monodepth
 def compute_errors(gt, pred, nyu=False):
+    # gt - pred and its square are shared by the metrics, only the log error of the dataset is computed.
     thresh = np.maximum((gt / pred), (pred / gt))
     a1 = (thresh < 1.25).mean()
     a2 = (thresh < 1.25**2).mean()
     a3 = (thresh < 1.25**3).mean()
 
-    rmse = (gt - pred)**2
-    rmse = np.sqrt(rmse.mean())
+    diff = gt - pred
+    sq_diff = diff**2
+    rmse = np.sqrt(sq_diff.mean())
 
-    rmse_log = (np.log(gt) - np.log(pred))**2
-    rmse_log = np.sqrt(rmse_log.mean())
+    abs_rel = np.mean(np.abs(diff) / (gt))
 
-    log10 = np.mean(np.abs((np.log10(gt) - np.log10(pred))))
-
-    abs_rel = np.mean(np.abs(gt - pred) / (gt))
-
-    sq_rel = np.mean(((gt - pred)**2) / (gt))
+    sq_rel = np.mean(sq_diff / (gt))
 
     if nyu:
+        log10 = np.mean(np.abs((np.log10(gt) - np.log10(pred))))
         return abs_rel, sq_rel, rmse, log10, a1, a2, a3
     else:
+        rmse_log = (np.log(gt) - np.log(pred))**2
+        rmse_log = np.sqrt(rmse_log.mean())
         return abs_rel, sq_rel, rmse, rmse_log, a1, a2, a3
 
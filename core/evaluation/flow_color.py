@@ -0,0 +1,54 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import numpy as np
+import torch
+from flowlib import COLOR_WHEEL_UNIT, UNKNOWN_FLOW_THRESH
+
+
+def flow_to_image_torch(flow):
+    '''
+    Batched flow_to_image on the device of flow, e.g. the output of inference_flow.
+    Every flow is normalized by its own max radius, as flow_to_image.
+    - flow	torch.Tensor (B, 2, H, W)
+    Returns uint8 (B, H, W, 3) on the same device.
+    The operations and their precision follow flowlib.compute_color (the flow dtype up to the hue,
+    float64 for the colors).
+    '''
+    u, v = flow[:, 0].clone(), flow[:, 1].clone()
+    unknown = (u.abs() > UNKNOWN_FLOW_THRESH) | (v.abs() > UNKNOWN_FLOW_THRESH)
+    u[unknown] = 0
+    v[unknown] = 0
+
+    rad = torch.sqrt(u**2 + v**2)
+    maxrad = rad.view(rad.shape[0], -1).max(1)[0].clamp(min=-1)
+    denom = (maxrad.double() + np.finfo(float).eps).to(flow.dtype).view(-1, 1, 1)
+    u = u / denom
+    v = v / denom
+
+    nan = torch.isnan(u) | torch.isnan(v)
+    u[nan] = 0
+    v[nan] = 0
+
+    wheel = torch.from_numpy(np.ascontiguousarray(COLOR_WHEEL_UNIT)).to(flow.device)
+    ncols = wheel.shape[0]
+
+    rad = torch.sqrt(u**2 + v**2)
+    a = torch.atan2(-v, -u) / np.pi
+    fk = (a + 1) / 2 * (ncols - 1) + 1
+    k0 = torch.floor(fk).long()
+    k1 = k0 + 1
+    k1[k1 == ncols + 1] = 1
+    f = (fk.double() - k0.double()).unsqueeze(-1)
+
+    col0 = wheel[k0 - 1]
+    col1 = wheel[k1 - 1]
+    col = (1 - f) * col0 + f * col1
+
+    rad = rad.double().unsqueeze(-1)
+    inside = (rad <= 1).expand_as(col)
+    col_inside = 1 - rad * (1 - col)
+    col = col * 0.75
+    col[inside] = col_inside[inside]
+    img = torch.floor(255 * col * (1 - nan.double()).unsqueeze(-1)).to(torch.uint8)
+    img[unknown] = 0
+    return img
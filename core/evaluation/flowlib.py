@@ -8,13 +8,12 @@ Adopted from https://github.com/liruoteng/OpticalFlowToolkit
 # Date: 6th Aug 2016
 # ==============================
 """
-import png
 import scipy
 import numpy as np
 import matplotlib.colors as cl
 import matplotlib.pyplot as plt
 from PIL import Image
-#import cv2
+import cv2
 
 UNKNOWN_FLOW_THRESH = 1e7
 SMALLFLOW = 0.0
@@ -108,19 +107,15 @@ def read_flow_png(flow_file):
     """
     Read optical flow from KITTI .png file
     :param flow_file: name of the flow file
-    :return: optical flow data in matrix
+    :return: optical flow data in matrix, float32 (h, w, 3) with u, v and the valid mask
     """
-    flow_object = png.Reader(filename=flow_file)
-    flow_direct = flow_object.asDirect()
-    flow_data = list(flow_direct[2])
-    (w, h) = flow_direct[3]['size']
-    flow = np.zeros((h, w, 3), dtype=np.float64)
-    for i in range(len(flow_data)):
-        flow[i, :, 0] = flow_data[i][0::3]
-        flow[i, :, 1] = flow_data[i][1::3]
-        flow[i, :, 2] = flow_data[i][2::3]
-
+    # 16-bit png, cv2 returns the channels as BGR
+    flow_raw = cv2.imread(flow_file, cv2.IMREAD_UNCHANGED)
+    if flow_raw is None:
+        raise IOError('Failed to read ' + flow_file)
+    flow = flow_raw[:, :, ::-1].astype(np.float32)
     invalid_idx = (flow[:, :, 2] == 0)
+    # exact in float32: 16-bit integers over 64
     flow[:, :, 0:2] = (flow[:, :, 0:2] - 2**15) / 64.0
     flow[invalid_idx, 0] = 0
     flow[invalid_idx, 1] = 0
@@ -135,13 +130,9 @@ def write_flow_png(flo, flow_file):
     out_flo[:, :, 1] = np.maximum(
         np.minimum(flo[:, :, 1] * 64.0 + 2**15, 2**16 - 1), 0)
     out_flo = out_flo.astype(np.uint16)
-
-    with open(flow_file, 'wb') as f:
-        writer = png.Writer(width=w, height=h, bitdepth=16)
-        # Convert z to the Python list of lists expected by
-        # the png writer.
-        z2list = out_flo.reshape(-1, w * 3).tolist()
-        writer.write(f, z2list)
+    # 16-bit png written as BGR by cv2
+    if not cv2.imwrite(flow_file, np.ascontiguousarray(out_flo[:, :, ::-1])):
+        raise IOError('Failed to write ' + flow_file)
 
 
 def write_flow(flow, filename):
@@ -288,12 +279,11 @@ def flow_to_image(flow):
     u = u / (maxrad + np.finfo(float).eps)
     v = v / (maxrad + np.finfo(float).eps)
 
-    img = compute_color(u, v)
+    img = compute_color_uint8(u, v)
 
-    idx = np.repeat(idxUnknow[:, :, np.newaxis], 3, axis=2)
-    img[idx] = 0
+    img[idxUnknow] = 0
 
-    return np.uint8(img)
+    return img
 
 
 def evaluate_flow_file(gt, pred):
@@ -331,20 +321,17 @@ Disparity Section
 
 def read_disp_png(file_name):
     """
-    Read optical flow from KITTI .png file
-    :param file_name: name of the flow file
-    :return: optical flow data in matrix
+    Read disparity from KITTI .png file
+    :param file_name: name of the disparity file
+    :return: disparity, float32 (h, w)
     """
-    image_object = png.Reader(filename=file_name)
-    image_direct = image_object.asDirect()
-    image_data = list(image_direct[2])
-    (w, h) = image_direct[3]['size']
-    channel = len(image_data[0]) / w
-    flow = np.zeros((h, w, channel), dtype=np.uint16)
-    for i in range(len(image_data)):
-        for j in range(channel):
-            flow[i, :, j] = image_data[i][j::channel]
-    return flow[:, :, 0] / 256
+    image = cv2.imread(file_name, cv2.IMREAD_UNCHANGED)
+    if image is None:
+        raise IOError('Failed to read ' + file_name)
+    if image.ndim == 3:
+        # first png channel, cv2 returns the channels as BGR(A)
+        image = image[:, :, 2]
+    return image.astype(np.float32) / 256
 
 
 def disp_to_flowfile(disp, filename):
@@ -448,13 +435,21 @@ def compute_color(u, v):
     :param v: optical flow vertical map
     :return: optical flow in color code
     """
-    [h, w] = u.shape
-    img = np.zeros([h, w, 3])
+    return compute_color_uint8(u, v).astype(np.float64)
+
+
+def compute_color_uint8(u, v):
+    """
+    compute_color as uint8, the hue interpolation is computed once for the three channels
+    :param u: optical flow horizontal map
+    :param v: optical flow vertical map
+    :return: optical flow in color code, uint8 (h, w, 3)
+    """
     nanIdx = np.isnan(u) | np.isnan(v)
     u[nanIdx] = 0
     v[nanIdx] = 0
 
-    colorwheel = make_color_wheel()
+    colorwheel = get_color_wheel()
     ncols = np.size(colorwheel, 0)
 
     rad = np.sqrt(u**2 + v**2)
@@ -467,22 +462,16 @@ def compute_color(u, v):
 
     k1 = k0 + 1
     k1[k1 == ncols + 1] = 1
-    f = fk - k0
-
-    for i in range(0, np.size(colorwheel, 1)):
-        tmp = colorwheel[:, i]
-        col0 = tmp[k0 - 1] / 255
-        col1 = tmp[k1 - 1] / 255
-        col = (1 - f) * col0 + f * col1
-
-        idx = rad <= 1
-        col[idx] = 1 - rad[idx] * (1 - col[idx])
-        notidx = np.logical_not(idx)
+    f = (fk - k0)[:, :, np.newaxis]
 
-        col[notidx] *= 0.75
-        img[:, :, i] = np.uint8(np.floor(255 * col * (1 - nanIdx)))
+    # (h, w, 3) colors of the two nearest hues
+    col0 = COLOR_WHEEL_UNIT[k0 - 1]
+    col1 = COLOR_WHEEL_UNIT[k1 - 1]
+    col = (1 - f) * col0 + f * col1
 
-    return img
+    idx = (rad <= 1)[:, :, np.newaxis]
+    col = np.where(idx, 1 - rad[:, :, np.newaxis] * (1 - col), col * 0.75)
+    return np.uint8(np.floor(255 * col * (1 - nanIdx)[:, :, np.newaxis]))
 
 
 def make_color_wheel():
@@ -538,3 +527,18 @@ def make_color_wheel():
     colorwheel[col:col + MR, 0] = 255
 
     return colorwheel
+
+
+# color wheel and color wheel / 255, built once
+COLOR_WHEEL = make_color_wheel()
+COLOR_WHEEL.setflags(write=False)
+COLOR_WHEEL_UNIT = COLOR_WHEEL / 255
+COLOR_WHEEL_UNIT.setflags(write=False)
+
+
+def get_color_wheel():
+    """
+    Cached Middlebury color wheel (read only), see make_color_wheel
+    :return: Color wheel
+    """
+    return COLOR_WHEEL
@@ -0,0 +1,226 @@
+import os, sys
+import json
+import hashlib
+import threading
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import cv2
+from PIL import Image
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from flowlib import read_flow_png
+
+NUM_GT = {'kitti_2012': 194, 'kitti_2015': 200}
+
+
+class LazyList(object):
+    # Read-only sequence whose items are built on access from the cached arrays.
+    def __init__(self, get_fn, length):
+        self.get_fn = get_fn
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.length
+        if i < 0 or i >= self.length:
+            raise IndexError
+        return self.get_fn(i)
+
+    def __iter__(self):
+        for i in range(self.length):
+            yield self.get_fn(i)
+
+
+def files_key(files):
+    # Hash of the names, sizes and modification times of the ground truth files.
+    h = hashlib.sha1()
+    for f in files:
+        stat = os.stat(f)
+        h.update('{}:{}:{}\n'.format(os.path.basename(f), stat.st_size, stat.st_mtime).encode())
+    return h.hexdigest()
+
+
+def cached_arrays(cache_dir, name, key, specs_fn, fill_fn):
+    '''
+    Arrays of specs_fn() {array_name: (dtype, shape)} filled once by fill_fn(arrays) and kept as .npy
+    files in cache_dir, memory-mapped on the next runs while key is unchanged. specs_fn is only
+    called when the arrays are built.
+    Without cache_dir the arrays are filled in memory.
+    '''
+    if cache_dir is None:
+        arrays = dict([(k, np.zeros(shape, dtype=dtype)) for k, (dtype, shape) in specs_fn().items()])
+        fill_fn(arrays)
+        return arrays
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    key_file = os.path.join(cache_dir, name + '.json')
+    if os.path.isfile(key_file):
+        with open(key_file, 'r') as f:
+            cached = json.load(f)
+        fnames = dict([(k, os.path.join(cache_dir, '{}_{}.npy'.format(name, k))) for k in cached.get('arrays', [])])
+        if cached.get('key') == key and len(fnames) > 0 and all([os.path.isfile(f) for f in fnames.values()]):
+            return dict([(k, np.load(fname, mmap_mode='r')) for k, fname in fnames.items()])
+    print('Caching the {} ground truth in {}'.format(name, cache_dir))
+    specs = specs_fn()
+    fnames = dict([(k, os.path.join(cache_dir, '{}_{}.npy'.format(name, k))) for k in specs.keys()])
+    # runs sharing cache_dir may build the same arrays at the same time, each one writes its own
+    # temporary files and the (identical) results replace each other atomically
+    tmp = '.{}.tmp'.format(os.getpid())
+    try:
+        arrays = dict([(k, np.lib.format.open_memmap(fnames[k] + tmp, mode='w+', dtype=dtype, shape=shape)) for k, (dtype, shape) in specs.items()])
+        fill_fn(arrays)
+        for k in specs.keys():
+            arrays[k].flush()
+        del arrays
+        for k in specs.keys():
+            os.replace(fnames[k] + tmp, fnames[k])
+        with open(key_file + tmp, 'w') as f:
+            json.dump({'key': key, 'arrays': sorted(specs.keys())}, f)
+        os.replace(key_file + tmp, key_file)
+    finally:
+        for f in list(fnames.values()) + [key_file]:
+            if os.path.isfile(f + tmp):
+                os.remove(f + tmp)
+    return dict([(k, np.load(fname, mmap_mode='r')) for k, fname in fnames.items()])
+
+
+def image_shapes(files):
+    # (h, w) of every image, from the png headers only.
+    shapes = []
+    for f in files:
+        w, h = Image.open(f).size
+        shapes.append((h, w))
+    return np.array(shapes, dtype=np.int32)
+
+
+class KittiFlowGT(object):
+    '''
+    KITTI 2012 / 2015 flow ground truth, padded to the largest image:
+    - flow	int16 (N, H, W, 2), the 16-bit png values minus 2**15, i.e. flow * 64, 0 where invalid
+    - valid / noc	uint8 (N, H, W), flow_occ and flow_noc validity
+    - shapes	int32 (N, 2), size of every image
+    '''
+    def __init__(self, gt_dir, mode, cache_dir=None, num_threads=8):
+        if mode not in NUM_GT:
+            raise ValueError('Mode {} not found.'.format(mode))
+        num_gt = NUM_GT[mode]
+        occ_files = [os.path.join(gt_dir, "flow_occ", str(i).zfill(6) + "_10.png") for i in range(num_gt)]
+        noc_files = [os.path.join(gt_dir, "flow_noc", str(i).zfill(6) + "_10.png") for i in range(num_gt)]
+        self.num_threads = num_threads
+        key = files_key(occ_files + noc_files)
+        # the png headers are only read when the cache is built
+        shapes = []
+
+        def specs():
+            shapes.append(image_shapes(occ_files))
+            max_h, max_w = shapes[0].max(0)
+            return {'flow': (np.int16, (num_gt, max_h, max_w, 2)), 'valid': (np.uint8, (num_gt, max_h, max_w)),
+                    'noc': (np.uint8, (num_gt, max_h, max_w)), 'shapes': (np.int32, (num_gt, 2))}
+
+        def fill(arrays):
+            arrays['shapes'][:] = shapes[0]
+            def decode(i):
+                flow = read_flow_png(occ_files[i])
+                noc = read_flow_png(noc_files[i])
+                h, w = flow.shape[0:2]
+                arrays['flow'][i, :h, :w] = (flow[:, :, 0:2] * 64.0).astype(np.int16)
+                arrays['valid'][i, :h, :w] = flow[:, :, 2]
+                arrays['noc'][i, :h, :w] = noc[:, :, 2]
+            pool = ThreadPool(self.num_threads)
+            pool.map(decode, range(num_gt))
+            pool.close()
+            pool.join()
+        arrays = cached_arrays(cache_dir, mode + '_flow', key, specs, fill)
+        self.flow, self.valid, self.noc, self.shapes = arrays['flow'], arrays['valid'], arrays['noc'], arrays['shapes']
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def get_flow(self, i):
+        # float32 (h, w, 3) with u, v and the valid mask, as read_flow_png
+        h, w = self.shapes[i]
+        flow = np.empty((h, w, 3), dtype=np.float32)
+        flow[:, :, 0:2] = self.flow[i, :h, :w] / np.float32(64.0)
+        flow[:, :, 2] = self.valid[i, :h, :w]
+        return flow
+
+    def get_noc(self, i):
+        h, w = self.shapes[i]
+        return self.noc[i, :h, :w].astype(np.float32)
+
+
+class KittiMaskGT(object):
+    # KITTI 2015 object masks (obj_map > 0), uint8 (N, H, W) padded, with the size of every image.
+    def __init__(self, gt_dir, cache_dir=None, num_threads=8):
+        num_gt = NUM_GT['kitti_2015']
+        files = [os.path.join(gt_dir, "obj_map", str(i).zfill(6) + "_10.png") for i in range(num_gt)]
+        key = files_key(files)
+        shapes = []
+
+        def specs():
+            shapes.append(image_shapes(files))
+            max_h, max_w = shapes[0].max(0)
+            return {'mask': (np.uint8, (num_gt, max_h, max_w)), 'shapes': (np.int32, (num_gt, 2))}
+
+        def fill(arrays):
+            arrays['shapes'][:] = shapes[0]
+            def decode(i):
+                m = cv2.imread(files[i], -1)
+                arrays['mask'][i, :m.shape[0], :m.shape[1]] = (m > 0)
+            pool = ThreadPool(num_threads)
+            pool.map(decode, range(num_gt))
+            pool.close()
+            pool.join()
+        arrays = cached_arrays(cache_dir, 'kitti_2015_mask', key, specs, fill)
+        self.mask, self.shapes = arrays['mask'], arrays['shapes']
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def get_mask(self, i):
+        h, w = self.shapes[i]
+        return np.array(self.mask[i, :h, :w])
+
+
+def load_gt_flow_cached(gt_dir, mode, cache_dir=None):
+    gt = KittiFlowGT(gt_dir, mode, cache_dir=cache_dir)
+    return LazyList(gt.get_flow, len(gt)), LazyList(gt.get_noc, len(gt))
+
+
+def load_gt_mask_cached(gt_dir, cache_dir=None):
+    gt = KittiMaskGT(gt_dir, cache_dir=cache_dir)
+    return LazyList(gt.get_mask, len(gt))
+
+
+class AsyncCall(object):
+    '''
+    Runs fn(*args, **kwargs) on a background thread, e.g. loading the ground truth while the model
+    is built. result() waits for it and returns its value or raises its exception.
+    '''
+    def __init__(self, fn, *args, **kwargs):
+        self.value, self.error = None, None
+        self.thread = threading.Thread(target=self.run, args=(fn, args, kwargs))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, fn, args, kwargs):
+        try:
+            self.value = fn(*args, **kwargs)
+        except Exception as e:
+            self.error = e
+
+    def result(self):
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+def load_kitti_gt(cfg, cache_dir=None):
+    # Ground truth used for the flow evaluation during training.
+    gt_flows_2012, noc_masks_2012 = load_gt_flow_cached(cfg.gt_2012_dir, 'kitti_2012', cache_dir)
+    gt_flows_2015, noc_masks_2015 = load_gt_flow_cached(cfg.gt_2015_dir, 'kitti_2015', cache_dir)
+    gt_masks_2015 = load_gt_mask_cached(cfg.gt_2015_dir, cache_dir)
+    return gt_flows_2012, noc_masks_2012, gt_flows_2015, noc_masks_2015, gt_masks_2015
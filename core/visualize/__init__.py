@@ -3,3 +3,5 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 from visualizer import Visualizer
 from visualizer import Visualizer_debug
 from profiler import Profiler
+from metrics_log import MetricsLog, read_metrics, tail_metrics, convert_log_pkl
+from image_writer import ImageWriterPool, WriteGroup, get_image_writer
@@ -0,0 +1,96 @@
+import os, sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+import cv2
+
+
+class ImageWriterPool(object):
+    '''
+    Encodes and writes images on a pool of threads (cv2 and numpy release the GIL), so that dumping
+    images overlaps with the evaluation.
+    Jobs are functions doing the colorization / encoding and the write. At most max_pending jobs are
+    queued: submit() blocks while the pool is that far behind.
+    The pool is shared, every user submits through its own group(), whose flush() waits for the jobs
+    of the group only and raises the first error of one of them.
+    '''
+    def __init__(self, num_workers=4, max_pending=32):
+        self.executor = ThreadPoolExecutor(max_workers=num_workers)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        self.pending = set()
+
+    def done(self, future):
+        with self.lock:
+            self.pending.discard(future)
+        self.slots.release()
+
+    def submit(self, fn, *args, **kwargs):
+        self.slots.acquire()
+        future = self.executor.submit(fn, *args, **kwargs)
+        with self.lock:
+            self.pending.add(future)
+        future.add_done_callback(self.done)
+        return future
+
+    def group(self):
+        return WriteGroup(self)
+
+    def flush(self):
+        # waits for the jobs of all the groups, their errors are raised by the groups
+        with self.lock:
+            pending = list(self.pending)
+        wait(pending)
+
+    def close(self):
+        self.flush()
+        self.executor.shutdown()
+
+
+class WriteGroup(object):
+    '''
+    The jobs of one user of an ImageWriterPool, e.g. an evaluation or a debug visualizer.
+    '''
+    def __init__(self, pool):
+        self.pool = pool
+        self.futures = []
+
+    def check(self, futures):
+        for future in futures:
+            if future.exception() is not None:
+                self.futures = []
+                raise future.exception()
+
+    def submit(self, fn, *args, **kwargs):
+        # errors of the finished jobs are raised early, the others by flush()
+        done = [f for f in self.futures if f.done()]
+        self.futures = [f for f in self.futures if not f.done()]
+        self.check(done)
+        future = self.pool.submit(fn, *args, **kwargs)
+        self.futures.append(future)
+        return future
+
+    def write(self, fname, img, params=None):
+        # cv2.imwrite in the pool, img must not be modified afterwards.
+        return self.submit(imwrite, fname, img, params)
+
+    def flush(self):
+        futures, self.futures = self.futures, []
+        wait(futures)
+        self.check(futures)
+
+
+def imwrite(fname, img, params=None):
+    if not cv2.imwrite(fname, img, params if params is not None else []):
+        raise IOError('Failed to write ' + fname)
+
+
+# pool shared by the evaluation and the debug visualization
+SHARED_WRITER = None
+SHARED_WRITER_LOCK = threading.Lock()
+
+def get_image_writer():
+    global SHARED_WRITER
+    with SHARED_WRITER_LOCK:
+        if SHARED_WRITER is None:
+            SHARED_WRITER = ImageWriterPool()
+        return SHARED_WRITER
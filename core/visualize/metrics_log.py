@@ -0,0 +1,195 @@
+import os, sys
+import time
+import json
+import pickle
+import numbers
+import argparse
+
+# names of the values of the depth results (eval_depth tuples)
+DEPTH_METRICS = ['abs_rel', 'sq_rel', 'rms', 'log_rms', 'a1', 'a2', 'a3']
+NYU_DEPTH_METRICS = ['abs_rel', 'sq_rel', 'rms', 'log10', 'a1', 'a2', 'a3']
+
+
+def to_number(v):
+    # numpy / torch scalars to python numbers, None for anything else.
+    if isinstance(v, bool):
+        return int(v)
+    if isinstance(v, numbers.Integral):
+        return int(v)
+    if isinstance(v, numbers.Real):
+        return float(v)
+    if hasattr(v, 'numel'):
+        size = v.numel()
+    elif hasattr(v, 'item') and hasattr(v, 'size'):
+        size = v.size
+    else:
+        return None
+    return to_number(v.item()) if size == 1 else None
+
+
+def parse_result_string(res):
+    '''
+    The old eval_flow_avg output, a line of names and a line of values, as a dict.
+    Returns None for other strings.
+    '''
+    lines = [l for l in res.strip().split('\n') if l.strip()]
+    if len(lines) != 2:
+        return None
+    names = [k.strip() for k in lines[0].split(',') if k.strip()]
+    try:
+        values = [float(k) for k in lines[1].split(',') if k.strip()]
+    except ValueError:
+        return None
+    if len(names) != len(values):
+        return None
+    return dict(zip(names, values))
+
+
+def flatten_record(pack, prefix=''):
+    '''
+    Flattens a log pack into {name: number}, nested names joined with '.'.
+    Depth result tuples get their metric names, eval_flow_avg strings are parsed.
+    '''
+    record = {}
+    for k, v in pack.items():
+        name = prefix + str(k)
+        if isinstance(v, str):
+            parsed = parse_result_string(v)
+            if parsed is not None:
+                record.update(flatten_record(parsed, name + '.'))
+            else:
+                record[name] = v
+        elif isinstance(v, dict):
+            record.update(flatten_record(v, name + '.'))
+        elif isinstance(v, (tuple, list)) and len(v) == len(DEPTH_METRICS) and all([to_number(x) is not None for x in v]):
+            metrics = NYU_DEPTH_METRICS if 'nyu' in name else DEPTH_METRICS
+            record.update(dict([(name + '.' + m, to_number(x)) for m, x in zip(metrics, v)]))
+        else:
+            number = to_number(v)
+            record[name] = number if number is not None else str(v)
+    return record
+
+
+class MetricsLog(object):
+    '''
+    Append-only JSON lines log of the training metrics, one record per line:
+    {"kind": "loss" / "eval", "iter": ..., "time": ..., <metric>: <number>, ...}
+    Records are buffered and written as whole lines, at most every flush_interval seconds or
+    max_buffer records, so an interrupted run leaves at most a partial last line, which the
+    readers skip.
+    '''
+    def __init__(self, fname, flush_interval=30.0, max_buffer=100):
+        self.fname = fname
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.buffer = []
+        self.last_flush = time.time()
+        dirname = os.path.dirname(os.path.abspath(fname))
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self.f = open(fname, 'a')
+
+    def append(self, kind, iter_=None, values=None, flush=False):
+        record = {'kind': kind, 'iter': to_number(iter_) if iter_ is not None else None, 'time': time.time()}
+        record.update(flatten_record(values or {}))
+        self.buffer.append(json.dumps(record))
+        if flush or len(self.buffer) >= self.max_buffer or time.time() - self.last_flush > self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) > 0:
+            self.f.write('\n'.join(self.buffer) + '\n')
+            self.buffer = []
+        self.f.flush()
+        self.last_flush = time.time()
+
+    def close(self):
+        if self.f is not None:
+            self.flush()
+            self.f.close()
+            self.f = None
+
+
+def parse_lines(data):
+    records = []
+    for line in data.split(b'\n'):
+        if not line.strip():
+            continue
+        try:
+            records.append(json.loads(line.decode()))
+        except ValueError:
+            pass
+    return records
+
+
+def read_metrics(fname, offset=0, kind=None):
+    '''
+    Records written after byte offset, and the offset to continue from: a dashboard keeps the
+    offset and reads only the new lines. A partial last line is left for the next read.
+    '''
+    with open(fname, 'rb') as f:
+        f.seek(offset)
+        data = f.read()
+    end = data.rfind(b'\n') + 1
+    records = parse_lines(data[:end])
+    if kind is not None:
+        records = [r for r in records if r.get('kind') == kind]
+    return records, offset + end
+
+
+def tail_metrics(fname, num_records=10, kind=None, block_size=65536):
+    '''
+    The last num_records records (of a kind), read backwards from the end of the file.
+    '''
+    with open(fname, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        data = b''
+        records = []
+        while pos > 0:
+            read_size = min(block_size, pos)
+            pos -= read_size
+            f.seek(pos)
+            data = f.read(read_size) + data
+            # skip the partial last line, and the first line unless the start of the file is read
+            lines = data[:data.rfind(b'\n') + 1]
+            if pos > 0:
+                lines = lines[lines.find(b'\n') + 1:]
+            records = parse_lines(lines)
+            if kind is not None:
+                records = [r for r in records if r.get('kind') == kind]
+            if len(records) >= num_records:
+                break
+    return records[-num_records:] if num_records > 0 else []
+
+
+def convert_log_pkl(pkl_fname, jsonl_fname=None):
+    '''
+    Converts a log.pkl (the pickled list of evaluation log packs) into a metrics log.
+    '''
+    if jsonl_fname is None:
+        jsonl_fname = os.path.splitext(pkl_fname)[0] + '.jsonl'
+    with open(pkl_fname, 'rb') as f:
+        log_list = pickle.load(f)
+    metrics_log = MetricsLog(jsonl_fname)
+    for pack in log_list:
+        pack = dict(pack)
+        iter_ = pack.pop('eval_iter', None)
+        metrics_log.append('eval', iter_, pack)
+    metrics_log.close()
+    print('{0} records of {1} written to {2}'.format(len(log_list), pkl_fname, jsonl_fname))
+    return jsonl_fname
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Metrics log tools.')
+    arg_parser.add_argument('fname', type=str, help='log.pkl to convert, or a metrics log to read.')
+    arg_parser.add_argument('--output', type=str, default=None, help='converted metrics log, next to the log.pkl by default.')
+    arg_parser.add_argument('--tail', type=int, default=None, help='print the last records of a metrics log.')
+    arg_parser.add_argument('--kind', type=str, default=None, help='loss or eval records only.')
+    args = arg_parser.parse_args()
+    if args.tail is not None:
+        for record in tail_metrics(args.fname, args.tail, kind=args.kind):
+            print(json.dumps(record))
+    else:
+        convert_log_pkl(args.fname, args.output)
@@ -2,7 +2,9 @@ import os, sys
 import numpy as np
 import cv2
 import pdb
-import pickle
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from metrics_log import MetricsLog
+from image_writer import get_image_writer, imwrite
 from mpl_toolkits import mplot3d
 import matplotlib.pyplot as plt
 import PIL.Image as pil
@@ -18,18 +20,31 @@ class Visualizer(object):
         #self.use_flow_error = (self.loss_weights_dict['flow_error'] > 0)
         self.dump_dir = dump_dir
 
-        self.log_list = []
+        # losses and evaluation results, appended to the metrics log (see metrics_log.py)
+        self.metrics_log = MetricsLog(dump_dir) if dump_dir is not None else None
 
     def add_log_pack(self, log_pack):
-        self.log_list.append(log_pack)
-
-    def dump_log(self, fname=None):
-        if fname is None:
-            fname = self.dump_dir
-        with open(fname, 'wb') as f:
-            pickle.dump(self.log_list, f)
-
-    def print_loss(self, loss_pack, iter_=None):
+        if self.metrics_log is None:
+            return
+        log_pack = dict(log_pack)
+        iter_ = log_pack.pop('eval_iter', None)
+        self.metrics_log.append('eval', iter_, log_pack)
+
+    def dump_log(self):
+        # Writes the buffered records.
+        if self.metrics_log is not None:
+            self.metrics_log.flush()
+
+    def close(self):
+        if self.metrics_log is not None:
+            self.metrics_log.close()
+
+    def format_stats(self, stats):
+        if not stats:
+            return ''
+        return ''.join([', {0}: {1:.4f}'.format(k, v) for k, v in stats.items()])
+
+    def print_loss(self, loss_pack, iter_=None, stats=None):
         loss_pixel = loss_pack['loss_pixel'].mean().detach().cpu().numpy()
         loss_ssim = loss_pack['loss_ssim'].mean().detach().cpu().numpy()
         loss_flow_smooth = loss_pack['loss_flow_smooth'].mean().detach().cpu().numpy()
@@ -43,15 +58,25 @@ class Visualizer(object):
             #if self.use_flow_error:
             #    loss_flow_error = loss_pack['flow_error'].mean().detach().cpu().numpy()
             #    str_ = str_ + ', loss_flow_error: {0:.6f}'.format(loss_flow_error)
-            print(str_)
+            print(str_ + self.format_stats(stats))
+            losses = {'loss_pixel': loss_pixel, 'loss_ssim': loss_ssim, 'loss_pt_depth': loss_pt_depth, 'loss_pj_depth': loss_pj_depth, 'loss_depth_smooth': loss_depth_smooth}
         else:
-            print('iter: {4}, loss_pixel: {0:.6f}, loss_ssim: {1:.6f}, loss_flow_smooth: {2:.6f}, loss_flow_consis: {3:.6f}'.format(loss_pixel, loss_ssim, loss_flow_smooth, loss_flow_consis, iter_))
+            print('iter: {4}, loss_pixel: {0:.6f}, loss_ssim: {1:.6f}, loss_flow_smooth: {2:.6f}, loss_flow_consis: {3:.6f}'.format(loss_pixel, loss_ssim, loss_flow_smooth, loss_flow_consis, iter_) + self.format_stats(stats))
+            losses = {'loss_pixel': loss_pixel, 'loss_ssim': loss_ssim, 'loss_flow_smooth': loss_flow_smooth, 'loss_flow_consis': loss_flow_consis}
+        if self.metrics_log is not None:
+            losses.update(stats or {})
+            self.metrics_log.append('loss', iter_, losses)
 
 class Visualizer_debug():
     def __init__(self, dump_dir=None, img1=None, img2=None):
         self.dump_dir = dump_dir
         self.img1 = img1
         self.img2 = img2
+        # images are drawn and written in the background, flush() waits for them
+        self.writer = get_image_writer().group()
+
+    def flush(self):
+        self.writer.flush()
     
     def draw_point_corres(self, batch_idx, match, name):
         img1 = self.img1[batch_idx]
@@ -75,8 +100,11 @@ class Visualizer_debug():
 
     def show_corres(self, img1, img2, match, name):
         # img: [H, W, 3] match: [4, n]
-        cv2.imwrite(os.path.join(self.dump_dir, name+'_img1_cor.png'), img1)
-        cv2.imwrite(os.path.join(self.dump_dir, name+'_img2_cor.png'), img2)
+        self.writer.submit(self.write_corres, np.array(img1), np.array(img2), np.array(match), name)
+
+    def write_corres(self, img1, img2, match, name):
+        imwrite(os.path.join(self.dump_dir, name+'_img1_cor.png'), img1)
+        imwrite(os.path.join(self.dump_dir, name+'_img2_cor.png'), img2)
         img1 = cv2.imread(os.path.join(self.dump_dir, name+'_img1_cor.png'))
         img2 = cv2.imread(os.path.join(self.dump_dir, name+'_img2_cor.png'))
         n = np.shape(match)[1]
@@ -87,26 +115,32 @@ class Visualizer_debug():
             #print((x2, y2))
             cv2.circle(img1, (x1,y1), radius=1, color=colorlib[i%len(colorlib)], thickness=2)
             cv2.circle(img2, (x2,y2), radius=1, color=colorlib[i%len(colorlib)], thickness=2)
-        cv2.imwrite(os.path.join(self.dump_dir, name+'_img1_cor.png'), img1)
-        cv2.imwrite(os.path.join(self.dump_dir, name+'_img2_cor.png'), img2)
+        imwrite(os.path.join(self.dump_dir, name+'_img1_cor.png'), img1)
+        imwrite(os.path.join(self.dump_dir, name+'_img2_cor.png'), img2)
     
     def show_mask(self, mask, name):
         # mask: [H, W, 1]
         mask = mask / np.max(mask) * 255.0
-        cv2.imwrite(os.path.join(self.dump_dir, name+'.png'), mask)
+        self.writer.write(os.path.join(self.dump_dir, name+'.png'), mask)
     
     def save_img(self, img, name):
-        cv2.imwrite(os.path.join(self.dump_dir, name+'.png'), img)
+        self.writer.write(os.path.join(self.dump_dir, name+'.png'), np.array(img))
     
     def save_depth_img(self, depth, name):
+        self.writer.submit(self.write_depth_img, np.array(depth), name)
+
+    def write_depth_img(self, depth, name):
         # depth: [h,w,1]
         minddepth = np.min(depth)
         maxdepth = np.max(depth)
         depth_nor = (depth-minddepth) / (maxdepth-minddepth) * 255.0
         depth_nor = depth_nor.astype(np.uint8)
-        cv2.imwrite(os.path.join(self.dump_dir, name+'_depth.png'), depth_nor)
+        imwrite(os.path.join(self.dump_dir, name+'_depth.png'), depth_nor)
     
     def save_disp_color_img(self, disp, name):
+        self.writer.submit(self.write_disp_color_img, np.array(disp), name)
+
+    def write_disp_color_img(self, disp, name):
         vmax = np.percentile(disp, 95)
         normalizer = mpl.colors.Normalize(vmin=disp.min(), vmax=vmax)
         mapper = cm.ScalarMappable(norm=normalizer, cmap='magma')
@@ -132,6 +166,10 @@ class Visualizer_debug():
     
     def show_epipolar_line(self, img1, img2, match, F, name):
         # img: [H,W,3] match: [4,n] F: [3,3]
+        self.writer.submit(self.write_epipolar_line, np.array(img1), np.array(img2), np.array(match), F, name)
+        return None
+
+    def write_epipolar_line(self, img1, img2, match, F, name):
         pts1 = np.transpose(match[:2,:], [1,0])
         pts2 = np.transpose(match[2:,:], [1,0])
         lines1 = cv2.computeCorrespondEpilines(pts2.reshape(-1,1,2), 2,F)
@@ -144,8 +182,8 @@ class Visualizer_debug():
         lines2 = lines2.reshape(-1,3)
         img3,img4 = self.drawlines(img2,img1,lines2,pts2,pts1)
 
-        cv2.imwrite(os.path.join(self.dump_dir, name+'_1eline.png'), img5)
-        cv2.imwrite(os.path.join(self.dump_dir, name+'_2eline.png'), img3)
+        imwrite(os.path.join(self.dump_dir, name+'_1eline.png'), img5)
+        imwrite(os.path.join(self.dump_dir, name+'_2eline.png'), img3)
 
         return None
 
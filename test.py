@@ -1,77 +1,63 @@
 import os, sys
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-from core.dataset import KITTI_2012, KITTI_2015
-from core.evaluation import eval_flow_avg, load_gt_flow_kitti
+from core.dataset import KITTI_2012, KITTI_2015, KittiFlowPairs, NYU_Test
+from core.evaluation import FlowEvaluator, format_flow_result, load_gt_flow_kitti
 from core.evaluation import eval_depth
 from core.visualize import Visualizer_debug
 from core.networks import Model_flow
 from core.evaluation import load_gt_flow_kitti, load_gt_mask
 import torch
 from tqdm import tqdm
+from multiprocessing.pool import ThreadPool
 import pdb
 import cv2
 import numpy as np
 import yaml
 
+def model_device(model):
+    # The evaluation runs on the device of the model, a gpu or the cpu (asynchronous evaluation).
+    return next(model.parameters()).device
+
+def infer_flow_batches(cfg, model, dataset):
+    '''
+    Batched flow inference on the pairs of a KITTI_2012 / KITTI_2015 dataset, decoded by DataLoader
+    workers and copied to the GPU from pinned memory.
+    Yields (idx, flow), flow torch.Tensor (2, H, W) on the GPU.
+    '''
+    loader = torch.utils.data.DataLoader(KittiFlowPairs(dataset), batch_size=getattr(cfg, 'test_batch_size', None) or 1, shuffle=False,
+                                         num_workers=getattr(cfg, 'test_workers', 4), pin_memory=model_device(model).type == 'cuda', drop_last=False)
+    with torch.no_grad():
+        for idxs, imgs in loader:
+            imgs = imgs.to(model_device(model), non_blocking=True).float() / 255.0
+            img1, img2 = imgs[:,0], imgs[:,1]
+            if cfg.mode == 'flow' or cfg.mode == 'flowposenet':
+                flows = model.inference_flow(img1, img2)
+            for i, idx in enumerate(idxs.tolist()):
+                yield idx, flows[i]
+
 def test_kitti_2012(cfg, model, gt_flows, noc_masks):
     dataset = KITTI_2012(cfg.gt_2012_dir)
-    flow_list = []
-    for idx, inputs in enumerate(tqdm(dataset)):
-        # img, K, K_inv = inputs
-        img = inputs
-        img = img[None,:,:,:]
-        # K = K[None,:,:]
-        # K_inv = K_inv[None,:,:]
-        img_h = int(img.shape[2] / 2)
-        img1, img2 = img[:,:,:img_h,:], img[:,:,img_h:,:]
-        img1, img2 = img1.cuda(), img2.cuda()
-        if cfg.mode == 'flow' or cfg.mode == 'flowposenet':
-            flow = model.inference_flow(img1, img2)
-        
-        #pdb.set_trace()
-        flow = flow[0].detach().cpu().numpy()
-        flow = flow.transpose(1,2,0)
-        flow_list.append(flow)
-        
-    eval_flow_res = eval_flow_avg(gt_flows, noc_masks, flow_list, cfg, write_img=False)
-    
+    evaluator = FlowEvaluator(cfg.img_hw)
+    for idx, flow in tqdm(infer_flow_batches(cfg, model, dataset), total=len(dataset)):
+        evaluator.update(flow, gt_flows[idx], noc_masks[idx])
+
+    eval_flow_res = evaluator.result()
     print('CONFIG: {0}, mode: {1}'.format(cfg.config_file, cfg.mode))
     print('[EVAL] [KITTI 2012]')
-    print(eval_flow_res)
+    print(format_flow_result(eval_flow_res))
     return eval_flow_res
 
 def test_kitti_2015(cfg, model, gt_flows, noc_masks, gt_masks, depth_save_dir=None):
     dataset = KITTI_2015(cfg.gt_2015_dir)
     visualizer = Visualizer_debug(depth_save_dir)
-    pred_flow_list = []
-    pred_disp_list = []
-    img_list = []
-    for idx, inputs in enumerate(tqdm(dataset)):
-        # img, K, K_inv = inputs
-        img = inputs
-        img = img[None,:,:,:]
-        
-        img_h = int(img.shape[2] / 2)
-        img1, img2 = img[:,:,:img_h,:], img[:,:,img_h:,:]
-        img_list.append(img1)
-        img1, img2 = img1.cuda(), img2.cuda()
-        if cfg.mode == 'flow' or cfg.mode == 'flowposenet':
-            flow = model.inference_flow(img1, img2)
-        # else:
-        #     flow, disp1, disp2, Rt, _, _ = model.inference(img1, img2, K, K_inv)
-        #     disp = disp1[0].detach().cpu().numpy()
-        #     disp = disp.transpose(1,2,0)
-        #     pred_disp_list.append(disp)
+    evaluator = FlowEvaluator(cfg.img_hw, with_moving=True)
+    for idx, flow in tqdm(infer_flow_batches(cfg, model, dataset), total=len(dataset)):
+        evaluator.update(flow, gt_flows[idx], noc_masks[idx], gt_masks[idx])
 
-        flow = flow[0].detach().cpu().numpy()
-        flow = flow.transpose(1,2,0)
-        pred_flow_list.append(flow)
-        
-    #pdb.set_trace()
-    eval_flow_res = eval_flow_avg(gt_flows, noc_masks, pred_flow_list, cfg, moving_masks=gt_masks, write_img=False)
+    eval_flow_res = evaluator.result()
     print('CONFIG: {0}, mode: {1}'.format(cfg.config_file, cfg.mode))
     print('[EVAL] [KITTI 2015]')
-    print(eval_flow_res)
+    print(format_flow_result(eval_flow_res))
     ## depth evaluation
     return eval_flow_res
 
@@ -82,16 +68,23 @@ def disp2depth(disp, min_depth=0.001, max_depth=80.0):
     depth = 1 / scaled_disp
     return scaled_disp, depth
 
+def map_threads(fn, num_items, num_threads=8):
+    # cv2 and numpy release the GIL, the images are processed in threads.
+    pool = ThreadPool(num_threads)
+    res = pool.map(fn, range(num_items))
+    pool.close()
+    pool.join()
+    return res
+
 def resize_depths(gt_depth_list, pred_disp_list):
-    gt_disp_list = []
-    pred_depth_list = []
-    pred_disp_resized = []
-    for i in range(len(pred_disp_list)):
+    def resize(i):
         h, w = gt_depth_list[i].shape
         pred_disp = cv2.resize(pred_disp_list[i], (w,h))
         pred_depth = 1.0 / (pred_disp + 1e-4)
-        pred_depth_list.append(pred_depth)
-        pred_disp_resized.append(pred_disp)
+        return pred_depth, pred_disp
+    res = map_threads(resize, len(pred_disp_list))
+    pred_depth_list = [r[0] for r in res]
+    pred_disp_resized = [r[1] for r in res]
     
     return pred_depth_list, pred_disp_resized
 
@@ -105,7 +98,7 @@ def test_eigen_depth(cfg, model):
         img = cv2.imread(os.path.join(os.path.join(cfg.raw_base_dir, path1), 'image_02/data/'+str(idx)+'.png'))
         #img_resize = cv2.resize(img, (832,256))
         img_resize = cv2.resize(img, (cfg.img_hw[1], cfg.img_hw[0]))
-        img_input = torch.from_numpy(img_resize / 255.0).float().cuda().unsqueeze(0).permute(0,3,1,2)
+        img_input = torch.from_numpy(img_resize / 255.0).float().to(model_device(model)).unsqueeze(0).permute(0,3,1,2)
         disp = model.infer_depth(img_input)
         disp = disp[0].detach().cpu().numpy()
         disp = disp.transpose(1,2,0)
@@ -128,43 +121,29 @@ def test_eigen_depth(cfg, model):
 
 
 def resize_disp(pred_disp_list, gt_depths):
-    pred_depths = []
     h, w = gt_depths[0].shape[0], gt_depths[0].shape[1]
-    for i in range(len(pred_disp_list)):
-        disp = pred_disp_list[i]
-        resize_disp = cv2.resize(disp, (w,h))
-        depth = 1.0 / resize_disp
-        pred_depths.append(depth)
+    def resize(i):
+        resize_disp = cv2.resize(pred_disp_list[i], (w,h))
+        return 1.0 / resize_disp
+    pred_depths = map_threads(resize, len(pred_disp_list))
     
     return pred_depths
 
-import h5py
-import scipy.io as sio
-def load_nyu_test_data(data_dir):
-    data = h5py.File(os.path.join(data_dir, 'nyu_depth_v2_labeled.mat'), 'r')
-    splits = sio.loadmat(os.path.join(data_dir, 'splits.mat'))
-    test = np.array(splits['testNdxs']).squeeze(1)
-    images = np.transpose(data['images'], [0,1,3,2])
-    depths = np.transpose(data['depths'], [0,2,1])
-    images = images[test-1]
-    depths = depths[test-1]
-    return images, depths
+def load_nyu_test_data(data_dir, cache_dir=None):
+    # Test frames cropped to [45:472, 41:602], read lazily (see NYU_Test).
+    return NYU_Test(data_dir, cache_dir=cache_dir)
 
-def test_nyu(cfg, model, test_images, test_gt_depths):
-    leng = test_images.shape[0]
+def test_nyu(cfg, model, test_data):
+    leng = len(test_data)
     print('Test nyu depth on '+str(leng)+' images. Using depth model in '+cfg.model_dir)
     pred_disp_list = []
-    crop_imgs = []
     crop_gt_depths = []
     for i in range(leng):
-        img = test_images[i]
-        img_crop = img[:,45:472,41:602]
-        crop_imgs.append(img_crop)
-        gt_depth_crop = test_gt_depths[i][45:472,41:602]
+        img_crop, gt_depth_crop = test_data[i]
         crop_gt_depths.append(gt_depth_crop)
         #img = np.transpose(cv2.resize(np.transpose(img_crop, [1,2,0]), (576,448)), [2,0,1])
         img = np.transpose(cv2.resize(np.transpose(img_crop, [1,2,0]), (cfg.img_hw[1],cfg.img_hw[0])), [2,0,1])
-        img_t = torch.from_numpy(img).float().cuda().unsqueeze(0) / 255.0
+        img_t = torch.from_numpy(img).float().to(model_device(model)).unsqueeze(0) / 255.0
         disp = model.infer_depth(img_t)
         disp = np.transpose(disp[0].cpu().detach().numpy(), [1,2,0])
         pred_disp_list.append(disp)
@@ -194,6 +173,7 @@ def test_single_image(img_path, model, training_hw, save_dir='./'):
 
     visualizer = Visualizer_debug(dump_dir=save_dir)
     visualizer.save_disp_color_img(disp_resized, name='demo')
+    visualizer.flush()
     print('Depth prediction saved in ' + save_dir)
 
 
@@ -250,12 +230,13 @@ if __name__ == '__main__':
     if args.task == 'kitti_depth':
         depth_res = test_eigen_depth(cfg_new, model)
     elif args.task == 'kitti_flow':
-        gt_flows_2015, noc_masks_2015 = load_gt_flow_kitti(cfg_new.gt_2015_dir, 'kitti_2015')
-        gt_masks_2015 = load_gt_mask(cfg_new.gt_2015_dir)
+        gt_cache_dir = getattr(cfg_new, 'gt_cache_dir', None)
+        gt_flows_2015, noc_masks_2015 = load_gt_flow_kitti(cfg_new.gt_2015_dir, 'kitti_2015', cache_dir=gt_cache_dir)
+        gt_masks_2015 = load_gt_mask(cfg_new.gt_2015_dir, cache_dir=gt_cache_dir)
         flow_res = test_kitti_2015(cfg_new, model, gt_flows_2015, noc_masks_2015, gt_masks_2015)
     elif args.task == 'nyuv2':
-        test_images, test_gt_depths = load_nyu_test_data(cfg_new.nyu_test_dir)
-        depth_res = test_nyu(cfg_new, model, test_images, test_gt_depths)
+        test_data = load_nyu_test_data(cfg_new.nyu_test_dir, cache_dir=getattr(cfg_new, 'nyu_test_cache_dir', None))
+        depth_res = test_nyu(cfg_new, model, test_data)
     elif args.task == 'demo':
         test_single_image(args.image_path, model, training_hw=cfg['img_hw'], save_dir=args.result_dir)
 
@@ -1,11 +1,12 @@
 import os, sys
 import yaml
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-from core.dataset import KITTI_RAW, KITTI_Prepared, SINTEL_RAW, SINTEL_Prepared, NYU_Prepare, NYU_v2, KITTI_Odo
+from core.dataset import KITTI_RAW, KITTI_Prepared, SINTEL_RAW, SINTEL_Prepared, NYU_Prepare, NYU_v2, KITTI_Odo, RawTriplets
+from core.dataset import get_batch_augment, collate_frames, DataPrefetcher, get_sample_codec, get_sample_cache
 from core.networks import get_model
 from core.config import generate_loss_weights_dict
 from core.visualize import Visualizer
-from core.evaluation import load_gt_flow_kitti, load_gt_mask
+from core.evaluation import load_gt_flow_kitti, load_gt_mask, AsyncCall, load_kitti_gt, AsyncEvaluator
 from test import test_kitti_2012, test_kitti_2015, test_eigen_depth, test_nyu, load_nyu_test_data
 
 from collections import OrderedDict
@@ -30,7 +31,51 @@ def load_model(model_dir, filename, model, optimizer):
     optimizer.load_state_dict(data['optimizer_state_dict'])
     return iter_, model, optimizer
 
+def add_eval_results(visualizer, results):
+    # Results of the asynchronous evaluation, logged when they arrive.
+    for eval_iter, log_pack in results:
+        if log_pack:
+            log_pack['eval_iter'] = eval_iter
+            visualizer.add_log_pack(log_pack)
+    if len(results) > 0:
+        visualizer.dump_log()
+
+def build_eval_model(cfg):
+    return get_model(cfg.mode)(cfg)
+
+def load_eval_data(cfg):
+    # Test data of the periodic evaluation.
+    if cfg.dataset == 'kitti_depth' or cfg.dataset == 'kitti_odo' or cfg.dataset == 'sintel_raw':
+        gt_cache_dir = getattr(cfg, 'gt_cache_dir', None) or os.path.join(cfg.prepared_base_dir, 'gt_cache')
+        return load_kitti_gt(cfg, cache_dir=gt_cache_dir)
+    elif cfg.dataset == 'nyuv2':
+        return load_nyu_test_data(cfg.nyu_test_dir, cache_dir=getattr(cfg, 'nyu_test_cache_dir', None))
+    return None
+
+def evaluate(cfg, model_eval, eval_data):
+    # Periodic evaluation, returns the log pack of the results.
+    log_pack = {}
+    if cfg.dataset == 'kitti_depth' or cfg.dataset == 'kitti_odo' or cfg.dataset == 'sintel_raw':
+        if not (cfg.mode == 'depth' or cfg.mode == 'flowposenet'):
+            gt_flows_2012, noc_masks_2012, gt_flows_2015, noc_masks_2015, gt_masks_2015 = eval_data
+            log_pack['eval_2012_res'] = test_kitti_2012(cfg, model_eval, gt_flows_2012, noc_masks_2012)
+            log_pack['eval_2015_res'] = test_kitti_2015(cfg, model_eval, gt_flows_2015, noc_masks_2015, gt_masks_2015, depth_save_dir=os.path.join(cfg.model_dir, 'results'))
+    elif cfg.dataset == 'nyuv2':
+        if not cfg.mode == 'flow':
+            log_pack['eval_nyu_res'] = test_nyu(cfg, model_eval, eval_data)
+    return log_pack
+
 def train(cfg):
+    # periodic evaluation in another process (cfg.async_eval), or inline in the training loop
+    async_evaluator = None
+    if getattr(cfg, 'async_eval', False) and not cfg.no_test:
+        async_evaluator = AsyncEvaluator(cfg, build_eval_model, load_eval_data, evaluate, device=getattr(cfg, 'eval_device', None) or 'cpu')
+
+    # decode (or map from the cache) the evaluation ground truth while the model is built
+    eval_loader = None
+    if async_evaluator is None and not cfg.no_test:
+        eval_loader = AsyncCall(load_eval_data, cfg)
+
     # load model and optimizer
     model = get_model(cfg.mode)(cfg)
     if cfg.multi_gpu:
@@ -79,70 +124,90 @@ def train(cfg):
 
     # load dataset
     data_dir = os.path.join(cfg.prepared_base_dir, cfg.prepared_save_dir)
-    if not os.path.exists(os.path.join(data_dir, 'train.txt')):
+    # Preparation is incremental: finished drives are skipped, new or unfinished ones are processed.
+    # Without the raw data an already prepared dataset is used as it is.
+    # Virtual triplets are read from the raw drives, nothing is prepared.
+    virtual_triplets = getattr(cfg, 'virtual_triplets', False) and cfg.dataset in ['kitti_depth', 'kitti_odo', 'sintel_raw']
+    codec = get_sample_codec(cfg)
+    # other strides prepared in the same pass over the raw frames, {stride: prepared_save_dir}
+    prep_stride_dirs = getattr(cfg, 'prep_stride_dirs', None) or {}
+    stride_dirs = dict([(int(k), os.path.join(cfg.prepared_base_dir, v)) for k, v in prep_stride_dirs.items()])
+    if not virtual_triplets and (os.path.isdir(cfg.raw_base_dir) or not os.path.exists(os.path.join(data_dir, 'train.txt'))):
         if cfg.dataset == 'kitti_depth':
             kitti_raw_dataset = KITTI_RAW(cfg.raw_base_dir, cfg.static_frames_txt, cfg.test_scenes_txt)
-            kitti_raw_dataset.prepare_data_mp(data_dir, stride=1)
+            kitti_raw_dataset.prepare_data_mp(data_dir, stride=1, num_workers=cfg.prep_workers, io_concurrency=cfg.io_concurrency, codec=codec, stride_dirs=stride_dirs)
         elif cfg.dataset == 'sintel_raw':
             sintel_raw_dataset = SINTEL_RAW(cfg.raw_base_dir)
-            sintel_raw_dataset.prepare_data_mp(data_dir, cfg.stride)
+            sintel_raw_dataset.prepare_data_mp(data_dir, cfg.stride, num_workers=cfg.prep_workers, io_concurrency=cfg.io_concurrency, codec=codec, stride_dirs=stride_dirs)
         elif cfg.dataset == 'kitti_odo':
             kitti_raw_dataset = KITTI_Odo(cfg.raw_base_dir)
-            kitti_raw_dataset.prepare_data_mp(data_dir, stride=1)
+            kitti_raw_dataset.prepare_data_mp(data_dir, stride=1, num_workers=cfg.prep_workers, io_concurrency=cfg.io_concurrency, codec=codec, stride_dirs=stride_dirs)
         elif cfg.dataset == 'nyuv2':
             nyu_raw_dataset = NYU_Prepare(cfg.raw_base_dir, cfg.nyu_test_dir)
-            nyu_raw_dataset.prepare_data_mp(data_dir, stride=10)
+            # undistort, crop and resize offline instead of in every training sample
+            img_hw = cfg.img_hw if getattr(cfg, 'nyu_offline_undistort', False) else None
+            nyu_raw_dataset.prepare_data_mp(data_dir, stride=10, num_workers=cfg.prep_workers, io_concurrency=cfg.io_concurrency, codec=codec, img_hw=img_hw, stride_dirs=stride_dirs)
         else:
             raise NotImplementedError
         
     
-    if cfg.dataset == 'kitti_depth':
-        dataset = KITTI_Prepared(data_dir, num_scales=cfg.num_scales, img_hw=cfg.img_hw, num_iterations=(cfg.num_iterations - cfg.iter_start) * cfg.batch_size)
+    batch_augment = get_batch_augment(cfg)
+    if virtual_triplets:
+        strides = getattr(cfg, 'triplet_strides', None) or [getattr(cfg, 'stride', 1)]
+        dataset = RawTriplets(cfg.raw_base_dir, source=cfg.dataset, strides=strides, static_frames_txt=getattr(cfg, 'static_frames_txt', None), test_scenes_txt=getattr(cfg, 'test_scenes_txt', None), num_scales=cfg.num_scales, img_hw=cfg.img_hw, num_iterations=(cfg.num_iterations - cfg.iter_start) * cfg.batch_size, batch_augment=batch_augment is not None)
+    elif cfg.dataset == 'kitti_depth':
+        dataset = KITTI_Prepared(data_dir, num_scales=cfg.num_scales, img_hw=cfg.img_hw, num_iterations=(cfg.num_iterations - cfg.iter_start) * cfg.batch_size, batch_augment=batch_augment is not None)
     elif cfg.dataset == 'sintel_raw':
-        dataset = SINTEL_Prepared(data_dir, num_scales=cfg.num_scales, img_hw=cfg.img_hw, num_iterations=(cfg.num_iterations - cfg.iter_start) * cfg.batch_size)
+        dataset = SINTEL_Prepared(data_dir, num_scales=cfg.num_scales, img_hw=cfg.img_hw, num_iterations=(cfg.num_iterations - cfg.iter_start) * cfg.batch_size, batch_augment=batch_augment is not None)
     elif cfg.dataset == 'kitti_odo':
-        dataset = KITTI_Prepared(data_dir, num_scales=cfg.num_scales, img_hw=cfg.img_hw, num_iterations=(cfg.num_iterations - cfg.iter_start) * cfg.batch_size)
+        dataset = KITTI_Prepared(data_dir, num_scales=cfg.num_scales, img_hw=cfg.img_hw, num_iterations=(cfg.num_iterations - cfg.iter_start) * cfg.batch_size, batch_augment=batch_augment is not None)
     elif cfg.dataset == 'nyuv2':
+        # NYU samples carry intrinsics, they are not augmented on the device.
+        batch_augment = None
         dataset = NYU_v2(data_dir, num_scales=cfg.num_scales, img_hw=cfg.img_hw, num_iterations=(cfg.num_iterations - cfg.iter_start) * cfg.batch_size)
     else:
         raise NotImplementedError
     
-    dataloader = torch.utils.data.DataLoader(dataset, batch_size=cfg.batch_size, shuffle=True, num_workers=cfg.num_workers, drop_last=False)
-    if cfg.dataset == 'kitti_depth' or cfg.dataset == 'kitti_odo' or cfg.dataset == 'sintel_raw':
-        gt_flows_2012, noc_masks_2012 = load_gt_flow_kitti(cfg.gt_2012_dir, 'kitti_2012')
-        gt_flows_2015, noc_masks_2015 = load_gt_flow_kitti(cfg.gt_2015_dir, 'kitti_2015')
-        gt_masks_2015 = load_gt_mask(cfg.gt_2015_dir)
-    elif cfg.dataset == 'nyuv2':
-        test_images, test_gt_depths = load_nyu_test_data(cfg.nyu_test_dir)
+    # decoded samples shared by all the dataloader workers, created before they are forked
+    sample_cache = get_sample_cache(cfg, dataset)
+    dataset.sample_cache = sample_cache
+    collate_fn = collate_frames if batch_augment is not None else None
+    dataloader = torch.utils.data.DataLoader(dataset, batch_size=cfg.batch_size, shuffle=True, num_workers=cfg.num_workers, drop_last=False, collate_fn=collate_fn)
+    # pins batches and copies the next ones to the gpu while the current step runs
+    prefetcher = DataPrefetcher(dataloader, device='cuda', depth=cfg.prefetch_depth)
+    eval_data = eval_loader.result() if eval_loader is not None else None
 
     # training
     print('starting iteration: {}.'.format(cfg.iter_start))
-    for iter_, inputs in enumerate(tqdm(dataloader)):
+    for iter_, inputs in enumerate(tqdm(prefetcher)):
         if (iter_ + 1) % cfg.test_interval == 0 and (not cfg.no_test):
-            model.eval()
             if args.multi_gpu:
                 model_eval = model.module
             else:
                 model_eval = model
-            if cfg.dataset == 'kitti_depth' or cfg.dataset == 'kitti_odo' or cfg.dataset == 'sintel_raw':
-                if not (cfg.mode == 'depth' or cfg.mode == 'flowposenet'):
-                    eval_2012_res = test_kitti_2012(cfg, model_eval, gt_flows_2012, noc_masks_2012)
-                    eval_2015_res = test_kitti_2015(cfg, model_eval, gt_flows_2015, noc_masks_2015, gt_masks_2015, depth_save_dir=os.path.join(cfg.model_dir, 'results'))
-                    visualizer.add_log_pack({'eval_2012_res': eval_2012_res, 'eval_2015_res': eval_2015_res})
-            elif cfg.dataset == 'nyuv2':
-                if not cfg.mode == 'flow':
-                    eval_nyu_res = test_nyu(cfg, model_eval, test_images, test_gt_depths)
-                    visualizer.add_log_pack({'eval_nyu_res': eval_nyu_res})
-            visualizer.dump_log(os.path.join(cfg.model_dir, 'log.pkl'))
+            if async_evaluator is not None:
+                async_evaluator.submit(iter_ + cfg.iter_start, model_eval)
+            else:
+                model.eval()
+                log_pack = evaluate(cfg, model_eval, eval_data)
+                if log_pack:
+                    log_pack['eval_iter'] = iter_ + cfg.iter_start
+                    visualizer.add_log_pack(log_pack)
+                visualizer.dump_log()
+        if async_evaluator is not None:
+            add_eval_results(visualizer, async_evaluator.poll())
         model.train()
         iter_ = iter_ + cfg.iter_start
         optimizer.zero_grad()
-        inputs = inputs.cuda()
-        #inputs = [k.cuda() for k in inputs]
+        if batch_augment is not None:
+            inputs = batch_augment(inputs, iter_=iter_)
         loss_pack = model(inputs)
 
         if iter_ % cfg.log_interval == 0:
-            visualizer.print_loss(loss_pack, iter_=iter_)
+            stats = prefetcher.stats()
+            if sample_cache is not None:
+                stats.update(sample_cache.stats())
+            visualizer.print_loss(loss_pack, iter_=iter_, stats=stats)
 
         loss_list = []
         for key in list(loss_pack.keys()):
@@ -154,9 +219,14 @@ def train(cfg):
             save_model(iter_, cfg.model_dir, 'iter_{}.pth'.format(iter_), model, optimizer)
             save_model(iter_, cfg.model_dir, 'last.pth'.format(iter_), model, optimizer)
     
+    if async_evaluator is not None:
+        add_eval_results(visualizer, async_evaluator.close())
+
     if cfg.dataset == 'kitti_depth':
         if cfg.mode == 'depth' or cfg.mode == 'depth_pose':
             eval_depth_res = test_eigen_depth(cfg, model_eval)
+            visualizer.add_log_pack({'eval_depth_res': eval_depth_res, 'eval_iter': iter_})
+    visualizer.close()
 
 if __name__ == '__main__':
     import argparse
@@ -169,6 +239,9 @@ if __name__ == '__main__':
     arg_parser.add_argument('--iter_start', type=int, default=0, help='starting iteration.')
     arg_parser.add_argument('--lr', type=float, default=0.0001, help='learning rate')
     arg_parser.add_argument('--num_workers', type=int, default=4, help='number of workers.')
+    arg_parser.add_argument('--prep_workers', type=int, default=None, help='number of data preparation workers, defaults to the available cores.')
+    arg_parser.add_argument('--io_concurrency', type=int, default=None, help='max number of preparation workers reading the raw data at once.')
+    arg_parser.add_argument('--prefetch_depth', type=int, default=2, help='number of batches staged on the gpu ahead of the training step.')
     arg_parser.add_argument('--log_interval', type=int, default=100, help='interval for printing loss.')
     arg_parser.add_argument('--test_interval', type=int, default=2000, help='interval for evaluation.')
     arg_parser.add_argument('--save_interval', type=int, default=2000, help='interval for saving models.')
@@ -180,6 +253,8 @@ if __name__ == '__main__':
     arg_parser.add_argument('--resume', action='store_true', help='to resume training.')
     arg_parser.add_argument('--multi_gpu', action='store_true', help='to use multiple gpu for training.')
     arg_parser.add_argument('--no_test', action='store_true', help='without evaluation.')
+    arg_parser.add_argument('--async_eval', action='store_true', help='evaluate in another process while training goes on.')
+    arg_parser.add_argument('--eval_device', type=str, default='cpu', help='device of the asynchronous evaluation, cpu, a gpu id or cuda:<id> (among the visible gpus).')
     args = arg_parser.parse_args()
         #args.config_file = 'config/debug.yaml'
     if args.config_file is None:
@@ -196,7 +271,8 @@ if __name__ == '__main__':
     with open(args.config_file, 'r') as f:
         cfg = yaml.safe_load(f)
     cfg['img_hw'] = (cfg['img_hw'][0], cfg['img_hw'][1])
-    cfg['log_dump_dir'] = os.path.join(args.model_dir, 'log.pkl')
+    # append-only metrics log, core/visualize/metrics_log.py converts the log.pkl of older runs
+    cfg['log_dump_dir'] = os.path.join(args.model_dir, 'metrics.jsonl')
     shutil.copy(args.config_file, args.model_dir)
 
     # copy attr into cfg